@@ -0,0 +1,175 @@
+# Main file for create large spatial test data
+import argparse
+import os
+import sys
+import time
+from enum import Enum
+
+import numpy as np
+
+CHUNK_SIZE = 10000000
+REGION = [40, 42, -75, -73]  # bottom, up, left, right
+TIME_RANGE = [0, 86400]  # 3D点的第三维：一天内的秒数
+
+
+class SpatialDistribution(Enum):
+    UNIFORM = 0
+    GAUSSIAN_CLUSTER = 1
+    ROAD_NETWORK = 2
+    TAXI = 3
+
+
+class SpatialDataGenerator:
+    def __init__(self, distribution, region=REGION, dims=2, seed=1, cluster_num=100, road_num=200, hotspot_num=50):
+        """
+        vectorized spatial data generator, the structures of distribution (clusters, roads, hotspots) are created
+        by seed once, every chunk is created by its own generator of (seed, chunk id), so the data are fixed by seed
+        :param distribution: SpatialDistribution
+        :param region: [bottom, up, left, right]
+        :param dims: 2 for x/y, 3 for x/y/t
+        :param seed: int
+        """
+        self.distribution = distribution
+        self.bottom, self.up, self.left, self.right = region
+        self.dims = dims
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        width, height = self.right - self.left, self.up - self.bottom
+        # gaussian cluster: 中心均匀分布，权重和半径随机
+        self.cluster_centers = self.uniform_points(rng, cluster_num)
+        self.cluster_weights = normalize(rng.uniform(0.2, 1, cluster_num))
+        self.cluster_sigmas = rng.uniform(0.002, 0.02, cluster_num)[:, np.newaxis] * [width, height]
+        # road network: 横纵方向的网格道路和少量斜向道路，主干道权重更高
+        grid_num = road_num * 4 // 5
+        starts = self.uniform_points(rng, road_num)
+        ends = self.uniform_points(rng, road_num)
+        horizontal = np.arange(road_num) < grid_num // 2
+        vertical = (np.arange(road_num) >= grid_num // 2) & (np.arange(road_num) < grid_num)
+        starts[horizontal, 0], ends[horizontal, 0] = self.left, self.right
+        ends[horizontal, 1] = starts[horizontal, 1]
+        starts[vertical, 1], ends[vertical, 1] = self.bottom, self.up
+        ends[vertical, 0] = starts[vertical, 0]
+        self.road_starts = starts
+        self.road_vectors = ends - starts
+        self.road_weights = normalize(rng.pareto(1.5, road_num) + 1)
+        self.road_width = 0.0005 * min(width, height)
+        # taxi: 热点按zipf分布，离热点的距离按指数分布，长尾覆盖整个区域
+        self.hotspot_centers = self.uniform_points(rng, hotspot_num)
+        self.hotspot_weights = normalize(1.0 / np.arange(1, hotspot_num + 1))
+        self.hotspot_scale = 0.01 * min(width, height)
+
+    def uniform_points(self, rng, size):
+        return np.stack([rng.uniform(self.left, self.right, size), rng.uniform(self.bottom, self.up, size)], axis=1)
+
+    def generate_chunk(self, chunk_id, size):
+        """
+        create points of chunk
+        :param chunk_id: int, seed of chunk generator together with seed
+        :param size: point nums
+        :return: np.array, shape = [size, dims]
+        """
+        rng = np.random.default_rng([self.seed, chunk_id])
+        if self.distribution == SpatialDistribution.UNIFORM:
+            points = self.uniform_points(rng, size)
+        elif self.distribution == SpatialDistribution.GAUSSIAN_CLUSTER:
+            clusters = weighted_choice(rng, self.cluster_weights, size)
+            points = self.cluster_centers[clusters] + rng.standard_normal((size, 2)) * self.cluster_sigmas[clusters]
+        elif self.distribution == SpatialDistribution.ROAD_NETWORK:
+            roads = weighted_choice(rng, self.road_weights, size)
+            points = self.road_starts[roads] + rng.random((size, 1)) * self.road_vectors[roads]
+            points += rng.standard_normal((size, 2)) * self.road_width
+        elif self.distribution == SpatialDistribution.TAXI:
+            hotspots = weighted_choice(rng, self.hotspot_weights, size)
+            distances = rng.exponential(self.hotspot_scale, size)
+            angles = rng.uniform(0, 2 * np.pi, size)
+            points = self.hotspot_centers[hotspots] + np.stack([np.cos(angles), np.sin(angles)], axis=1) * \
+                     distances[:, np.newaxis]
+        else:
+            raise ValueError("unknown distribution: %s" % self.distribution)
+        # 超出区域的点clip到边界内，z order不接受right和up上的点
+        np.clip(points[:, 0], self.left, np.nextafter(self.right, self.left), out=points[:, 0])
+        np.clip(points[:, 1], self.bottom, np.nextafter(self.up, self.bottom), out=points[:, 1])
+        if self.dims == 3:
+            times = rng.uniform(TIME_RANGE[0], TIME_RANGE[1], size)
+            points = np.concatenate([points, times[:, np.newaxis]], axis=1)
+        return points
+
+    def generate_chunks(self, data_size, chunk_size=CHUNK_SIZE):
+        """
+        create data_size points chunk by chunk
+        :return: generator of np.array
+        """
+        for chunk_id, start in enumerate(range(0, data_size, chunk_size)):
+            yield self.generate_chunk(chunk_id, min(chunk_size, data_size - start))
+
+    def save_npy(self, path, data_size, chunk_size=CHUNK_SIZE):
+        """
+        write points into npy file by memmap, shape = [data_size, dims]
+        """
+        data = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=(data_size, self.dims))
+        start = 0
+        for chunk in self.generate_chunks(data_size, chunk_size):
+            data[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        data.flush()
+        del data
+
+    def save_parquet(self, path, data_size, chunk_size=CHUNK_SIZE):
+        """
+        write points into parquet file, one row group for every chunk, columns = [x, y] or [x, y, t]
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        names = ['x', 'y', 't'][:self.dims]
+        schema = pa.schema([(name, pa.float64()) for name in names])
+        with pq.ParquetWriter(path, schema) as writer:
+            for chunk in self.generate_chunks(data_size, chunk_size):
+                writer.write_table(pa.Table.from_arrays([pa.array(chunk[:, i]) for i in range(self.dims)],
+                                                        schema=schema))
+
+
+def normalize(weights):
+    return weights / weights.sum()
+
+
+def weighted_choice(rng, weights, size):
+    # 比rng.choice(p=weights)快：直接在累积分布上二分
+    cdf = np.cumsum(weights)
+    return np.minimum(np.searchsorted(cdf, rng.random(size) * cdf[-1], side='right'), len(weights) - 1)
+
+
+def create_spatial_data(path, distribution, data_size, dims=2, seed=1, region=REGION, chunk_size=CHUNK_SIZE):
+    """
+    create spatial data into .npy or .parquet by the suffix of path
+    """
+    file_path = os.path.dirname(path)
+    if file_path and os.path.exists(file_path) is False:
+        os.makedirs(file_path)
+    generator = SpatialDataGenerator(distribution, region, dims, seed)
+    if path.endswith('.parquet'):
+        generator.save_parquet(path, data_size, chunk_size)
+    elif path.endswith('.npy'):
+        generator.save_npy(path, data_size, chunk_size)
+    else:
+        raise ValueError("unknown file type: %s, use .npy or .parquet" % path)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='create large spatial data into .npy or .parquet')
+    parser.add_argument('path', help='output file, .npy or .parquet')
+    parser.add_argument('-d', '--distribution', default='uniform',
+                        choices=[distribution.name.lower() for distribution in SpatialDistribution])
+    parser.add_argument('-n', '--num', type=int, default=100000000)
+    parser.add_argument('--dims', type=int, default=2, choices=[2, 3])
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--region', type=float, nargs=4, default=REGION, metavar=('BOTTOM', 'UP', 'LEFT', 'RIGHT'))
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    start_time = time.time()
+    create_spatial_data(args.path, SpatialDistribution[args.distribution.upper()], args.num, args.dims, args.seed,
+                        args.region, args.chunk_size)
+    print("Create %d points time " % args.num, time.time() - start_time)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,6 +2,8 @@
 
 import pandas as pd
 
+from src.spatial_index.common_utils import memory_usage_of
+
 # Node in BTree
 class BTreeNode:
     def __init__(self, degree=2, number_of_keys=0, is_leaf=True, items=None, children=None,
@@ -247,6 +249,16 @@ class BTree:
     def write_at(self, index, a_node):
         self.nodes[index] = a_node
 
+    def memory_usage(self):
+        """
+        bytes of every component, keys and positions: k and v of items, tree_nodes: nodes with their items
+        :return: dict, component name -> bytes, and total bytes
+        """
+        items = [item for node in self.nodes.values() for item in node.items[:node.numberOfKeys]]
+        return memory_usage_of({'keys': [item.k for item in items],
+                                'positions': [item.v for item in items],
+                                'tree_nodes': [self.nodes]})
+
 # Value in Node
 class Item():
     def __init__(self, k, v):
@@ -0,0 +1,217 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from src.spatial_index.common_utils import Region, MEMORY_COMPONENTS
+
+INDEX_NAMES = ['rtree', 'quadtree', 'zm', 'geohash']
+WORKLOADS = ['point', 'knn', 'range']
+RESULT_FIELDS = ['index', 'workload', 'data_num', 'build_time', 'query_num', 'p50', 'p95', 'p99', 'throughput',
+                 'misses', 'result_num', 'bytes_per_key'] + ['memory_' + name for name in MEMORY_COMPONENTS] + \
+                ['memory_total']
+
+
+def create_index(name, region, model_path, model_type, max_num):
+    """
+    create index by name, the modules are imported here so that the missing packages only affect their indexes
+    :param name: rtree/quadtree/zm/geohash
+    :param region: Region of data
+    :param model_path: dir of models, every learned index uses its sub dir
+    :param model_type: model type of learned indexes, nn/linear/pla/radix_spline
+    :param max_num: max points of quad tree node
+    :return: index
+    """
+    if name == 'rtree':
+        from src.spatial_index.r_tree import RTree
+        return RTree()
+    elif name == 'quadtree':
+        from src.spatial_index.quad_tree import QuadTree
+        return QuadTree(region=region, max_num=max_num)
+    elif name == 'zm':
+        from src.spatial_index.zm_index import ZMIndex
+        index = ZMIndex(region=region, model_path=os.path.join(model_path, 'zm_index/'))
+        index.model_types = [model_type] * index.stage_length
+        return index
+    elif name == 'geohash':
+        from src.spatial_index.geohash_model_index import GeoHashModelIndex
+        index = GeoHashModelIndex(region=region, max_num=max_num, model_path=os.path.join(model_path, 'gm_index/'))
+        index.model_type = model_type
+        return index
+    else:
+        raise ValueError("unknown index: %s" % name)
+
+
+def load_data(path, x_col, y_col, num, region, seed):
+    """
+    load x/y data from file, or create uniform random data in region if path is None
+    .npy: [n, dims] array created by data/create_spatial_data.py, x_col and y_col are its columns, 0 and 1 if None
+    .parquet: x and y columns, csv: file without header, x_col and y_col are its columns, 2 and 3 if None
+    :return: pd.DataFrame, [x, y]
+    """
+    if path is not None:
+        if path.endswith('.npy'):
+            x_col = 0 if x_col is None else x_col
+            y_col = 1 if y_col is None else y_col
+            points = np.load(path, mmap_mode='r')[:num]
+            return pd.DataFrame({'x': np.array(points[:, x_col]), 'y': np.array(points[:, y_col])})
+        if path.endswith('.parquet'):
+            data = pd.read_parquet(path, columns=['x', 'y'])
+        else:
+            x_col = 2 if x_col is None else x_col
+            y_col = 3 if y_col is None else y_col
+            data = pd.read_csv(path, header=None, usecols=[x_col, y_col], names=["x", "y"])
+        return data if num is None else data.iloc[:num].reset_index(drop=True)
+    rng = np.random.default_rng(seed)
+    num = 100000 if num is None else num
+    return pd.DataFrame({'x': rng.uniform(region.left, region.right, num),
+                         'y': rng.uniform(region.bottom, region.up, num)})
+
+
+def create_workloads(data, query_num, range_size, seed):
+    """
+    create the same query workloads for all the indexes
+    point and knn: points sampled from data, range: windows of range_size centered at the sampled points
+    :return: dict, workload -> pd.DataFrame
+    """
+    points = data.sample(n=min(query_num, len(data)), random_state=seed).reset_index(drop=True)
+    half = range_size / 2
+    windows = pd.DataFrame({'x1': points.x - half, 'y1': points.y - half, 'x2': points.x + half, 'y2': points.y + half})
+    return {'point': points, 'knn': points, 'range': windows}
+
+
+def run_query(index, workload, queries, k):
+    """
+    run queries of workload
+    :return: pd.Series of results, None if the index does not support the workload
+    """
+    if workload == 'point':
+        return index.point_query(queries)
+    elif workload == 'knn':
+        return index.knn_query(queries, k) if hasattr(index, 'knn_query') else None
+    elif workload == 'range':
+        return index.range_query(queries) if hasattr(index, 'range_query') else None
+    raise ValueError("unknown workload: %s" % workload)
+
+
+def count_results(workload, results, k):
+    """
+    misses: points not found, or knn queries with less than k neighbours; result_num: points returned by all queries
+    """
+    if workload == 'point':
+        return int(results.isna().sum()), int(results.notna().sum())
+    result_nums = np.array([len(result) for result in results], dtype=np.int64)
+    misses = int((result_nums < k).sum()) if workload == 'knn' else None
+    return misses, int(result_nums.sum())
+
+
+def benchmark_index(name, data, workloads, args):
+    """
+    build index and run workloads
+    1. build index on a copy of data, the learned indexes sort the data in place
+    2. latency: run every query alone, throughput: run all the queries in one batch
+    3. memory of index by memory_usage
+    :return: list of result dict, one for every workload
+    """
+    # 1. build index
+    index = create_index(name, args.region, args.model_path, args.model_type, args.max_num)
+    start_time = time.perf_counter()
+    index.build(data.copy())
+    build_time = time.perf_counter() - start_time
+    # 3. memory of index
+    memory_usage = index.memory_usage() if hasattr(index, 'memory_usage') else None
+    records = []
+    for workload in args.workloads:
+        queries = workloads[workload]
+        # 2. throughput: run all the queries in one batch
+        start_time = time.perf_counter()
+        results = run_query(index, workload, queries, args.k)
+        batch_time = time.perf_counter() - start_time
+        if results is None:
+            continue
+        misses, result_num = count_results(workload, results, args.k)
+        # 2. latency: run every query alone
+        latency_num = min(args.latency_queries, len(queries))
+        latencies = np.empty(latency_num)
+        for i in range(latency_num):
+            start_time = time.perf_counter()
+            run_query(index, workload, queries.iloc[i:i + 1].reset_index(drop=True), args.k)
+            latencies[i] = time.perf_counter() - start_time
+        record = {'index': index.name,
+                  'workload': workload,
+                  'data_num': len(data),
+                  'build_time': build_time,
+                  'query_num': len(queries),
+                  'p50': float(np.percentile(latencies, 50)) if latency_num else None,
+                  'p95': float(np.percentile(latencies, 95)) if latency_num else None,
+                  'p99': float(np.percentile(latencies, 99)) if latency_num else None,
+                  'throughput': len(queries) / batch_time if batch_time > 0 else None,
+                  'misses': misses,
+                  'result_num': result_num,
+                  'bytes_per_key': memory_usage['total'] / len(data) if memory_usage else None}
+        for component in MEMORY_COMPONENTS + ['total']:
+            record['memory_' + component] = memory_usage[component] if memory_usage else None
+        records.append(record)
+        print("%s %s: p50 %.6fs, p99 %.6fs, throughput %.1f/s, misses %s" %
+              (index.name, workload, record['p50'] or 0, record['p99'] or 0, record['throughput'] or 0, misses))
+    return records
+
+
+def save_results(records, output):
+    """
+    save results into output.json and output.csv
+    """
+    file_path = os.path.dirname(output)
+    if file_path and os.path.exists(file_path) is False:
+        os.makedirs(file_path)
+    with open(output + '.json', 'w') as f:
+        json.dump(records, f, indent=2)
+    with open(output + '.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(records)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='build every index on the same data and run the same workloads')
+    parser.add_argument('--data', default=None, help='csv without header, .npy or .parquet, uniform random data '
+                                                     'if not set')
+    parser.add_argument('--x-col', type=int, default=None, help='column of x, default 2 for csv and 0 for .npy')
+    parser.add_argument('--y-col', type=int, default=None, help='column of y, default 3 for csv and 1 for .npy')
+    parser.add_argument('--num', type=int, default=None, help='data num, all the csv rows if not set')
+    parser.add_argument('--region', type=float, nargs=4, default=[40, 42, -75, -73],
+                        metavar=('BOTTOM', 'UP', 'LEFT', 'RIGHT'))
+    parser.add_argument('--indexes', nargs='+', choices=INDEX_NAMES, default=INDEX_NAMES)
+    parser.add_argument('--workloads', nargs='+', choices=WORKLOADS, default=WORKLOADS)
+    parser.add_argument('--queries', type=int, default=10000, help='query num of every workload')
+    parser.add_argument('--latency-queries', type=int, default=1000, help='queries run alone to measure latency')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--range-size', type=float, default=0.01, help='width and height of range windows')
+    parser.add_argument('--model-type', default='nn', choices=['nn', 'linear', 'pla', 'radix_spline'])
+    parser.add_argument('--model-path', default='model/benchmark/')
+    parser.add_argument('--max-num', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='result/benchmark', help='results are saved into OUTPUT.json/csv')
+    args = parser.parse_args(argv)
+    args.region = Region(*args.region)
+    return args
+
+
+def main(argv):
+    args = parse_args(argv)
+    data = load_data(args.data, args.x_col, args.y_col, args.num, args.region, args.seed)
+    workloads = create_workloads(data, args.queries, args.range_size, args.seed)
+    records = []
+    for name in args.indexes:
+        records.extend(benchmark_index(name, data, workloads, args))
+    save_results(records, args.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,20 +1,54 @@
 import numpy as np
 import pandas as pd
 
-from src.spatial_index.common_utils import Region, ZOrder
+from src.spatial_index.common_utils import Region, ZOrder, memory_usage_of
 from src.spatial_index.quad_tree import QuadTree
 
+PAGE_SIZE = 8192  # 和PostgreSQL一样，page file的每个page为8KiB
+PAGE_MAGIC = b'BRIN'
+META_DTYPE = np.dtype([('magic', 'S4'), ('version', '<i4'), ('page_size', '<i4'), ('pages_per_range', '<i8'),
+                       ('revmap_page_maxitems', '<i4'), ('regular_page_maxitems', '<i4'), ('block_size', '<i8'),
+                       ('key_num', '<i8'), ('range_num', '<i8'), ('revmap_page_num', '<i8'),
+                       ('regular_page_num', '<i8'), ('blknum_size', '<i4'), ('ranges_sorted', '<i4')])
+REVMAP_ITEM_DTYPE = np.dtype([('regular_page', '<i4'), ('item', '<i4')])
+
+
+def regular_item_dtype(blknum_size):
+    # blknum_size = 0: blknum为int64的block number，否则为定长bytes的geohash
+    return np.dtype([('blknum', '<i8' if blknum_size == 0 else 'S%d' % blknum_size),
+                     ('min_value', '<f8'), ('max_value', '<f8')])
+
+
+def page_dtype(item_dtype, page_size):
+    """
+    dtype of fixed-size page: id, item_num and items, padded to page_size
+    :return: dtype, max item nums of page
+    """
+    capacity = (page_size - 8) // item_dtype.itemsize
+    return np.dtype({'names': ['id', 'item_num', 'items'],
+                     'formats': ['<i4', '<i4', (item_dtype, capacity)],
+                     'offsets': [0, 4, 8],
+                     'itemsize': page_size}), capacity
+
 
 class BRIN:
     def __init__(self, version, pages_per_range, revmap_page_maxitems, regular_page_maxitems,
-                 meta_page=None, revmap_pages=None, regular_pages=None):
+                 meta_page=None, revmap_pages=None, regular_pages=None, block_size=100, key_num=0):
         self.version = version
         self.pages_per_range = pages_per_range
+        self.block_size = block_size  # build时每个block的key数量
+        self.key_num = key_num  # 已summarize的key数量，之后append的key由summarize_new_values增量summarize
         self.revmap_page_maxitems = revmap_page_maxitems
         self.regular_page_maxitems = regular_page_maxitems
         self.meta_page = meta_page
         self.revmap_pages = revmap_pages if revmap_pages is not None else []
         self.regular_pages = regular_pages if regular_pages is not None else []
+        # regular pages的所有range按min value排序后展开的数组，point_query时二分查找
+        self.min_values = None
+        self.max_values = None
+        self.blknums = None
+        self.max_sorted = True  # range之间不重叠时max value也有序，range_query可以二分
+        self.flatten_pages()
 
     @staticmethod
     def init_by_dict(d: dict):
@@ -24,38 +58,207 @@ class BRIN:
                     regular_page_maxitems=d['regular_page_maxitems'],
                     meta_page=d['meta_page'],
                     revmap_pages=d['revmap_pages'],
-                    regular_pages=d['regular_pages'])
+                    regular_pages=d['regular_pages'],
+                    block_size=d.get('block_size', 100),
+                    key_num=d.get('key_num', 0))
+
+    def to_dict(self):
+        # 展开的数组由regular pages重建，不保存
+        return {'version': self.version,
+                'pages_per_range': self.pages_per_range,
+                'revmap_page_maxitems': self.revmap_page_maxitems,
+                'regular_page_maxitems': self.regular_page_maxitems,
+                'meta_page': self.meta_page,
+                'revmap_pages': self.revmap_pages,
+                'regular_pages': self.regular_pages,
+                'block_size': self.block_size,
+                'key_num': self.key_num}
+
+    def flatten_pages(self):
+        """
+        flatten the ranges of regular pages into min_values, max_values and blknums sorted by min value
+        :return: None
+        """
+        values = [value for regular_page in self.regular_pages for value in regular_page.values]
+        blknums = [blknum for regular_page in self.regular_pages for blknum in regular_page.blknums]
+        values = np.array(values, dtype=np.float64).reshape(-1, 2)
+        order = np.argsort(values[:, 0], kind='stable')
+        self.min_values = np.ascontiguousarray(values[order, 0])
+        self.max_values = np.ascontiguousarray(values[order, 1])
+        self.max_sorted = bool(np.all(np.diff(self.max_values) >= 0))
+        # build的blknums是block number，build_by_quad_tree的是geohash
+        if all(isinstance(blknum, int) for blknum in blknums):
+            self.blknums = np.array(blknums, dtype=np.int64).reshape(-1)[order]
+        else:
+            self.blknums = np.empty(len(blknums), dtype=object)
+            self.blknums[:] = blknums
+            self.blknums = self.blknums[order]
 
-    def build(self):
-        return None
+    def build(self, keys):
+        """
+        summarize keys into block ranges, every range has pages_per_range blocks and every block has block_size keys
+        the blknum of range is its first block number, keys[blknum * block_size] is its first key
+        :param keys: np.array or path of npy file (heap file), ranges overlap if keys are not sorted
+        :return: None
+        """
+        if self.pages_per_range is None:
+            raise ValueError("pages_per_range is required to build brin by keys")
+        if isinstance(keys, str):
+            keys = np.load(keys, mmap_mode='r')
+        self.meta_page = MetaPage(version=self.version, pages_per_range=self.pages_per_range, last_revmap_page=0)
+        self.revmap_pages = []
+        self.regular_pages = []
+        self.key_num = 0
+        self.flatten_pages()
+        self.summarize_new_values(keys)
+
+    def summarize_new_values(self, keys):
+        """
+        summarize the keys appended after the last build or summarize, like brin_summarize_new_values of PostgreSQL
+        1. widen the last range in place if it is not full, by the new keys in it
+        2. summarize the other new keys into new ranges and append them into regular pages and revmap pages
+        only keys[key_num:] are read, so the cost is proportional to the new keys
+        :param keys: np.array or path of npy file (heap file), all the keys including the summarized ones
+        :return: int, number of new keys
+        """
+        if self.pages_per_range is None:
+            raise ValueError("pages_per_range is required to summarize brin by keys")
+        if isinstance(keys, str):
+            keys = np.load(keys, mmap_mode='r')
+        range_size = self.block_size * self.pages_per_range
+        start = self.key_num
+        end = len(keys)
+        if end <= start:
+            return 0
+        # 1. widen the last range in place
+        if start % range_size:
+            range_end = min(start - start % range_size + range_size, end)
+            self.widen_last_range(float(np.min(keys[start:range_end])), float(np.max(keys[start:range_end])))
+            start = range_end
+        # 2. summarize the other new keys into new ranges
+        starts = np.arange(start, end, range_size)
+        if len(starts):
+            new_keys = keys[start:end]
+            values = np.stack([np.minimum.reduceat(new_keys, starts - start),
+                               np.maximum.reduceat(new_keys, starts - start)], axis=1)
+            self.append_ranges((starts // self.block_size).tolist(), values.tolist())
+        new_num = end - self.key_num
+        self.key_num = end
+        return new_num
+
+    def widen_last_range(self, min_value, max_value):
+        """
+        widen [min value, max value] of the last range by the new keys in it, in regular page and flattened arrays
+        """
+        regular_page = self.regular_pages[-1]
+        value = regular_page.values[-1]
+        value = [min(value[0], min_value), max(value[1], max_value)]
+        regular_page.values[-1] = value
+        i = np.flatnonzero(self.blknums == regular_page.blknums[-1])[0]
+        self.min_values[i], self.max_values[i] = value
+        # min value变小后可能不再有序，重新展开
+        if (i > 0 and self.min_values[i] < self.min_values[i - 1]) or \
+                (i < len(self.max_values) - 1 and self.max_values[i] > self.max_values[i + 1]):
+            self.flatten_pages()
 
-    def point_query(self, data: pd.DataFrame):
+    def point_query(self, data: pd.Series):
         """
         query index by x point
         1. get the value in regular_pages.values which contains x
         2. get the geohash of leaf model from blknums by value
-        :param data: pd.DataFrame, [x]
-        :return: pd.DataFrame, [geohash of leaf_model]
+        :param data: pd.Series or np.array, [x]
+        :return: pd.Series, [geohash of leaf_model], in the order of data, None if not in any range
         """
-        data = data.sort_values(ascending=True)
-        data_length = len(data)
-        tmp_index = 0
-        result = [None] * data_length
+        ranges = self.point_query_batch(np.asarray(data, dtype=np.float64))
+        result = np.full(len(ranges), None, dtype=object)
+        result[ranges >= 0] = self.blknums[ranges[ranges >= 0]]
+        return pd.Series(result, dtype=object)
+
+    def range_query(self, z_lo, z_hi):
+        """
+        search the ranges overlapping [z_lo, z_hi]
+        1. the ranges whose min value <= z_hi are before the upper bound of z_hi in min_values
+        2. the ranges whose max value >= z_lo are after the lower bound of z_lo in max_values if max_values is sorted,
+           otherwise filter them one by one
+        :param z_lo: float
+        :param z_hi: float
+        :return: np.array of blknums, sorted by min value
+        """
+        # 1. the ranges whose min value <= z_hi
+        end = np.searchsorted(self.min_values, z_hi, side='right')
+        # 2. the ranges whose max value >= z_lo
+        if self.max_sorted:
+            start = min(np.searchsorted(self.max_values, z_lo, side='left'), end)
+            return self.blknums[start:end]
+        return self.blknums[:end][self.max_values[:end] >= z_lo]
+
+    def point_query_batch(self, values):
+        """
+        search the ranges containing values by binary search on min_values, the ranges should not overlap,
+        use range_query(value, value) for the overlapped ranges of unsorted keys
+        :param values: np.array
+        :return: np.array of int, index of range in min_values/max_values/blknums, -1 if not in any range
+        """
+        ranges = np.searchsorted(self.min_values, values, side='right') - 1
+        found = (ranges >= 0) & (values <= self.max_values[np.maximum(ranges, 0)])
+        return np.where(found, ranges, -1)
+
+    def memory_usage(self):
+        """
+        bytes of every component, tree_nodes: meta page, revmap pages and regular pages
+        :return: dict, component name -> bytes, and total bytes
+        """
+        return memory_usage_of({'tree_nodes': [self.meta_page, self.revmap_pages, self.regular_pages,
+                                               self.min_values, self.max_values, self.blknums]})
+
+    def save_pages(self, path, page_size=PAGE_SIZE):
+        """
+        save brin into a page file of fixed-size pages, which is opened by PagedBRIN through mmap
+        page 0: meta page, then revmap_page_num revmap pages, then regular_page_num regular pages
+        revmap item: [regular page, item of regular page], regular item: [blknum, min value, max value]
+        range i is the item i % revmap_page_maxitems of revmap page i // revmap_page_maxitems
+        revmap_page_maxitems and regular_page_maxitems are limited to the items which fit in a page
+        :param path: file path
+        :param page_size: bytes of page
+        :return: None
+        """
+        blknum_size = 0 if self.blknums.dtype == np.int64 else max([len(blknum) for blknum in self.blknums] + [1])
+        item_dtype = regular_item_dtype(blknum_size)
+        revmap_dtype, revmap_capacity = page_dtype(REVMAP_ITEM_DTYPE, page_size)
+        regular_dtype, regular_capacity = page_dtype(item_dtype, page_size)
+        revmap_page_maxitems = min(self.revmap_page_maxitems, revmap_capacity)
+        regular_page_maxitems = min(self.regular_page_maxitems, regular_capacity)
+        # 1. regular items in range id order by revmap
+        regular_items = {}
         for regular_page in self.regular_pages:
-            for i in range(len(regular_page.itemoffsets)):
-                value = regular_page.values[i]
-                while tmp_index < data_length:
-                    data_value = data.iloc[tmp_index]
-                    data_index = data.index[tmp_index]
-                    if data_value >= value[0]:
-                        if data_value <= value[1]:
-                            result[data_index] = regular_page.blknums[i]
-                        else:
-                            break
-                    else:
-                        result[data_index] = None
-                    tmp_index += 1
-        return pd.Series(result)
+            for itemoffset, blknum, value in zip(regular_page.itemoffsets, regular_page.blknums, regular_page.values):
+                regular_items[itemoffset] = (blknum, value[0], value[1])
+        items = np.array([regular_items[item["regular_page_item"]]
+                          for revmap_page in self.revmap_pages for item in revmap_page.pages], dtype=item_dtype)
+        range_ids = np.arange(len(items))
+        # 2. pack items into regular pages and revmap pages
+        regular_pages = np.zeros(-(-len(items) // regular_page_maxitems), dtype=regular_dtype)
+        regular_pages['id'] = np.arange(len(regular_pages))
+        regular_pages['item_num'] = np.bincount(range_ids // regular_page_maxitems, minlength=len(regular_pages))
+        regular_pages['items'][range_ids // regular_page_maxitems, range_ids % regular_page_maxitems] = items
+        revmap_pages = np.zeros(-(-len(items) // revmap_page_maxitems), dtype=revmap_dtype)
+        revmap_pages['id'] = np.arange(len(revmap_pages))
+        revmap_pages['item_num'] = np.bincount(range_ids // revmap_page_maxitems, minlength=len(revmap_pages))
+        revmap_pages['items']['regular_page'][range_ids // revmap_page_maxitems, range_ids % revmap_page_maxitems] = \
+            range_ids // regular_page_maxitems
+        revmap_pages['items']['item'][range_ids // revmap_page_maxitems, range_ids % revmap_page_maxitems] = \
+            range_ids % regular_page_maxitems
+        # 3. meta page, range id顺序下min value和max value都有序时，PagedBRIN按range id二分查找
+        ranges_sorted = bool(np.all(np.diff(items['min_value']) >= 0) and np.all(np.diff(items['max_value']) >= 0))
+        meta_page = np.zeros(1, dtype=META_DTYPE)
+        meta_page[0] = (PAGE_MAGIC, self.version, page_size,
+                        -1 if self.pages_per_range is None else self.pages_per_range,
+                        revmap_page_maxitems, regular_page_maxitems, self.block_size, self.key_num,
+                        len(items), len(revmap_pages), len(regular_pages), blknum_size, ranges_sorted)
+        with open(path, 'wb') as f:
+            f.write(meta_page.tobytes().ljust(page_size, b'\0'))
+            f.write(revmap_pages.tobytes())
+            f.write(regular_pages.tobytes())
 
     def build_by_quad_tree(self, quad_tree):
         """
@@ -71,36 +274,219 @@ class BRIN:
             blknum = geohash_key
             z_border_list.append(z_border)
             blknum_list.append(blknum)
-        index_len = len(split_data)
-        page_len = int(index_len / self.regular_page_maxitems)
-        revmap_page_list = []
-        for i in range(page_len + 1):
-            left_index = i * self.regular_page_maxitems
-            right_index = (i + 1) * self.regular_page_maxitems
-            if right_index > index_len:
-                right_index = index_len
-            if left_index > index_len:
-                break
-            revmap_page_list.extend(
-                [{"regular_page_id": i, "regular_page_item": j} for j in range(left_index, right_index)])
-            self.regular_pages.append(RegularPage(id=i,
-                                                  itemoffsets=list(range(left_index, right_index)),
-                                                  blknums=blknum_list[left_index: right_index],
-                                                  values=z_border_list[left_index: right_index]))
-        revmap_page_len = len(revmap_page_list)
-        page_len = int(revmap_page_len / self.revmap_page_maxitems)
-        for i in range(page_len + 1):
-            left_index = i * self.revmap_page_maxitems
-            right_index = (i + 1) * self.revmap_page_maxitems
-            if right_index > index_len:
-                right_index = index_len
-            if left_index > index_len:
-                break
-            self.revmap_pages.append(RevMapPage(id=i,
-                                                pages=revmap_page_list[left_index: right_index]))
+        self.append_ranges(blknum_list, z_border_list)
+
+    def append_ranges(self, blknums, values):
+        """
+        append block ranges into regular pages and revmap pages, the last pages are filled before creating new ones
+        :param blknums: list, first block number (or geohash) of ranges
+        :param values: list of [min value, max value] of ranges
+        :return: None
+        """
+        item = sum(len(regular_page.itemoffsets) for regular_page in self.regular_pages)
+        old_num = item
+        offset = 0
+        while offset < len(blknums):
+            if len(self.regular_pages) == 0 or \
+                    len(self.regular_pages[-1].itemoffsets) >= self.regular_page_maxitems:
+                self.regular_pages.append(RegularPage(id=len(self.regular_pages),
+                                                      itemoffsets=[], blknums=[], values=[]))
+            regular_page = self.regular_pages[-1]
+            size = min(self.regular_page_maxitems - len(regular_page.itemoffsets), len(blknums) - offset)
+            regular_page.itemoffsets.extend(range(item, item + size))
+            regular_page.blknums.extend(blknums[offset: offset + size])
+            regular_page.values.extend(values[offset: offset + size])
+            self.append_revmap_items([{"regular_page_id": regular_page.id, "regular_page_item": j}
+                                      for j in range(item, item + size)])
+            item += size
+            offset += size
         self.meta_page = MetaPage(version=self.version,
                                   pages_per_range=self.pages_per_range,
                                   last_revmap_page=len(self.revmap_pages))
+        self.append_flattened(old_num, blknums, values)
+
+    def append_flattened(self, old_num, blknums, values):
+        """
+        append the new ranges into the flattened arrays, flatten all the pages if they are not after the old ranges
+        """
+        values = np.array(values, dtype=np.float64).reshape(-1, 2)
+        if self.min_values is None or len(self.min_values) != old_num or len(values) == 0 or \
+                np.any(np.diff(values[:, 0]) < 0) or (old_num and values[0, 0] < self.min_values[-1]) or \
+                not all(isinstance(blknum, int) for blknum in blknums) or self.blknums.dtype != np.int64:
+            self.flatten_pages()
+            return
+        self.min_values = np.concatenate([self.min_values, values[:, 0]])
+        self.max_values = np.concatenate([self.max_values, values[:, 1]])
+        self.blknums = np.concatenate([self.blknums, np.array(blknums, dtype=np.int64)])
+        self.max_sorted = self.max_sorted and bool(np.all(np.diff(self.max_values[max(old_num - 1, 0):]) >= 0))
+
+    def append_revmap_items(self, items):
+        offset = 0
+        while offset < len(items):
+            if len(self.revmap_pages) == 0 or len(self.revmap_pages[-1].pages) >= self.revmap_page_maxitems:
+                self.revmap_pages.append(RevMapPage(id=len(self.revmap_pages), pages=[]))
+            revmap_page = self.revmap_pages[-1]
+            size = min(self.revmap_page_maxitems - len(revmap_page.pages), len(items) - offset)
+            revmap_page.pages.extend(items[offset: offset + size])
+            offset += size
+
+
+class PagedBRIN:
+    def __init__(self, path):
+        """
+        read-only brin on the page file created by BRIN.save_pages
+        only the meta page is read when opening, revmap pages and regular pages are read through mmap when used,
+        so a lookup of range touches one revmap page and one regular page
+        :param path: page file
+        """
+        meta_page = np.fromfile(path, dtype=META_DTYPE, count=1)
+        if len(meta_page) == 0 or meta_page[0]['magic'] != PAGE_MAGIC:
+            raise ValueError("not a brin page file: %s" % path)
+        meta_page = meta_page[0]
+        self.path = path
+        self.version = int(meta_page['version'])
+        self.page_size = int(meta_page['page_size'])
+        self.pages_per_range = None if meta_page['pages_per_range'] < 0 else int(meta_page['pages_per_range'])
+        self.revmap_page_maxitems = int(meta_page['revmap_page_maxitems'])
+        self.regular_page_maxitems = int(meta_page['regular_page_maxitems'])
+        self.block_size = int(meta_page['block_size'])
+        self.key_num = int(meta_page['key_num'])
+        self.range_num = int(meta_page['range_num'])
+        self.blknum_size = int(meta_page['blknum_size'])
+        self.ranges_sorted = bool(meta_page['ranges_sorted'])
+        revmap_page_num = int(meta_page['revmap_page_num'])
+        regular_page_num = int(meta_page['regular_page_num'])
+        revmap_dtype, _ = page_dtype(REVMAP_ITEM_DTYPE, self.page_size)
+        regular_dtype, _ = page_dtype(regular_item_dtype(self.blknum_size), self.page_size)
+        self.revmap_pages = self.map_pages(revmap_dtype, 1, revmap_page_num)
+        self.regular_pages = self.map_pages(regular_dtype, 1 + revmap_page_num, regular_page_num)
+
+    def map_pages(self, dtype, first_page, page_num):
+        if page_num == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=first_page * self.page_size, shape=(page_num,))
+
+    def close(self):
+        self.revmap_pages = None
+        self.regular_pages = None
+
+    def get_items(self, range_ids):
+        """
+        get the regular items of ranges by revmap
+        1. revmap item of range i: item i % revmap_page_maxitems of revmap page i // revmap_page_maxitems
+        2. regular item: item of regular page in revmap item
+        :param range_ids: np.array of int
+        :return: np.array of regular item dtype, [blknum, min_value, max_value]
+        """
+        range_ids = np.asarray(range_ids, dtype=np.int64)
+        revmap_items = self.revmap_pages['items'][range_ids // self.revmap_page_maxitems,
+                                                  range_ids % self.revmap_page_maxitems]
+        return self.regular_pages['items'][revmap_items['regular_page'], revmap_items['item']]
+
+    def decode_blknums(self, blknums):
+        if self.blknum_size == 0:
+            return np.asarray(blknums, dtype=np.int64)
+        return np.char.decode(blknums, 'ascii').astype(object)
+
+    def lookup(self, blknums):
+        """
+        get the ranges of heap blocks in O(1) pages, range of block is blknum // pages_per_range
+        :param blknums: np.array of int, block numbers
+        :return: np.array of the first block numbers, min values and max values of ranges
+        """
+        if self.pages_per_range is None:
+            raise ValueError("ranges of brin built by quad tree are not block ranges")
+        range_ids = np.asarray(blknums, dtype=np.int64) // self.pages_per_range
+        if len(range_ids) and (range_ids.min() < 0 or range_ids.max() >= self.range_num):
+            raise ValueError("block number out of the %d summarized ranges" % self.range_num)
+        items = self.get_items(range_ids)
+        return self.decode_blknums(items['blknum']), items['min_value'], items['max_value']
+
+    def search_ranges(self, field, values, side):
+        """
+        binary search values on field of ranges in range id order, every round reads the middle ranges by get_items
+        :return: np.array of int, same as np.searchsorted
+        """
+        values = np.asarray(values, dtype=np.float64)
+        lo = np.zeros(len(values), dtype=np.int64)
+        hi = np.full(len(values), self.range_num, dtype=np.int64)
+        active = np.flatnonzero(lo < hi)
+        while len(active):
+            mid = (lo[active] + hi[active]) // 2
+            mid_values = self.get_items(mid)[field]
+            right = mid_values <= values[active] if side == 'right' else mid_values < values[active]
+            lo[active] = np.where(right, mid + 1, lo[active])
+            hi[active] = np.where(right, hi[active], mid)
+            active = active[lo[active] < hi[active]]
+        return lo
+
+    def point_query_batch(self, values):
+        """
+        search the ranges containing values, same as BRIN.point_query_batch
+        binary search in range id order if the ranges are sorted, otherwise read all the ranges
+        :param values: np.array
+        :return: np.array of int, range id, -1 if not in any range
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if self.range_num == 0:
+            return np.full(len(values), -1, dtype=np.int64)
+        if self.ranges_sorted:
+            ranges = self.search_ranges('min_value', values, 'right') - 1
+            found = (ranges >= 0) & (values <= self.get_items(np.maximum(ranges, 0))['max_value'])
+            return np.where(found, ranges, -1)
+        items = self.get_items(np.arange(self.range_num))
+        order = np.argsort(items['min_value'], kind='stable')
+        ranges = np.maximum(np.searchsorted(items['min_value'][order], values, side='right') - 1, 0)
+        found = (items['min_value'][order][ranges] <= values) & (values <= items['max_value'][order][ranges])
+        return np.where(found, order[ranges], -1)
+
+    def point_query(self, data: pd.Series):
+        """
+        same as BRIN.point_query
+        :param data: pd.Series or np.array, [x]
+        :return: pd.Series, [blknum], in the order of data, None if not in any range
+        """
+        ranges = self.point_query_batch(np.asarray(data, dtype=np.float64))
+        result = np.full(len(ranges), None, dtype=object)
+        result[ranges >= 0] = self.decode_blknums(self.get_items(ranges[ranges >= 0])['blknum'])
+        return pd.Series(result, dtype=object)
+
+    def range_query(self, z_lo, z_hi):
+        """
+        search the ranges overlapping [z_lo, z_hi], same as BRIN.range_query
+        the ranges are sliced by binary search if they are sorted, otherwise all of them are read and filtered
+        :return: np.array of blknums, in range id order
+        """
+        if self.ranges_sorted:
+            end = self.search_ranges('min_value', [z_hi], 'right')[0]
+            start = min(self.search_ranges('max_value', [z_lo], 'left')[0], end)
+            return self.decode_blknums(self.get_items(np.arange(start, end))['blknum'])
+        items = self.get_items(np.arange(self.range_num))
+        overlapped = (items['min_value'] <= z_hi) & (items['max_value'] >= z_lo)
+        return self.decode_blknums(items['blknum'][overlapped])
+
+    def to_brin(self):
+        """
+        read all the pages into BRIN, e.g. for summarize_new_values and save_pages again
+        """
+        items = self.get_items(np.arange(self.range_num))
+        brin = BRIN(version=self.version, pages_per_range=self.pages_per_range,
+                    revmap_page_maxitems=self.revmap_page_maxitems, regular_page_maxitems=self.regular_page_maxitems,
+                    block_size=self.block_size)
+        brin.append_ranges(self.decode_blknums(items['blknum']).tolist(),
+                           np.stack([items['min_value'], items['max_value']], axis=1).tolist())
+        brin.key_num = self.key_num
+        return brin
+
+    def memory_usage(self):
+        """
+        bytes of every component, pages are mapped but not resident, so only the meta page is counted
+        :return: dict, component name -> bytes, and total bytes
+        """
+        return memory_usage_of({'tree_nodes': [self.path, self.version, self.page_size, self.pages_per_range,
+                                               self.revmap_page_maxitems, self.regular_page_maxitems,
+                                               self.block_size, self.key_num, self.range_num, self.blknum_size,
+                                               self.ranges_sorted]})
 
 
 class MetaPage:
@@ -159,7 +545,7 @@ if __name__ == '__main__':
     z_col, index_col = 7, 8
     data = pd.read_csv(path, header=None, usecols=[2, 3], names=["x", "y"])
     z_order = ZOrder()
-    z_values = data.apply(lambda t: z_order.point_to_z(t.x, t.y, Region(40, 42, -75, -73)), 1)
+    z_values = z_order.point_to_z_batch(data.x.values, data.y.values, Region(40, 42, -75, -73))
     # z归一化
     data["z"] = z_values / z_order.max_z
     data.sort_values(by=["z"], ascending=True, inplace=True)
@@ -1,14 +1,16 @@
+import hashlib
+import json
 import logging
 import os.path
-import random
+import threading
 from functools import wraps
 
 import numpy as np
 import tensorflow as tf
-from matplotlib import pyplot as plt
 
-from src.spatial_index.common_utils import nparray_normalize, nparray_normalize_minmax, nparray_diff_normalize_reverse, \
-    nparray_normalize_reverse
+from src.spatial_index.common_utils import nparray_normalize, nparray_diff_normalize_reverse, nparray_normalize_reverse
+
+logger = logging.getLogger(__name__)
 
 
 # using cache
@@ -30,8 +32,12 @@ def memoize(func):
 
 # extract matrix for predicting position
 class AbstractNN:
-    def __init__(self, weights, core_nums, input_min, input_max, output_min, output_max, min_err, max_err):
-        self.weights = weights
+    def __init__(self, weights, core_nums, input_min, input_max, output_min, output_max, min_err, max_err,
+                 dtype='float64', scales=None):
+        # weights按dtype存储，int8量化的weights在predict时每层matmul之后乘以scale还原
+        self.dtype = dtype
+        self.scales = scales
+        self.weights = [np.ascontiguousarray(weight, dtype=dtype) for weight in weights]
         self.core_nums = core_nums
         self.input_min = input_min
         self.input_max = input_max
@@ -39,6 +45,12 @@ class AbstractNN:
         self.output_max = output_max
         self.min_err = min_err
         self.max_err = max_err
+        # 归一化参数和各层输出的buffer，随batch大小扩容；buffer按线程分开，查询和后台merge可以同时predict
+        if input_min is None or input_max is None or input_max == input_min:
+            self.input_offset, self.input_scale = 0.0, 1.0
+        else:
+            self.input_offset, self.input_scale = input_min, 1.0 / (input_max - input_min)
+        self.local = threading.local()
 
     @staticmethod
     def relu(x):
@@ -55,25 +67,222 @@ class AbstractNN:
     def sigmoid(x):
         return 1 / (1 + np.exp(-x))
 
+    @staticmethod
+    def sigmoid_inplace(x):
+        np.negative(x, out=x)
+        np.exp(x, out=x)
+        x += 1
+        np.reciprocal(x, out=x)
+        return x
+
+    def quantize(self, dtype, inputs, labels):
+        """
+        copy of model whose weights are quantized to dtype, the error bounds are recomputed on inputs and labels
+        float16: cast weights to float16
+        int8: weights of every layer are scaled into [-127, 127] by max(abs(weights)) / 127
+        :param dtype: float64/float16/int8
+        :param inputs: np.array, train keys of model
+        :param labels: np.array, train labels of model
+        :return: AbstractNN
+        """
+        weights = self.dequantize()
+        if dtype == 'float64' or dtype == 'float16':
+            scales = None
+        elif dtype == 'int8':
+            scales = [float(np.abs(weight).max()) / 127 if weight.size and np.abs(weight).max() > 0 else 1.0
+                      for weight in weights]
+            weights = [np.clip(np.round(weight / scale), -127, 127) for weight, scale in zip(weights, scales)]
+        else:
+            raise ValueError("unknown weight dtype: %s" % dtype)
+        model = AbstractNN(weights, self.core_nums, self.input_min, self.input_max, self.output_min, self.output_max,
+                           self.min_err, self.max_err, dtype, scales)
+        errs = model.predict(inputs) - np.asarray(labels, dtype=np.float64)
+        model.min_err, model.max_err = float(errs.min()), float(errs.max())
+        return model
+
+    def dequantize(self):
+        """
+        float64 weights, int8 weights are multiplied by their scales
+        """
+        if self.scales is None:
+            return [weight.astype(np.float64, copy=False) for weight in self.weights]
+        return [weight.astype(np.float64) * scale for weight, scale in zip(self.weights, self.scales)]
+
+    def get_buffers(self, size):
+        """
+        get buffers of every layer for size keys in the current thread, realloc only when size is larger than before
+        :param size: key nums
+        :return: list of np.array, buffers[i].shape = [size, core_nums[i]]
+        """
+        buffers = getattr(self.local, 'buffers', None)
+        if buffers is None or len(buffers[0]) < size:
+            buffers = [np.empty((size, core_num), dtype=np.float64) for core_num in self.core_nums]
+            self.local.buffers = buffers
+        return [buffer[:size] for buffer in buffers]
+
     # @memoize TODO: 要加缓存的话， 缓存的key不能是list，之前是float
     # TODO: 和model.predict有小偏差，怀疑是exp的e和elu的e不一致
-    def predict(self, input_keys):
-        input_keys = nparray_normalize_minmax(input_keys, self.input_min, self.input_max)
-        tmp_res = np.mat(input_keys).T
-        for i in range(len(self.core_nums) - 1):
-            # w * x + b
-            # sigmoid(x)
-            tmp_res = AbstractNN.sigmoid(tmp_res * np.mat(self.weights[i * 2]) + np.mat(self.weights[i * 2 + 1]))
-        # 值clip到最大最小值之间
-        tmp_res = np.asarray(tmp_res).flatten()
-        return nparray_normalize_reverse(tmp_res, self.output_min, self.output_max)
+    def predict(self, input_keys, out=None):
+        """
+        predict by weights in preallocated buffers
+        1. normalize keys by input_min and input_max
+        2. w * x + b and sigmoid(x) for every layer
+        3. clip to [0, 1] and reverse normalize by output_min and output_max
+        :param input_keys: float or np.array
+        :param out: np.array to write result, create a new one if None
+        :return: np.array
+        """
+        input_keys = np.asarray(input_keys, dtype=np.float64).reshape(-1)
+        buffers = self.get_buffers(len(input_keys))
+        # float16和int8的weights在matmul中直接转为float64计算，int8的scale在matmul之后乘，和StackedStage一致
+        weights = self.weights
+        # 1. normalize keys by input_min and input_max
+        tmp_res = buffers[0]
+        np.subtract(input_keys[:, np.newaxis], self.input_offset, out=tmp_res)
+        tmp_res *= self.input_scale
+        # 2. w * x + b and sigmoid(x) for every layer
+        with np.errstate(over='ignore'):
+            for i in range(len(self.core_nums) - 1):
+                np.matmul(tmp_res, weights[i * 2], out=buffers[i + 1])
+                tmp_res = buffers[i + 1]
+                if self.scales is None:
+                    tmp_res += weights[i * 2 + 1]
+                else:
+                    tmp_res *= self.scales[i * 2]
+                    tmp_res += weights[i * 2 + 1] * self.scales[i * 2 + 1]
+                AbstractNN.sigmoid_inplace(tmp_res)
+        # 3. 值clip到最大最小值之间
+        if out is None:
+            out = np.empty(len(input_keys), dtype=np.float64)
+        np.clip(tmp_res[:, 0], 0, 1, out=out)
+        if self.output_min is not None and self.output_max is not None:
+            out *= self.output_max - self.output_min
+            out += self.output_min
+        return out
+
+    def to_dict(self):
+        return {'weights': self.weights,
+                'core_nums': self.core_nums,
+                'input_min': self.input_min,
+                'input_max': self.input_max,
+                'output_min': self.output_min,
+                'output_max': self.output_max,
+                'min_err': self.min_err,
+                'max_err': self.max_err,
+                'dtype': self.dtype,
+                'scales': self.scales}
+
+    def shift(self, offset):
+        """
+        copy of model whose outputs are shifted by offset, used when keys are inserted before the keys of model
+        :param offset: float, in label units
+        :return: AbstractNN
+        """
+        if self.output_min is None or self.output_max is None:
+            output_min, output_max = offset, offset + 1.0
+        else:
+            output_min, output_max = self.output_min + offset, self.output_max + offset
+        return AbstractNN(self.weights, self.core_nums, self.input_min, self.input_max,
+                          output_min, output_max, self.min_err, self.max_err, self.dtype, self.scales)
 
     @staticmethod
     def init_by_dict(d: dict):
         return AbstractNN(d['weights'], d['core_nums'],
                           d['input_min'], d['input_max'],
                           d['output_min'], d['output_max'],
-                          d['min_err'], d['max_err'], )
+                          d['min_err'], d['max_err'],
+                          d.get('dtype', 'float64'), d.get('scales'))
+
+
+# content-addressed cache of trained models, replace the err in model file name
+class ModelCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "index.json")
+
+    @staticmethod
+    def get_key(train_x, train_y, core_nums, train_args: dict):
+        """
+        hash of train keys, labels relative to the first one, architecture and hyperparameters
+        labels of a leaf are shifted by the inserts and deletes before it, so the key is computed by relative labels,
+        and the cached model is shifted to the first label by get
+        :param train_x: np.array
+        :param train_y: np.array
+        :param core_nums: list of int
+        :param train_args: dict of hyperparameters, can be dumped by json
+        :return: str, sha256 hex digest
+        """
+        train_y = np.asarray(train_y, dtype=np.float64)
+        # label = position / block_size，相减的浮点误差会改变hash，先round
+        relative_y = np.round(train_y - train_y[0], 6) if len(train_y) else train_y
+        h = hashlib.sha256()
+        h.update(np.ascontiguousarray(train_x, dtype=np.float64).tobytes())
+        h.update(np.ascontiguousarray(relative_y, dtype=np.float64).tobytes())
+        h.update(json.dumps({'core_nums': core_nums, 'train_args': train_args}, sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def load_index(self):
+        if os.path.exists(self.index_path) is False:
+            return {}
+        with open(self.index_path, "r") as f:
+            return json.load(f)
+
+    def get(self, key, label_offset=0.0, index=None):
+        """
+        load model from cache
+        :param key: str
+        :param label_offset: float, the first label of train_y, the cached model is shifted to it
+        :param index: dict, index loaded by load_index, load it from file if None
+        :return: AbstractNN, None if not cached
+        """
+        entry = (self.load_index() if index is None else index).get(key)
+        weights_path = os.path.join(self.cache_dir, key + ".npz")
+        if entry is None or os.path.exists(weights_path) is False:
+            return None
+        with np.load(weights_path) as f:
+            weights = [f["weight_%d" % i] for i in range(entry["weight_num"])]
+        model = AbstractNN(weights, entry["core_nums"],
+                           entry["input_min"], entry["input_max"],
+                           entry["output_min"], entry["output_max"],
+                           entry["min_err"], entry["max_err"])
+        offset = label_offset - entry.get("label_offset", 0.0)
+        return model.shift(offset) if offset != 0 else model
+
+    def put(self, key, model, label_offset=0.0):
+        """
+        save model weights into key.npz and error bounds into index file
+        :param key: str
+        :param model: AbstractNN
+        :param label_offset: float, the first label of train_y
+        :return: None
+        """
+        self.put_all({key: (model, label_offset)})
+
+    def put_all(self, models):
+        """
+        save the weights of models into key.npz, and their error bounds into index file at once
+        :param models: dict of key -> (AbstractNN, label_offset)
+        :return: None
+        """
+        if len(models) == 0:
+            return
+        if os.path.exists(self.cache_dir) is False:
+            os.makedirs(self.cache_dir)
+        index = self.load_index()
+        for key, (model, label_offset) in models.items():
+            d = model.to_dict()
+            weights = d.pop("weights")
+            np.savez(os.path.join(self.cache_dir, key + ".npz"),
+                     **{"weight_%d" % i: weight for i, weight in enumerate(weights)})
+            entry = {k: v.item() if isinstance(v, np.generic) else v for k, v in d.items()}
+            entry["weight_num"] = len(weights)
+            entry["label_offset"] = float(label_offset)
+            index[key] = entry
+        # 先写临时文件再替换，中断时不会损坏index
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
 
 
 # Neural Network Model
@@ -88,25 +297,22 @@ class TrainedNN:
         self.learning_rate = learning_rate
         self.keep_ratio = keep_ratio
         self.train_x, self.train_x_min, self.train_x_max = nparray_normalize(train_x)
-        self.clean_not_best_model_file(model_path)
         self.train_y, self.train_y_min, self.train_y_max = nparray_normalize(train_y)
-        self.model_path = self.get_best_model_file(model_path)
+        self.model_path = model_path  # checkpoint of training, deleted after train
         self.use_threshold = use_threshold
         self.threshold = threshold
         self.model = None
+        self.best_weights = None
         self.min_err, self.max_err = 0, 0
         self.retrain_times = 0
         self.retrain_time_limit = retrain_time_limit
+        self.epochs = 0  # 所有retrain的epoch总数
 
     # train model
     def train(self):
         model_dir = os.path.join(os.path.dirname(self.model_path))
         if os.path.exists(model_dir) is False:
             os.makedirs(model_dir)
-        logging.basicConfig(filename=os.path.join(model_dir, "log.file"),
-                            level=logging.INFO,
-                            format="%(asctime)s - %(levelname)s - %(message)s",
-                            datefmt="%m/%d/%Y %H:%M:%S %p")
         # GPU配置
         os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
         os.environ["CUDA_VISIBLE_DEVICES"] = "0"
@@ -123,40 +329,55 @@ class TrainedNN:
             #     gpu,
             #     [tf.config.experimental.VirtualDeviceConfiguration(memory_limit=2048)]
             # )
-        # create or load model
-        if self.is_model_file_valid():  # valid the model file exists and is in hdf5 format
-            self.model = tf.keras.models.load_model(self.model_path, custom_objects={'score': self.score})
-            # do not train exists model when err is enough
-            if self.use_threshold:
-                self.min_err, self.max_err = self.get_err()
-                err_length = self.max_err - self.min_err
-                if err_length <= self.threshold:
-                    print("Do not train when model exists and prefect: Model %s, Err %f, Threshold %f" % (
-                        self.model_path, err_length, self.threshold))
-                    logging.info("Do not train when model exists and prefect: Model %s, Err %f, Threshold %f" % (
-                        self.model_path, err_length, self.threshold))
-                    self.model_path = self.rename_model_file_by_err(self.model_path, err_length)
-                    return
-        else:
-            # delete model when model file is not in hdf5 format but exists, maybe destroyed by interrupt
-            if os.path.exists(self.model_path):
-                os.remove(self.model_path)
-            model = tf.keras.Sequential()
-            for i in range(len(self.core_nums) - 2):
-                model.add(tf.keras.layers.Dense(units=self.core_nums[i + 1],
-                                                input_dim=self.core_nums[i],
-                                                activation='sigmoid'))
-                # drop_rate = 1 - self.keep_ratio
-                # if drop_rate > 0:
-                #     model.add(tf.keras.layers.Dropout(rate=drop_rate))  # dropout防止过拟合
-                # model.add(tf.keras.layers.BatchNormalization())  #bn可以杜绝梯度消失，但是训练的慢，而且predict我没实现。。。
-            model.add(tf.keras.layers.Dense(units=self.core_nums[-1],
+        # 每次retrain都重新创建model，内存中保留err最小的weights
+        while True:
+            self.model = self.create_model()
+            self.fit()
+            min_err, max_err = self.get_err()
+            err_length = max_err - min_err
+            if self.best_weights is None or err_length < self.max_err - self.min_err:
+                self.best_weights = self.model.get_weights()
+                self.min_err, self.max_err = min_err, max_err
+            if self.use_threshold is False:
+                logger.info("Stop train when score stop decreasing: Model %s, Err %f, Threshold %f" % (
+                    self.model_path, err_length, self.threshold))
+                break
+            if err_length <= self.threshold:
+                logger.info("Model perfect: Model %s, Err %f, Threshold %f" % (
+                    self.model_path, err_length, self.threshold))
+                break
+            if self.retrain_times >= self.retrain_time_limit:
+                logger.info("Retrain time limit: Model %s, Err %f, Threshold %f" % (
+                    self.model_path, err_length, self.threshold))
+                break
+            self.retrain_times += 1
+            logger.info("Retrain %d when score not perfect: Model %s, Err %f, Threshold %f" % (
+                self.retrain_times, self.model_path, err_length, self.threshold))
+        self.model.set_weights(self.best_weights)
+        if os.path.exists(self.model_path):
+            os.remove(self.model_path)
+
+    def create_model(self):
+        model = tf.keras.Sequential()
+        for i in range(len(self.core_nums) - 2):
+            model.add(tf.keras.layers.Dense(units=self.core_nums[i + 1],
+                                            input_dim=self.core_nums[i],
                                             activation='sigmoid'))
-            optimizer = tf.keras.optimizers.Adam(learning_rate=self.learning_rate)
+            # drop_rate = 1 - self.keep_ratio
+            # if drop_rate > 0:
+            #     model.add(tf.keras.layers.Dropout(rate=drop_rate))  # dropout防止过拟合
+            # model.add(tf.keras.layers.BatchNormalization())  #bn可以杜绝梯度消失，但是训练的慢，而且predict我没实现。。。
+        model.add(tf.keras.layers.Dense(units=self.core_nums[-1],
+                                        activation='sigmoid'))
+        optimizer = tf.keras.optimizers.Adam(learning_rate=self.learning_rate)
+        model.compile(optimizer=optimizer, loss=self.score)
+        return model
 
-            model.compile(optimizer=optimizer, loss=self.score)
-            self.model = model
-        # self.model.summary()
+    def fit(self):
+        """
+        fit model and load the min loss checkpoint
+        :return: None
+        """
         # checkpoint
         checkpoint = tf.keras.callbacks.ModelCheckpoint(self.model_path,
                                                         monitor='loss',
@@ -182,48 +403,8 @@ class TrainedNN:
                                  batch_size=self.batch_size,
                                  verbose=0,
                                  callbacks=callbacks_list)
+        self.epochs += len(history.history['loss'])
         self.model = tf.keras.models.load_model(self.model_path, custom_objects={'score': self.score})
-        self.min_err, self.max_err = self.get_err()
-        err_length = self.max_err - self.min_err
-        self.model_path = self.rename_model_file_by_err(self.model_path, err_length)
-        if self.use_threshold:
-            if err_length > self.threshold:
-                if self.retrain_times < self.retrain_time_limit:
-                    self.model_path = self.init_model_name_by_random(self.model_path)
-                    self.retrain_times += 1
-                    print("Retrain %d when score not perfect: Model %s, Err %f, Threshold %f" % (
-                        self.retrain_times, self.model_path, err_length, self.threshold))
-                    logging.info("Retrain %d when score not perfect: Model %s, Err %f, Threshold %f" % (
-                        self.retrain_times, self.model_path, err_length, self.threshold))
-                    self.train()
-                else:
-                    print("Retrain time limit: Model %s, Err %f, Threshold %f" % (
-                        self.model_path, err_length, self.threshold))
-                    logging.info("Retrain time limit: Model %s, Err %f, Threshold %f" % (
-                        self.model_path, err_length, self.threshold))
-                    self.model_path = self.get_best_model_file(self.model_path)
-                    self.model = tf.keras.models.load_model(self.model_path, custom_objects={'score': self.score})
-                    self.min_err, self.max_err = self.get_err()
-                    return
-            else:
-                print("Model perfect: Model %s, Err %f, Threshold %f" % (
-                    self.model_path, err_length, self.threshold))
-                logging.info("Model perfect: Model %s, Err %f, Threshold %f" % (
-                    self.model_path, err_length, self.threshold))
-        else:
-            print("Stop train when score stop decreasing: Model %s, Err %f, Threshold %f" % (
-                self.model_path, err_length, self.threshold))
-            logging.info("Stop train when score stop decreasing: Model %s, Err %f, Threshold %f" % (
-                self.model_path, err_length, self.threshold))
-
-    def is_model_file_valid(self):
-        try:
-            model = tf.keras.models.load_model(self.model_path, custom_objects={'score': self.score})
-            return True
-        except Exception:
-            # {ValueError}No model config found in the file
-            # {OSError}SavedModel file does not exist
-            return False
 
     def get_weights(self):
         return self.model.get_weights()
@@ -247,6 +428,7 @@ class TrainedNN:
         return nparray_normalize_reverse(pres, self.train_y_min, self.train_y_max)
 
     def plot(self):
+        from matplotlib import pyplot as plt
         pres = self.model.predict(self.train_x).flatten()
         plt.plot(self.train_x, self.train_y, 'y--', label="true")
         plt.plot(self.train_x, pres, 'm--', label="predict")
@@ -258,97 +440,3 @@ class TrainedNN:
         plt.legend()
         plt.savefig(png_path)
         plt.close()
-
-    @staticmethod
-    def get_best_model_file(model_path):
-        """
-        find the min err model path
-        :return: perfect model path
-        """
-        file_path, file_name = os.path.split(model_path)
-        tmp_split = file_name.split('.')
-        model_index = tmp_split[0]
-        suffix = tmp_split[-1]
-        min_err = 'best'
-        if os.path.exists(file_path) is False:
-            return model_path
-        files = os.listdir(file_path)
-        for file in files:
-            tmp_split = file.split('.')
-            tmp_model_index = tmp_split[0]
-            if tmp_model_index == model_index:
-                tmp_err = '.'.join(tmp_split[1:-1])
-                try:
-                    tmp_err = float(tmp_err)
-                except:
-                    continue
-                if (min_err == 'best' or min_err > tmp_err) and tmp_err >= 0:
-                    min_err = tmp_err
-        best_file_name = '.'.join([model_index, str(min_err), suffix])
-        return os.path.join(file_path, best_file_name)
-
-    @staticmethod
-    def rename_model_file_by_err(model_path, err):
-        """
-        rename model file by err
-        :param model_path: old path
-        :param err: float
-        :return: new path
-        """
-        file_path, file_name = os.path.split(model_path)
-        tmp_split = file_name.split('.')
-        model_index = tmp_split[0]
-        suffix = tmp_split[-1]
-        new_file_name = '.'.join([model_index, str(err), suffix])
-        try:
-            new_model_path = os.path.join(file_path, new_file_name)
-            os.rename(model_path, new_model_path)
-            return new_model_path
-        except FileExistsError:  # 相同误差的model不再重复保存
-            os.remove(model_path)
-            return model_path
-
-    @staticmethod
-    def init_model_name_by_random(model_path):
-        """
-        init model name by random float num
-        :param model_path: old path
-        :return: new path
-        """
-        file_path, file_name = os.path.split(model_path)
-        tmp_split = file_name.split('.')
-        model_index = tmp_split[0]
-        suffix = tmp_split[-1]
-        new_file_name = '.'.join([model_index, str(random.random() * -1), suffix])
-        return os.path.join(file_path, new_file_name)
-
-    @staticmethod
-    def clean_not_best_model_file(model_path):
-        """
-        delete all the model file besides the best one
-        :return: None
-        """
-        file_path, file_name = os.path.split(model_path)
-        tmp_split = file_name.split('.')
-        model_index = tmp_split[0]
-        suffix = tmp_split[-1]
-        min_err = 'best'
-        if os.path.exists(file_path) is False:
-            return
-        files = os.listdir(file_path)
-        for file in files:
-            tmp_split = file.split('.')
-            tmp_model_index = tmp_split[0]
-            if tmp_model_index == model_index:
-                tmp_err = '.'.join(tmp_split[1:-1])
-                try:
-                    tmp_err = float(tmp_err)
-                except:
-                    continue
-                if (min_err == 'best' or min_err > tmp_err) and tmp_err >= 0:
-                    last_min_file_name = '.'.join([model_index, str(min_err), suffix])
-                    if os.path.exists(os.path.join(file_path, last_min_file_name)):
-                        os.remove(os.path.join(file_path, last_min_file_name))
-                    min_err = tmp_err
-                else:
-                    os.remove(os.path.join(file_path, file))
@@ -0,0 +1,257 @@
+import numpy as np
+
+from src.spatial_index.common_utils import binary_search_batch
+
+
+# closed-form models, trained in one pass over the sorted keys without tensorflow
+# min_err和max_err都是在训练数据上实测的pre - label，和AbstractNN一致，因此误差范围是有保证的
+class LinearModel:
+    def __init__(self, slope, intercept, min_err, max_err):
+        self.slope = slope
+        self.intercept = intercept
+        self.min_err = min_err
+        self.max_err = max_err
+
+    @staticmethod
+    def train(inputs, labels, error=None):
+        """
+        least-squares linear regression of labels on inputs
+        :param inputs: np.array, sorted keys
+        :param labels: np.array
+        :param error: unused, same args as the other models
+        :return: LinearModel
+        """
+        inputs = np.asarray(inputs, dtype=np.float64)
+        labels = np.asarray(labels, dtype=np.float64)
+        x_mean, y_mean = inputs.mean(), labels.mean()
+        x_var = ((inputs - x_mean) ** 2).sum()
+        slope = 0.0 if x_var == 0 else float(((inputs - x_mean) * (labels - y_mean)).sum() / x_var)
+        model = LinearModel(slope, float(y_mean - slope * x_mean), 0.0, 0.0)
+        model.min_err, model.max_err = get_errs(model, inputs, labels)
+        return model
+
+    def predict(self, input_keys):
+        input_keys = np.asarray(input_keys, dtype=np.float64).reshape(-1)
+        return input_keys * self.slope + self.intercept
+
+    def to_dict(self):
+        return {'slope': self.slope,
+                'intercept': self.intercept,
+                'min_err': self.min_err,
+                'max_err': self.max_err}
+
+    def shift(self, offset):
+        # copy of model whose outputs are shifted by offset
+        return LinearModel(self.slope, self.intercept + offset, self.min_err, self.max_err)
+
+    @staticmethod
+    def init_by_dict(d: dict):
+        return LinearModel(d['slope'], d['intercept'], d['min_err'], d['max_err'])
+
+
+class PiecewiseLinearModel:
+    def __init__(self, keys, intercepts, slopes, min_err, max_err):
+        self.keys = np.asarray(keys, dtype=np.float64)  # 每段的起点key
+        self.intercepts = np.asarray(intercepts, dtype=np.float64)  # 每段起点的label
+        self.slopes = np.asarray(slopes, dtype=np.float64)
+        self.min_err = min_err
+        self.max_err = max_err
+
+    @staticmethod
+    def train(inputs, labels, error):
+        """
+        greedy shrinking cone segmentation (FITing-Tree/PGM), every segment fits its keys within +-error
+        1. start a segment at the first key, the cone is the slopes which fit all the keys within +-error
+        2. shrink the cone by every key, start a new segment when the cone is empty
+        3. the slope of segment is the middle of its cone
+        duplicate keys are fitted by the label of their first one, so the error of them is measured after training
+        :param inputs: np.array, sorted keys
+        :param labels: np.array
+        :param error: max error of segments, in label units
+        :return: PiecewiseLinearModel
+        """
+        inputs = np.asarray(inputs, dtype=np.float64)
+        labels = np.asarray(labels, dtype=np.float64)
+        xs, firsts = np.unique(inputs, return_index=True)
+        ys = labels[firsts]
+        keys, intercepts, slopes = [], [], []
+        # 1. start a segment at the first key
+        x0, y0 = xs[0], ys[0]
+        slope_min, slope_max = -np.inf, np.inf
+        for x, y in zip(xs[1:].tolist(), ys[1:].tolist()):
+            dx = x - x0
+            new_min = max(slope_min, (y - error - y0) / dx)
+            new_max = min(slope_max, (y + error - y0) / dx)
+            # 2. start a new segment when the cone is empty
+            if new_min > new_max:
+                keys.append(x0)
+                intercepts.append(y0)
+                slopes.append(segment_slope(slope_min, slope_max))
+                x0, y0 = x, y
+                slope_min, slope_max = -np.inf, np.inf
+            else:
+                slope_min, slope_max = new_min, new_max
+        keys.append(x0)
+        intercepts.append(y0)
+        slopes.append(segment_slope(slope_min, slope_max))
+        model = PiecewiseLinearModel(keys, intercepts, slopes, 0.0, 0.0)
+        model.min_err, model.max_err = get_errs(model, inputs, labels)
+        return model
+
+    def predict(self, input_keys):
+        input_keys = np.asarray(input_keys, dtype=np.float64).reshape(-1)
+        segments = np.maximum(np.searchsorted(self.keys, input_keys, side='right') - 1, 0)
+        return self.intercepts[segments] + self.slopes[segments] * (input_keys - self.keys[segments])
+
+    def to_dict(self):
+        return {'keys': self.keys,
+                'intercepts': self.intercepts,
+                'slopes': self.slopes,
+                'min_err': self.min_err,
+                'max_err': self.max_err}
+
+    def shift(self, offset):
+        # copy of model whose outputs are shifted by offset
+        return PiecewiseLinearModel(self.keys, self.intercepts + offset, self.slopes, self.min_err, self.max_err)
+
+    @staticmethod
+    def init_by_dict(d: dict):
+        return PiecewiseLinearModel(d['keys'], d['intercepts'], d['slopes'], d['min_err'], d['max_err'])
+
+
+class RadixSpline:
+    def __init__(self, key_min, key_max, radix_bits, knot_keys, knot_labels, table, min_err, max_err):
+        self.key_min = key_min
+        self.key_max = key_max
+        self.radix_bits = radix_bits
+        self.knot_keys = np.asarray(knot_keys, dtype=np.float64)  # spline的节点，相邻节点之间线性插值
+        self.knot_labels = np.asarray(knot_labels, dtype=np.float64)
+        self.table = np.asarray(table, dtype=np.int64)  # radix table: key前缀 -> 第一个前缀>=它的节点
+        self.min_err = min_err
+        self.max_err = max_err
+        self.scale = 0.0 if key_max == key_min else (1 << radix_bits) / (key_max - key_min)
+
+    @staticmethod
+    def train(inputs, labels, error, radix_bits=10):
+        """
+        RadixSpline: greedy spline corridor and radix table of knots
+        1. pick knots by greedy spline corridor, the interpolation of knots fits all the keys within +-error
+        2. create radix table by the prefix of keys normalized in [key_min, key_max]
+        duplicate keys are fitted by the label of their first one, so the error of them is measured after training
+        :param inputs: np.array, sorted keys
+        :param labels: np.array
+        :param error: max error of spline, in label units
+        :param radix_bits: bits of the prefix in radix table
+        :return: RadixSpline
+        """
+        inputs = np.asarray(inputs, dtype=np.float64)
+        labels = np.asarray(labels, dtype=np.float64)
+        xs, firsts = np.unique(inputs, return_index=True)
+        ys = labels[firsts]
+        # 1. pick knots by greedy spline corridor
+        knot_keys, knot_labels = [xs[0]], [ys[0]]
+        if len(xs) > 1:
+            base_x, base_y = xs[0], ys[0]
+            upper_x, upper_y = xs[1], ys[1] + error
+            lower_x, lower_y = xs[1], ys[1] - error
+            prev_x, prev_y = xs[1], ys[1]
+            for x, y in zip(xs[2:].tolist(), ys[2:].tolist()):
+                dx = x - base_x
+                slope = (y - base_y) / dx
+                if slope > (upper_y - base_y) / (upper_x - base_x) or slope < (lower_y - base_y) / (lower_x - base_x):
+                    # 当前key超出corridor，上一个key作为节点，并以它为起点重建corridor
+                    knot_keys.append(prev_x)
+                    knot_labels.append(prev_y)
+                    base_x, base_y = prev_x, prev_y
+                    upper_x, upper_y = x, y + error
+                    lower_x, lower_y = x, y - error
+                else:
+                    if (y + error - base_y) / dx < (upper_y - base_y) / (upper_x - base_x):
+                        upper_x, upper_y = x, y + error
+                    if (y - error - base_y) / dx > (lower_y - base_y) / (lower_x - base_x):
+                        lower_x, lower_y = x, y - error
+                prev_x, prev_y = x, y
+            knot_keys.append(prev_x)
+            knot_labels.append(prev_y)
+        # 2. create radix table
+        model = RadixSpline(float(xs[0]), float(xs[-1]), radix_bits, knot_keys, knot_labels, [], 0.0, 0.0)
+        prefixes = model.prefix(model.knot_keys)
+        model.table = np.searchsorted(prefixes, np.arange((1 << radix_bits) + 1), side='left')
+        model.min_err, model.max_err = get_errs(model, inputs, labels)
+        return model
+
+    def prefix(self, input_keys):
+        prefixes = np.floor((input_keys - self.key_min) * self.scale)
+        return np.clip(prefixes, 0, (1 << self.radix_bits) - 1).astype(np.int64)
+
+    def predict(self, input_keys):
+        """
+        predict by radix table and spline
+        1. find the knots range of key by its prefix in radix table
+        2. binary search the first knot >= key in the range
+        3. interpolate between the knot and the one before it
+        :param input_keys: float or np.array
+        :return: np.array
+        """
+        input_keys = np.asarray(input_keys, dtype=np.float64).reshape(-1)
+        if len(self.knot_keys) == 1:
+            return np.full(len(input_keys), self.knot_labels[0])
+        # 1. find the knots range of key by its prefix in radix table
+        prefixes = self.prefix(input_keys)
+        # 2. binary search the first knot >= key in the range
+        knots, _ = binary_search_batch(self.knot_keys, input_keys, self.table[prefixes], self.table[prefixes + 1] - 1)
+        knots = np.clip(knots, 1, len(self.knot_keys) - 1)
+        # 3. interpolate between the knot and the one before it
+        x0, x1 = self.knot_keys[knots - 1], self.knot_keys[knots]
+        y0, y1 = self.knot_labels[knots - 1], self.knot_labels[knots]
+        return y0 + (input_keys - x0) * (y1 - y0) / (x1 - x0)
+
+    def to_dict(self):
+        return {'key_min': self.key_min,
+                'key_max': self.key_max,
+                'radix_bits': self.radix_bits,
+                'knot_keys': self.knot_keys,
+                'knot_labels': self.knot_labels,
+                'table': self.table,
+                'min_err': self.min_err,
+                'max_err': self.max_err}
+
+    def shift(self, offset):
+        # copy of model whose outputs are shifted by offset
+        return RadixSpline(self.key_min, self.key_max, self.radix_bits, self.knot_keys, self.knot_labels + offset,
+                           self.table, self.min_err, self.max_err)
+
+    @staticmethod
+    def init_by_dict(d: dict):
+        return RadixSpline(d['key_min'], d['key_max'], d['radix_bits'],
+                           d['knot_keys'], d['knot_labels'], d['table'],
+                           d['min_err'], d['max_err'])
+
+
+MODEL_TYPES = {'linear': LinearModel, 'pla': PiecewiseLinearModel, 'radix_spline': RadixSpline}
+
+
+def train_model(model_type, inputs, labels, error):
+    """
+    train closed-form model by type
+    :param model_type: linear/pla/radix_spline
+    :param inputs: np.array, sorted keys
+    :param labels: np.array
+    :param error: max error of pla and radix_spline, in label units
+    :return: model
+    """
+    if model_type not in MODEL_TYPES:
+        raise ValueError("unknown model type: %s" % model_type)
+    return MODEL_TYPES[model_type].train(inputs, labels, error)
+
+
+def get_errs(model, inputs, labels):
+    errs = model.predict(inputs) - labels
+    return float(errs.min()), float(errs.max())
+
+
+def segment_slope(slope_min, slope_max):
+    # 只有一个key的段没有约束，斜率取0
+    if np.isinf(slope_min):
+        return 0.0
+    return (slope_min + slope_max) / 2
@@ -0,0 +1,105 @@
+import numpy as np
+
+from src.rmi_keras import AbstractNN
+from src.rmi_linear import LinearModel
+
+
+# 一个stage的所有模型参数按model id堆叠成数组，batch预测时按key的model id gather参数，每层一次einsum
+# 只支持同结构的AbstractNN和LinearModel，其他模型（pla/radix_spline）仍然按model逐个predict
+class StackedStage:
+    def __init__(self, model_type, weights, input_offsets, input_scales, output_offsets, output_scales,
+                 min_errs, max_errs, valid, weight_scales=None):
+        self.model_type = model_type  # nn: weights[i]为第i层的[model nums, in, out]或[model nums, out]
+        self.weights = weights  # linear: weights = [slopes, intercepts]
+        self.weight_scales = weight_scales  # int8: [model nums, len(weights)]，gather后再乘scale
+        self.input_offsets = input_offsets
+        self.input_scales = input_scales
+        self.output_offsets = output_offsets
+        self.output_scales = output_scales
+        self.min_errs = min_errs
+        self.max_errs = max_errs
+        self.valid = valid  # 空模型为False，predict结果为nan
+        self.chunk_size = 4096  # gather的参数为[chunk_size, in, out]，分块预测控制内存
+
+    @staticmethod
+    def compile(models):
+        """
+        stack the parameters of models into arrays indexed by model id
+        :param models: list of model or None
+        :return: StackedStage, None if the models can not be stacked
+        """
+        valid = np.array([model is not None for model in models], dtype=bool)
+        existing = [model for model in models if model is not None]
+        if len(existing) == 0:
+            return None
+        size = len(models)
+        min_errs = np.full(size, np.nan)
+        max_errs = np.full(size, np.nan)
+        min_errs[valid] = [model.min_err for model in existing]
+        max_errs[valid] = [model.max_err for model in existing]
+        if all(type(model) is LinearModel for model in existing):
+            slopes = np.zeros(size)
+            intercepts = np.zeros(size)
+            slopes[valid] = [model.slope for model in existing]
+            intercepts[valid] = [model.intercept for model in existing]
+            return StackedStage('linear', [slopes, intercepts], None, None, None, None, min_errs, max_errs, valid)
+        if not all(type(model) is AbstractNN and model.core_nums == existing[0].core_nums for model in existing):
+            return None
+        # 同dtype的模型按量化后的weights堆叠，gather的数据量更小；dtype不同时还原为float64
+        dtype = existing[0].dtype if all(model.dtype == existing[0].dtype for model in existing) else 'float64'
+        model_weights = [model.weights if model.dtype == dtype else model.dequantize() for model in existing]
+        weights = []
+        for i, weight in enumerate(model_weights[0]):
+            stacked = np.zeros((size,) + weight.shape, dtype=weight.dtype)
+            stacked[valid] = [w[i] for w in model_weights]
+            weights.append(stacked)
+        weight_scales = None
+        if dtype == 'int8':
+            weight_scales = np.ones((size, len(weights)))
+            weight_scales[valid] = [model.scales for model in existing]
+        input_offsets = np.zeros(size)
+        input_scales = np.ones(size)
+        output_offsets = np.zeros(size)
+        output_scales = np.ones(size)
+        for j, model in enumerate(models):
+            if model is None:
+                continue
+            input_offsets[j], input_scales[j] = model.input_offset, model.input_scale
+            if model.output_min is not None and model.output_max is not None:
+                output_offsets[j], output_scales[j] = model.output_min, model.output_max - model.output_min
+        return StackedStage('nn', weights, input_offsets, input_scales, output_offsets, output_scales,
+                            min_errs, max_errs, valid, weight_scales)
+
+    def predict(self, model_ids, keys):
+        """
+        predict keys by their models
+        nn: gather the parameters of every key, w * x + b by einsum and sigmoid for every layer, same as AbstractNN
+        linear: slope * key + intercept
+        :param model_ids: np.array of int
+        :param keys: np.array
+        :return: np.array of the predicted indexes, min_errs and max_errs, nan if the model is empty
+        """
+        model_ids = np.asarray(model_ids, dtype=np.int64)
+        keys = np.asarray(keys, dtype=np.float64)
+        if self.model_type == 'linear':
+            pres = keys * self.weights[0][model_ids] + self.weights[1][model_ids]
+        else:
+            pres = np.empty(len(keys), dtype=np.float64)
+            for start in range(0, len(keys), self.chunk_size):
+                end = min(start + self.chunk_size, len(keys))
+                pres[start:end] = self.predict_nn(model_ids[start:end], keys[start:end])
+        pres[~self.valid[model_ids]] = np.nan
+        return pres, self.min_errs[model_ids], self.max_errs[model_ids]
+
+    def predict_nn(self, model_ids, keys):
+        tmp_res = ((keys - self.input_offsets[model_ids]) * self.input_scales[model_ids])[:, np.newaxis]
+        with np.errstate(over='ignore'):
+            for i in range(0, len(self.weights), 2):
+                tmp_res = np.einsum('ni,nio->no', tmp_res, self.weights[i][model_ids], dtype=np.float64)
+                if self.weight_scales is None:
+                    tmp_res += self.weights[i + 1][model_ids]
+                else:
+                    tmp_res *= self.weight_scales[model_ids, i, np.newaxis]
+                    tmp_res += self.weights[i + 1][model_ids] * self.weight_scales[model_ids, i + 1, np.newaxis]
+                AbstractNN.sigmoid_inplace(tmp_res)
+        return np.clip(tmp_res[:, 0], 0, 1) * self.output_scales[model_ids] + self.output_offsets[model_ids]
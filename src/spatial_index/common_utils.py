@@ -1,9 +1,10 @@
 import csv
+import heapq
 import random
 import time
 from collections import deque
 from itertools import chain
-from math import log10
+from math import log10, floor
 from reprlib import repr
 from sys import getsizeof, stderr
 
@@ -56,6 +57,14 @@ class Region:
     def contain_and_border(self, point):
         return self.up >= point.lat >= self.bottom and self.right >= point.lng >= self.left
 
+    def distance(self, lng, lat):
+        """
+        point到region的最近距离，point在region内时为0
+        """
+        dx = max(self.left - lng, 0, lng - self.right)
+        dy = max(self.bottom - lat, 0, lat - self.up)
+        return (dx * dx + dy * dy) ** 0.5
+
     @staticmethod
     def init_by_dict(d: dict):
         return Region(bottom=d['bottom'],
@@ -65,11 +74,19 @@ class Region:
 
 
 class ZOrder:
+    # morton.Morton的初始化要逐bit计算mask，很慢，按bits缓存后所有ZOrder共享
+    mortons = {}
+
     def __init__(self):
         self.bits = 21
-        self.morton = morton.Morton(dimensions=2, bits=self.bits)
         self.max_z = (1 << self.bits * 2) - 1
 
+    @property
+    def morton(self):
+        if self.bits not in ZOrder.mortons:
+            ZOrder.mortons[self.bits] = morton.Morton(dimensions=2, bits=self.bits)
+        return ZOrder.mortons[self.bits]
+
     def point_to_z(self, lng, lat, region):
         """
         计算point的z order
@@ -83,8 +100,171 @@ class ZOrder:
         max_num = 1 << self.bits
         lng_zoom = int((lng - region.left) * max_num / (region.right - region.left))
         lat_zoom = int((lat - region.bottom) * max_num / (region.up - region.bottom))
+        if not (0 <= lng_zoom < max_num and 0 <= lat_zoom < max_num):
+            raise ValueError("points out of region, zoom must be in [0, %d)" % max_num)
         return self.morton.pack(lng_zoom, lat_zoom)
 
+    def point_to_z_batch(self, lngs, lats, region):
+        """
+        计算一批point的z order，结果和point_to_z一致
+        1. 经纬度都先根据region归一化到0-1，然后缩放到0-2^self.bits，向0取整
+        2. 在uint64上交织经纬度的bit，经度在低位，纬度在高位
+        :param lngs: np.array
+        :param lats: np.array
+        :param region:
+        :return: np.array of uint64
+        """
+        max_num = 1 << self.bits
+        lng_zoom = self.zoom_batch(lngs, region.left, region.right, max_num)
+        lat_zoom = self.zoom_batch(lats, region.bottom, region.up, max_num)
+        return self.split_bits(lng_zoom) | (self.split_bits(lat_zoom) << np.uint64(1))
+
+    def z_to_point_batch(self, zs, region, center=False):
+        """
+        z order反算point，返回z所在格子左下角的经纬度
+        :param zs: np.array of int
+        :param region:
+        :param center: 为True时返回格子中心的经纬度
+        :return: np.array, np.array: lngs, lats
+        """
+        zs = np.asarray(zs, dtype=np.uint64)
+        max_num = 1 << self.bits
+        lng_zoom = self.compact_bits(zs).astype(np.float64)
+        lat_zoom = self.compact_bits(zs >> np.uint64(1)).astype(np.float64)
+        if center:
+            lng_zoom += 0.5
+            lat_zoom += 0.5
+        lngs = region.left + lng_zoom * (region.right - region.left) / max_num
+        lats = region.bottom + lat_zoom * (region.up - region.bottom) / max_num
+        return lngs, lats
+
+    def window_to_box(self, window, region):
+        """
+        计算window在region中覆盖的格子范围，超出region的部分被裁掉
+        :param window: Region
+        :param region: Region
+        :return: [x1, y1, x2, y2] of int, 左下和右上格子；window和region不相交时返回None
+        """
+        max_num = 1 << self.bits
+        x1 = floor((window.left - region.left) * max_num / (region.right - region.left))
+        x2 = floor((window.right - region.left) * max_num / (region.right - region.left))
+        y1 = floor((window.bottom - region.bottom) * max_num / (region.up - region.bottom))
+        y2 = floor((window.up - region.bottom) * max_num / (region.up - region.bottom))
+        if x2 < 0 or y2 < 0 or x1 >= max_num or y1 >= max_num or x1 > x2 or y1 > y2:
+            return None
+        return [max(x1, 0), max(y1, 0), min(x2, max_num - 1), min(y2, max_num - 1)]
+
+    def box_to_z_intervals(self, box, max_intervals=16):
+        """
+        把格子范围分解为z区间：BIGMIN/LITMAX
+        1. box的z范围是[z(x1, y1), z(x2, y2)]，其中包含box外的z
+        2. 在z_min和z_max最高的不同bit处把box切成两半，LITMAX是前一半的最大z，BIGMIN是后一半的最小z
+        3. 每次切分box外z最多的区间，直到所有区间都只包含box内的z或者区间数达到max_intervals
+        :param box: [x1, y1, x2, y2] of int
+        :param max_intervals: 区间数上限，超出时区间会包含box外的z，需要过滤
+        :return: list of [z_min, z_max, exact], 按z有序，exact表示区间内的z都在box内
+        """
+        heap = []
+
+        def push(x1, y1, x2, y2):
+            z_min = self.pack(x1, y1)
+            z_max = self.pack(x2, y2)
+            waste = (z_max - z_min + 1) - (x2 - x1 + 1) * (y2 - y1 + 1)
+            heapq.heappush(heap, (-waste, z_min, z_max, x1, y1, x2, y2))
+
+        push(*[int(value) for value in box])
+        while len(heap) < max_intervals and heap[0][0] < 0:
+            waste, z_min, z_max, x1, y1, x2, y2 = heapq.heappop(heap)
+            bit = (z_min ^ z_max).bit_length() - 1
+            level = bit >> 1
+            if bit & 1 == 0:
+                split = (x2 >> level) << level
+                push(x1, y1, split - 1, y2)  # LITMAX = z(split - 1, y2)
+                push(split, y1, x2, y2)  # BIGMIN = z(split, y1)
+            else:
+                split = (y2 >> level) << level
+                push(x1, y1, x2, split - 1)  # LITMAX = z(x2, split - 1)
+                push(x1, split, x2, y2)  # BIGMIN = z(x1, split)
+        # 合并首尾相接的区间
+        intervals = []
+        for waste, z_min, z_max, x1, y1, x2, y2 in sorted(heap, key=lambda t: t[1]):
+            if intervals and intervals[-1][1] + 1 == z_min:
+                intervals[-1][1] = z_max
+                intervals[-1][2] = intervals[-1][2] and waste == 0
+            else:
+                intervals.append([z_min, z_max, waste == 0])
+        return intervals
+
+    def z_in_box_batch(self, zs, box):
+        """
+        判断z所在的格子是否在box内
+        :param zs: np.array of int
+        :param box: [x1, y1, x2, y2] of int
+        :return: np.array of bool
+        """
+        zs = np.asarray(zs, dtype=np.uint64)
+        xs = self.compact_bits(zs)
+        ys = self.compact_bits(zs >> np.uint64(1))
+        return (xs >= box[0]) & (xs <= box[2]) & (ys >= box[1]) & (ys <= box[3])
+
+    @staticmethod
+    def zoom_batch(values, lower, upper, max_num):
+        """
+        按[lower, upper]把values缩放到0-max_num，超出范围时和morton.pack一样报错
+        """
+        zoom = np.trunc((np.asarray(values, dtype=np.float64) - lower) * max_num / (upper - lower))
+        if not ((zoom >= 0) & (zoom < max_num)).all():
+            raise ValueError("points out of region, zoom must be in [0, %d)" % max_num)
+        return zoom.astype(np.uint64)
+
+    @staticmethod
+    def pack(x, y):
+        """
+        z order of int x/y, same as morton.pack but faster: bit magic of split_bits on python int
+        """
+        z = 0
+        for value, shift in ((x, 0), (y, 1)):
+            value &= 0xFFFFFFFF
+            value = (value | (value << 16)) & 0x0000FFFF0000FFFF
+            value = (value | (value << 8)) & 0x00FF00FF00FF00FF
+            value = (value | (value << 4)) & 0x0F0F0F0F0F0F0F0F
+            value = (value | (value << 2)) & 0x3333333333333333
+            value = (value | (value << 1)) & 0x5555555555555555
+            z |= value << shift
+        return z
+
+    def pack_batch(self, xs, ys):
+        """
+        z order of int x/y in batch, same as pack
+        """
+        return self.split_bits(xs) | (self.split_bits(ys) << np.uint64(1))
+
+    @staticmethod
+    def split_bits(values):
+        """
+        把32bit以内的整数的bit间隔展开：b1b0 -> 0b10b0
+        """
+        values = np.asarray(values, dtype=np.uint64) & np.uint64(0xFFFFFFFF)
+        values = (values | (values << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+        values = (values | (values << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+        values = (values | (values << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        values = (values | (values << np.uint64(2))) & np.uint64(0x3333333333333333)
+        values = (values | (values << np.uint64(1))) & np.uint64(0x5555555555555555)
+        return values
+
+    @staticmethod
+    def compact_bits(values):
+        """
+        split_bits的逆运算：取出偶数位的bit并压紧
+        """
+        values = np.asarray(values, dtype=np.uint64) & np.uint64(0x5555555555555555)
+        values = (values | (values >> np.uint64(1))) & np.uint64(0x3333333333333333)
+        values = (values | (values >> np.uint64(2))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        values = (values | (values >> np.uint64(4))) & np.uint64(0x00FF00FF00FF00FF)
+        values = (values | (values >> np.uint64(8))) & np.uint64(0x0000FFFF0000FFFF)
+        values = (values | (values >> np.uint64(16))) & np.uint64(0x00000000FFFFFFFF)
+        return values
+
 
 class Geohash:
     """
@@ -235,17 +415,11 @@ def create_data_z(input_path, output_path, lng_col, lat_col, region):
     """
     df = pd.read_csv(input_path, header=None)
     z_order = ZOrder()
-    z_values = []
-    z_values_normalization = []
-    for i in range(df.count()[0]):
-        z_value = z_order.point_to_z(df[lng_col][i], df[lat_col][i], region)
-        z_values.append(z_value)
+    z_values = z_order.point_to_z_batch(df[lng_col].values, df[lat_col].values, region)
     # z归一化
-    min_z_value = min(z_values)
-    max_z_value = max(z_values)
-    for i in range(df.count()[0]):
-        z_value_normalization = (z_values[i] - min_z_value) / (max_z_value - min_z_value)
-        z_values_normalization.append(z_value_normalization)
+    min_z_value = z_values.min()
+    max_z_value = z_values.max()
+    z_values_normalization = (z_values - min_z_value) / (max_z_value - min_z_value)
     df["z_value"] = z_values
     df["z_value_normalization"] = z_values_normalization
     df = df.rename(columns={lng_col: "lng", lat_col: "lat"})
@@ -292,7 +466,8 @@ def read_data_and_search(path, index, lng_col, lat_col, z_col, index_col):
 # python sys.getsizeof无法对自定义类统计内存，提出以下方法
 # 代码来自：https://code.activestate.com/recipes/577504
 # l342有漏洞：只统计class.__dict__包含的属性，rtree.__dict__不包含bounds等属性，导致内存统计偏小
-def total_size(o, handlers={}, verbose=False):
+# np.array的view和memmap只有header，按base和nbytes统计；DataFrame按memory_usage(deep=True)统计
+def total_size(o, handlers={}, verbose=False, seen=None):
     """ Returns the approximate memory footprint an object and all of its contents.
 
     Automatically finds the contents of the following builtin containers and
@@ -312,13 +487,21 @@ def total_size(o, handlers={}, verbose=False):
                     frozenset: iter,
                     }
     all_handlers.update(handlers)  # user handlers take precedence
-    seen = set()  # track which object id's have already been seen
+    if seen is None:
+        seen = set()  # track which object id's have already been seen
     default_size = getsizeof(0)  # estimate sizeof object without __sizeof__
 
     def sizeof(o):
         if id(o) in seen:  # do not double count the same object
             return 0
         seen.add(id(o))
+        if isinstance(o, np.ndarray):
+            # view只统计header，数据按base统计一次；memmap的view是文件中不重叠的section，按nbytes统计
+            if isinstance(o.base, np.ndarray) and not isinstance(o, np.memmap) and not isinstance(o.base, np.memmap):
+                return getsizeof(o) + sizeof(o.base)
+            return max(getsizeof(o), o.nbytes)
+        if isinstance(o, (pd.DataFrame, pd.Series)):
+            return int(np.sum(o.memory_usage(index=True, deep=True)))
         s = getsizeof(o, default_size)
 
         if verbose:
@@ -339,6 +522,24 @@ def total_size(o, handlers={}, verbose=False):
     return sizeof(o)
 
 
+MEMORY_COMPONENTS = ['models', 'keys', 'positions', 'tree_nodes', 'native']
+
+
+def memory_usage_of(components: dict, native=0):
+    """
+    bytes of every component of index, objects shared by components are only counted in the first one
+    :param components: dict, component name in MEMORY_COMPONENTS -> list of objects
+    :param native: bytes of the storage outside python, e.g. the C-side storage of rtree
+    :return: dict, component name -> bytes, and total bytes
+    """
+    seen = set()
+    usage = {name: sum(total_size(o, seen=seen) for o in components.get(name, []))
+             for name in MEMORY_COMPONENTS}
+    usage['native'] += native
+    usage['total'] = sum(usage.values())
+    return usage
+
+
 def is_sorted_list(lst):
     """
     判断list是否有序
@@ -348,6 +549,161 @@ def is_sorted_list(lst):
     return sorted(lst) == lst or sorted(lst, reverse=True) == lst
 
 
+def bitmap_create(size):
+    """
+    bitmap of size bits, bit i is (bitmap[i >> 3] >> (i & 7)) & 1
+    """
+    return np.zeros((size + 7) >> 3, dtype=np.uint8)
+
+
+def bitmap_get(bitmap, positions):
+    positions = np.asarray(positions, dtype=np.int64)
+    return ((bitmap[positions >> 3] >> (positions & 7).astype(np.uint8)) & 1).astype(bool)
+
+
+def bitmap_set(bitmap, positions):
+    positions = np.asarray(positions, dtype=np.int64)
+    np.bitwise_or.at(bitmap, positions >> 3, np.left_shift(1, positions & 7).astype(np.uint8))
+
+
+def bitmap_to_mask(bitmap, size):
+    return np.unpackbits(bitmap, count=size, bitorder='little').astype(bool)
+
+
+def first_alive_batch(keys, tombstones, positions, xs):
+    """
+    move positions forward over the dead entries whose key == x
+    :param keys: np.array, sorted keys
+    :param tombstones: bitmap of dead entries
+    :param positions: np.array of int, lower bounds of xs
+    :param xs: np.array, keys to search
+    :return: np.array of int, positions of the first alive entries whose key == x
+             np.array of bool, found or not
+    """
+    positions = np.array(positions, dtype=np.int64)
+    last = len(keys) - 1
+    active = np.arange(len(positions))
+    while len(active):
+        p = np.minimum(positions[active], last)
+        dead = (positions[active] <= last) & (keys[p] == xs[active]) & bitmap_get(tombstones, p)
+        active = active[dead]
+        positions[active] += 1
+    found = (positions <= last) & (keys[np.minimum(positions, last)] == xs)
+    return positions, found
+
+
+def points_in_polygon(xs, ys, polygon):
+    """
+    ray casting: 点向右的射线和多边形的边相交奇数次时在多边形内
+    :param xs: np.array
+    :param ys: np.array
+    :param polygon: np.array or list of [x, y] vertices, the last vertex connects to the first one
+    :return: np.array of bool
+    """
+    polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    inside = np.zeros(len(xs), dtype=bool)
+    for (x1, y1), (x2, y2) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        crossing = (y1 > ys) != (y2 > ys)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (ys - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crossing & (xs < x_cross)
+    return inside
+
+
+def group_indexes(labels):
+    """
+    按label对np.array的下标分组
+    :param labels: np.array of int
+    :return: generator of (label, np.array of positions with this label)
+    """
+    order = np.argsort(labels, kind='stable')
+    uniques, starts = np.unique(labels[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    for label, start, end in zip(uniques, starts, ends):
+        yield label, order[start:end]
+
+
+def binary_search_batch(nums, xs, left, right):
+    """
+    lower bound of every x in nums[left, right], all the searches run in lockstep
+    :param nums: np.array, sorted keys
+    :param xs: np.array, keys to search
+    :param left: np.array of int
+    :param right: np.array of int
+    :return: np.array of int, position of the first key >= x in scope, right + 1 if all keys in scope < x
+             np.array of int, probes of every search
+    """
+    lo = np.asarray(left, dtype=np.int64).copy()
+    hi = np.asarray(right, dtype=np.int64) + 1
+    probes = np.zeros(len(lo), dtype=np.int64)
+    if len(nums) == 0 or len(lo) == 0:
+        return lo, probes
+    last = len(nums) - 1
+    # 每轮scope长度至少减半，最长scope的bit数即为轮数
+    width = int((hi - lo).max())
+    while width > 0:
+        active = lo < hi
+        mid = (lo + hi) >> 1
+        less = nums[np.minimum(mid, last)] < xs
+        lo = np.where(active & less, mid + 1, lo)
+        hi = np.where(active & ~less, mid, hi)
+        probes += active
+        width >>= 1
+    return lo, probes
+
+
+def exponential_search_batch(nums, xs, pres, left, right):
+    """
+    lower bound of every x in nums[left, right], galloping from the predicted position, all the searches run in lockstep
+    1. compare nums[pre] with x to choose the direction
+    2. gallop with step 1, 2, 4... until the key crosses x or the step crosses the scope
+    3. binary search between the last two steps
+    :param nums: np.array, sorted keys
+    :param xs: np.array, keys to search
+    :param pres: np.array, predicted positions, nan to start from the middle of scope
+    :param left: np.array of int
+    :param right: np.array of int
+    :return: np.array of int, position of the first key >= x in scope, right + 1 if all keys in scope < x
+             np.array of int, probes of every search
+    """
+    left = np.asarray(left, dtype=np.int64)
+    right = np.asarray(right, dtype=np.int64)
+    probes = np.zeros(len(left), dtype=np.int64)
+    if len(nums) == 0 or len(left) == 0:
+        return left.copy(), probes
+    last = len(nums) - 1
+    pres = np.asarray(pres, dtype=np.float64)
+    starts = np.where(np.isnan(pres), (left + right) >> 1, np.round(np.nan_to_num(pres))).astype(np.int64)
+    starts = np.maximum(np.minimum(starts, right), left)
+    # 1. compare nums[pre] with x to choose the direction, lower bound is in [lo, hi]
+    valid = left <= right
+    forward = valid & (nums[np.clip(starts, 0, last)] < xs)
+    probes += valid
+    lo = np.where(forward, starts + 1, left)
+    hi = np.where(forward, right + 1, np.where(valid, starts, left))
+    # 2. gallop with step 1, 2, 4... until the key crosses x or the step crosses the scope
+    step = 1
+    active = valid.copy()
+    while active.any():
+        probe = np.where(forward, starts + step, starts - step)
+        inside = active & (probe >= left) & (probe <= right)
+        less = nums[np.clip(probe, 0, last)] < xs
+        probes += inside
+        # forward: key < x则继续，否则lower bound在(starts + step / 2, probe]
+        lo = np.where(inside & forward & less, probe + 1, lo)
+        hi = np.where(inside & forward & ~less, probe, hi)
+        # backward: key >= x则继续，否则lower bound在(probe, starts - step / 2]
+        hi = np.where(inside & ~forward & ~less, probe, hi)
+        lo = np.where(inside & ~forward & less, probe + 1, lo)
+        active = inside & (less == forward)
+        step <<= 1
+    # 3. binary search between the last two steps
+    positions, binary_probes = binary_search_batch(nums, xs, lo, hi - 1)
+    return positions, probes + binary_probes
+
+
 def nparray_normalize(na):
     """
     对np.array进行最大最小值归一化
@@ -375,29 +731,17 @@ def nparray_normalize_minmax(na, min_v, max_v):
 
 
 def nparray_normalize_reverse(na, min_v, max_v):
-    f1 = np.frompyfunc(nparray_normalize_reverse_child, 3, 1)
-    return f1(na, min_v, max_v).astype('float')
-
-
-def nparray_normalize_reverse_child(num, min_v, max_v):
-    if num < 0:
-        num = 0
-    elif num > 1:
-        num = 1
-    return num * (max_v - min_v) + min_v
+    """
+    np.array先clip到0-1，再按最大最小值反归一化
+    """
+    return np.clip(na, 0, 1) * (max_v - min_v) + min_v
 
 
 def nparray_diff_normalize_reverse(na1, na2, min_v, max_v):
-    f1 = np.frompyfunc(nparray_diff_normalize_reverse_child, 4, 1)
-    return f1(na1, na2, min_v, max_v).astype('float')
-
-
-def nparray_diff_normalize_reverse_child(num1, num2, min_v, max_v):
-    if num1 < 0:
-        num1 = 0
-    elif num1 > 1:
-        num1 = 1
-    return (num1 - num2) * (max_v - min_v)
+    """
+    na1先clip到0-1，再计算和na2的差值并按最大最小值反归一化
+    """
+    return (np.clip(na1, 0, 1) - na2) * (max_v - min_v)
 
 
 if __name__ == '__main__':
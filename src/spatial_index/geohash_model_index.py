@@ -1,6 +1,4 @@
-import gc
 import json
-import multiprocessing
 import os
 import sys
 import time
@@ -11,19 +9,31 @@ import pandas as pd
 sys.path.append('D:/Code/Paper/st-learned-index')
 from src.brin import BRIN, RegularPage, RevMapPage, MetaPage
 from src.spatial_index.quad_tree import QuadTree
-from src.spatial_index.common_utils import ZOrder, Region
+from src.spatial_index.common_utils import ZOrder, Region, group_indexes, binary_search_batch, \
+    exponential_search_batch, bitmap_create, bitmap_get, bitmap_set, bitmap_to_mask, first_alive_batch, \
+    memory_usage_of, points_in_polygon
+from src.spatial_index.index_file import save_index_file, load_index_file, models_to_sections, sections_to_models
 from src.spatial_index.spatial_index import SpatialIndex
-from src.rmi_keras import TrainedNN, AbstractNN
+from src.spatial_index.leaf_trainer import MODEL_CLASSES, train_leaves
+from src.spatial_index.telemetry import Telemetry
+from src.rmi_keras import AbstractNN
+from src.rmi_linear import LinearModel, PiecewiseLinearModel, RadixSpline
+
+# 保存在index文件header中的训练参数，load后compact重训leaf model时使用
+TRAIN_ARG_NAMES = ['use_threshold', 'threshold', 'model_type', 'weight_dtype', 'core', 'train_step', 'batch_size',
+                   'learning_rate', 'keep_ratio', 'retrain_time_limit', 'compaction_ratio']
 
 
 class GeoHashModelIndex(SpatialIndex):
     def __init__(self, region=Region(-90, 90, -180, 180), max_num=10000, model_path=None, train_data_length=None,
-                 brin=None, gm_dict=None, index_list=None):
+                 brin=None, gm_dict=None, index_keys=None, index_positions=None, search_mode='binary'):
         super(GeoHashModelIndex, self).__init__("GeoHash Model Index")
         # nn args
         self.block_size = 100
         self.use_threshold = True
         self.threshold = 2
+        self.model_type = 'nn'  # nn: keras网络, linear/pla/radix_spline: 闭式模型，误差上限为threshold / 2
+        self.weight_dtype = 'float64'  # nn的weights存储类型: float64/float16/int8
         self.core = [1, 128, 1]
         self.train_step = 30000
         self.batch_size = 1024
@@ -39,7 +49,19 @@ class GeoHashModelIndex(SpatialIndex):
         self.train_data_length = train_data_length
         self.brin = brin
         self.gm_dict = gm_dict if gm_dict is not None else {}
-        self.index_list = index_list  # 索引列
+        self.index_keys = index_keys  # 索引列：有序的key
+        self.index_positions = index_positions  # 索引列：key对应的key index
+        self.search_mode = search_mode  # binary: 在[pre - max_err, pre - min_err]内二分, exponential: 从pre开始倍增查找
+        self.search_stats = {'searches': 0, 'probes': 0}
+        # tombstones: index_keys中已删除的位置，dead占比超过compaction_ratio后compact
+        self.compaction_ratio = 0.1
+        self.tombstones = bitmap_create(0 if index_keys is None else len(index_keys))
+        self.dead_num = 0
+        # leaf cells: geohash, xy border和z border按brin的顺序展开的数组，build和load时创建，compact后更新slices
+        self.cell_geohashes = None
+        self.cell_borders = None
+        self.cell_z_borders = None
+        self.cell_slices = None
 
     def init_train_data(self, data: pd.DataFrame):
         """
@@ -52,15 +74,17 @@ class GeoHashModelIndex(SpatialIndex):
         :return: None
         """
         z_order = ZOrder()
-        z_values = data.apply(lambda t: z_order.point_to_z(t.x, t.y, self.region), 1)
+        z_values = z_order.point_to_z_batch(data.x.values, data.y.values, self.region)
         # z归一化
         data["z"] = z_values / z_order.max_z
         data.sort_values(by=["z"], ascending=True, inplace=True)
         data.reset_index(drop=True, inplace=True)
         self.train_data_length = len(data)
         data["z_index"] = pd.Series(np.arange(0, self.train_data_length) / self.block_size)
-        self.index_list = pd.DataFrame({'key': data.z,
-                                        "key_index": data.z_index})
+        self.index_keys = np.ascontiguousarray(data.z.values)
+        self.index_positions = np.ascontiguousarray(data.z_index.values)
+        self.tombstones = bitmap_create(self.train_data_length)
+        self.dead_num = 0
 
     def build(self, data: pd.DataFrame):
         """
@@ -81,64 +105,182 @@ class GeoHashModelIndex(SpatialIndex):
         # 3. create brin index
         self.brin = BRIN(version=0, pages_per_range=None, revmap_page_maxitems=500, regular_page_maxitems=500)
         self.brin.build_by_quad_tree(quad_tree)
-        # 4. in every part data, create zm-model
-        multiprocessing.set_start_method('spawn')  # 解决CUDA_ERROR_NOT_INITIALIZED报错
-        pool = multiprocessing.Pool(processes=self.thread_pool_size)
-        mp_dict = multiprocessing.Manager().dict()  # 使用共享dict暂存index[i]的所有model
+        # 4. in every part data, create zm-model, keys and labels are passed to workers by shared memory
+        telemetry = Telemetry(self.model_path + "models/telemetry.jsonl", index=self.name, stage=1)
+        if os.path.exists(telemetry.path):
+            os.remove(telemetry.path)
+        tasks = []
         for geohash_key in split_data:
             points = split_data[geohash_key]["items"]
             inputs = np.array([item.z for item in points])
             labels = np.array([item.index for item in points])
-            if len(labels) == 0:
-                continue
-            pool.apply_async(self.build_single_thread, (1, geohash_key, inputs, labels, mp_dict))
-        pool.close()
-        pool.join()
-        for (key, value) in mp_dict.items():
-            self.gm_dict[key] = value
+            tasks.append((geohash_key, self.get_model_path(1, geohash_key), inputs, labels))
+        self.gm_dict.update(train_leaves(tasks, self.model_type, self.get_train_args(), self.thread_pool_size,
+                                         self.model_path + "models/", telemetry, self.weight_dtype))
+        self.init_leaf_cells()
         # 5. clear train data and label to save memory
 
-    def build_single_thread(self, curr_stage, current_stage_step, inputs, labels, tmp_dict=None):
-        # train model
-        i = curr_stage
-        j = current_stage_step
-        model_path = self.model_path + "models/" + str(i) + "_" + str(j) + "_weights.best.hdf5"
-        tmp_index = TrainedNN(model_path, inputs, labels,
-                              self.threshold,
-                              self.use_threshold,
-                              self.core,
-                              self.train_step,
-                              self.batch_size,
-                              self.learning_rate,
-                              self.keep_ratio,
-                              self.retrain_time_limit)
-        tmp_index.train()
-        tmp_index.plot()
-        # get parameters in model (weight matrix and bias matrix)
-        abstract_index = AbstractNN(tmp_index.get_weights(),
-                                    self.core,
-                                    tmp_index.train_x_min,
-                                    tmp_index.train_x_max,
-                                    tmp_index.train_y_min,
-                                    tmp_index.train_y_max,
-                                    tmp_index.min_err,
-                                    tmp_index.max_err)
-        del tmp_index
-        gc.collect()
-        tmp_dict[j] = abstract_index
+    def delete(self, point):
+        """
+        delete point
+        :param point: Point, delete the entries of point.index, or all the entries of x/y if None
+        :return: int, number of deleted entries
+        """
+        return self.delete_batch([point.lng], [point.lat], None if point.index is None else [point.index])
+
+    def delete_batch(self, x, y, positions=None):
+        """
+        delete x/y points in batch by marking their entries in tombstones, compact when the dead entries are too many
+        :param x: np.array
+        :param y: np.array
+        :param positions: np.array, key index of points, delete all the entries of x/y if None
+        :return: int, number of deleted entries
+        """
+        z_order = ZOrder()
+        zs = z_order.point_to_z_batch(x, y, self.region) / z_order.max_z
+        starts = np.searchsorted(self.index_keys, zs, side='left')
+        ends = np.searchsorted(self.index_keys, zs, side='right')
+        dead = [np.arange(start, end) for start, end in zip(starts, ends)]
+        if positions is not None:
+            dead = [entries[self.index_positions[entries] == position] for entries, position in zip(dead, positions)]
+        dead = np.concatenate(dead) if dead else np.empty(0, dtype=np.int64)
+        dead = np.unique(dead[~bitmap_get(self.tombstones, dead)])
+        bitmap_set(self.tombstones, dead)
+        self.dead_num += len(dead)
+        if self.dead_num > self.compaction_ratio * max(len(self.index_keys), 1):
+            self.compact()
+        return len(dead)
+
+    def compact(self):
+        """
+        remove the dead entries from index_keys and index_positions
+        1. drop the dead entries, the positions of alive entries move forward by the dead entries before them
+        2. retrain the leaf models which contain dead entries, drop the models of leaves without alive entries
+        3. shift the other leaf models by the dead entries before their cells
+        leaf cells are unchanged, so brin is kept, only the slices of leaf cells move forward by the dead entries
+        :return: None
+        """
+        if self.dead_num == 0:
+            return
+        # 1. drop the dead entries, the new arrays and models are assigned after training in case of failure
+        geohashes, borders, slices = self.leaf_cells()
+        alive = ~bitmap_to_mask(self.tombstones, len(self.index_keys))
+        removed_before = np.concatenate([[0], np.cumsum(~alive)])
+        index_keys = np.ascontiguousarray(self.index_keys[alive])
+        index_positions = np.ascontiguousarray(self.index_positions[alive])
+        new_slices = slices - removed_before[slices]
+        gm_dict = dict(self.gm_dict)
+        # 2. retrain the leaf models which contain dead entries
+        tasks = []
+        for geohash, (start, end), (new_start, new_end) in zip(geohashes, slices, new_slices):
+            # 没有数据的leaf没有模型，之前compact时可能已被去掉
+            if geohash not in gm_dict:
+                continue
+            removed = removed_before[end] - removed_before[start]
+            if removed > 0 and new_end > new_start:
+                tasks.append((geohash, self.get_model_path(1, geohash), index_keys[new_start:new_end],
+                              np.arange(new_start, new_end) / self.block_size))
+            elif removed > 0:
+                # 所有entry都已删除的leaf没有数据，去掉它的模型，否则scope会指向下一个leaf的slice
+                del gm_dict[geohash]
+            elif removed_before[start] > 0:
+                # 3. shift the other leaf models
+                gm_dict[geohash] = gm_dict[geohash].shift(-removed_before[start] / self.block_size)
+        telemetry = Telemetry(self.model_path + "models/telemetry.jsonl", index=self.name, stage=1)
+        gm_dict.update(train_leaves(tasks, self.model_type, self.get_train_args(), self.thread_pool_size,
+                                    self.model_path + "models/", telemetry, self.weight_dtype))
+        self.index_keys = index_keys
+        self.index_positions = index_positions
+        self.train_data_length = len(index_keys)
+        self.tombstones = bitmap_create(self.train_data_length)
+        self.dead_num = 0
+        self.cell_slices = new_slices
+        self.gm_dict = gm_dict
+
+    def get_model_path(self, i, j):
+        return self.model_path + "models/" + str(i) + "_" + str(j) + "_weights.best.hdf5"
+
+    def get_train_args(self):
+        return {'threshold': self.threshold,
+                'use_threshold': self.use_threshold,
+                'core': self.core,
+                'train_step': self.train_step,
+                'batch_size': self.batch_size,
+                'learning_rate': self.learning_rate,
+                'keep_ratio': self.keep_ratio,
+                'retrain_time_limit': self.retrain_time_limit}
+
+    def memory_usage(self):
+        """
+        bytes of every component
+        models: leaf models, keys: index keys and tombstones, positions: key indexes, tree_nodes: pages of brin and leaf cells
+        :return: dict, component name -> bytes, and total bytes
+        """
+        return memory_usage_of({'models': [self.gm_dict],
+                                'keys': [self.index_keys, self.tombstones],
+                                'positions': [self.index_positions],
+                                'tree_nodes': [self.brin, self.cell_geohashes, self.cell_borders, self.cell_z_borders,
+                                               self.cell_slices]})
 
     def save(self):
+        """
+        save gm index into binary index file
+        header: args of gm index, brin and models, sections: stacked arrays of models, index_keys and index_positions
+        :return: None
+        """
+        if os.path.exists(self.model_path) is False:
+            os.makedirs(self.model_path)
+        gm_keys = list(self.gm_dict.keys())
+        models_header, models_sections = models_to_sections('gm', [self.gm_dict[key] for key in gm_keys])
+        header = {'block_size': self.block_size,
+                  'region': self.region.__dict__,
+                  'max_num': self.max_num,
+                  'train_data_length': self.train_data_length,
+                  'train_args': {name: getattr(self, name) for name in TRAIN_ARG_NAMES},
+                  'brin': json.dumps(self.brin, cls=MyEncoder, ensure_ascii=False),
+                  'gm_keys': gm_keys,
+                  'gm_dict': models_header}
+        sections = {'index_keys': self.index_keys,
+                    'index_positions': self.index_positions,
+                    'tombstones': self.tombstones}
+        sections.update(models_sections)
+        save_index_file(self.model_path + 'gm_index.idx', header, sections)
+
+    def load(self):
+        """
+        load gm index from binary index file, arrays are memory-mapped without copy
+        :return: None
+        """
+        header, sections = load_index_file(self.model_path + 'gm_index.idx')
+        self.block_size = header['block_size']
+        self.region = Region.init_by_dict(header['region'])
+        self.max_num = header['max_num']
+        self.train_data_length = header['train_data_length']
+        for name, value in header.get('train_args', {}).items():
+            setattr(self, name, value)
+        self.brin = json.loads(header['brin'], cls=MyDecoder)
+        models = sections_to_models('gm', header['gm_dict'], sections, MODEL_CLASSES)
+        self.gm_dict = dict(zip(header['gm_keys'], models))
+        self.index_keys = sections['index_keys']
+        self.index_positions = sections['index_positions']
+        # 删除会修改tombstones，不能用只读的memmap
+        self.tombstones = np.array(sections.get('tombstones', bitmap_create(len(self.index_keys))), dtype=np.uint8)
+        self.dead_num = int(bitmap_to_mask(self.tombstones, len(self.index_keys)).sum())
+        self.init_leaf_cells()
+
+    def save_json(self):
         """
         save gm index into json file
         :return: None
         """
         if os.path.exists(self.model_path) is False:
             os.makedirs(self.model_path)
-        self.index_list.to_csv(self.model_path + 'index_list.csv', sep=',', header=True, index=False)
+        np.save(self.model_path + 'index_keys.npy', self.index_keys)
+        np.save(self.model_path + 'index_positions.npy', self.index_positions)
         with open(self.model_path + 'gm_index.json', "w") as f:
             json.dump(self, f, cls=MyEncoder, ensure_ascii=False)
 
-    def load(self):
+    def load_json(self):
         """
         load gm index from json file
         :return: None
@@ -148,8 +290,10 @@ class GeoHashModelIndex(SpatialIndex):
             self.train_data_length = gm_index.train_data_length
             self.brin = gm_index.brin
             self.gm_dict = gm_index.gm_dict
-            self.index_list = pd.read_csv(self.model_path + 'index_list.csv',
-                                          float_precision='round_trip')  # round_trip保留小数位数
+            self.index_keys = np.load(self.model_path + 'index_keys.npy', mmap_mode='r')
+            self.index_positions = np.load(self.model_path + 'index_positions.npy', mmap_mode='r')
+            self.tombstones = bitmap_create(len(self.index_keys))
+            self.init_leaf_cells()
             del gm_index
 
     @staticmethod
@@ -158,59 +302,395 @@ class GeoHashModelIndex(SpatialIndex):
                                  max_num=d['max_num'],
                                  train_data_length=d['train_data_length'],
                                  brin=d['brin'],
-                                 gm_dict=d['gm_dict'],
-                                 index_list=d['index_list'])
+                                 gm_dict=d['gm_dict'])
 
     def point_query(self, data: pd.DataFrame):
         """
-        query index by x/y point
+        query index by x/y point in batch
         1. compute z from x/y of points
         2. normalize z by z.min and z.max
         3. predict the leaf model by brin
-        4. predict by leaf model and create index scope [pre - min_err, pre + max_err]
-        5. binary search in scope
+        4. group points by leaf model, predict every group by one call of its model and create index scope
+           [pre - max_err, pre - min_err]
+        5. search all the scopes in batch by search_mode
         :param data: pd.DataFrame, [x, y]
-        :return: pd.DataFrame, [pre]
+        :return: pd.Series, [key index], nan if not found
         """
         z_order = ZOrder()
-        results = []
         # 1. compute z from x/y of points
         # 2. normalize z by z.min and z.max
-        z_values = data.apply(lambda t: z_order.point_to_z(t.x, t.y, self.region) / z_order.max_z, 1)
+        z_values = z_order.point_to_z_batch(data.x.values, data.y.values, self.region) / z_order.max_z
         # 3. predicted the leaf model by brin
-        leaf_model_indexes = self.brin.point_query(z_values)
-        for i in range(len(z_values)):
-            z = z_values[i]
-            leaf_model_index = leaf_model_indexes[i]
-            leaf_model = self.gm_dict[leaf_model_index]
-            # 4. predict by z and create index scope [pre - min_err, pre + max_err]
-            pre, min_err, max_err = leaf_model.predict(z)[0], leaf_model.min_err, leaf_model.max_err
-            left_bound = max((pre - max_err) * self.block_size, 0)
-            right_bound = min((pre - min_err) * self.block_size, self.train_data_length - 1)
-            # 4. binary search in scope
-            result = self.binary_search(self.index_list, z, int(round(left_bound)), int(round(right_bound)))
-            results.append(result)
+        ranges = self.brin.point_query_batch(z_values)
+        # 4. group points by leaf model and predict every group by one call
+        pres = np.full(len(z_values), np.nan)
+        min_errs = np.zeros(len(z_values))
+        max_errs = np.zeros(len(z_values))
+        for j, group in group_indexes(ranges):
+            leaf_model = self.gm_dict.get(self.brin.blknums[j]) if j >= 0 else None
+            if leaf_model is None:
+                continue
+            pres[group] = leaf_model.predict(z_values[group])
+            min_errs[group], max_errs[group] = leaf_model.min_err, leaf_model.max_err
+        # 5. search all the scopes in batch
+        predicted = ~np.isnan(pres)
+        zs, pres = z_values[predicted], pres[predicted]
+        left_bounds = np.rint(np.maximum((pres - max_errs[predicted]) * self.block_size, 0)).astype(np.int64)
+        right_bounds = np.rint(np.minimum((pres - min_errs[predicted]) * self.block_size,
+                                          self.train_data_length - 1)).astype(np.int64)
+        positions = self.search_batch(zs, pres * self.block_size, left_bounds, right_bounds)
+        found = (positions <= right_bounds) & \
+                (self.index_keys[np.minimum(positions, len(self.index_keys) - 1)] == zs)
+        if self.dead_num:
+            # 跳过key相同的已删除位置
+            alive_positions, alive_found = first_alive_batch(self.index_keys, self.tombstones,
+                                                             positions[found], zs[found])
+            positions[found] = alive_positions
+            found[found] = alive_found
+        results = np.full(len(z_values), np.nan)
+        results[np.flatnonzero(predicted)[found]] = self.index_positions[positions[found]]
         return pd.Series(results)
 
-    # TODO: 无法处理有重复的数组
-    def binary_search(self, nums, x, left, right):
+    def init_leaf_cells(self):
+        """
+        create the cells of leaf models from brin, the regions of geohashes are computed once here
+        :return: None
+        """
+        geohashes = []
+        z_borders = []
+        for regular_page in self.brin.regular_pages:
+            geohashes.extend(regular_page.blknums)
+            z_borders.extend(regular_page.values)
+        regions = [QuadTree.geohash_to_region(geohash, self.region) for geohash in geohashes]
+        self.cell_geohashes = geohashes
+        self.cell_borders = np.array([[region.bottom, region.up, region.left, region.right] for region in regions],
+                                     dtype=np.float64).reshape(-1, 4)
+        self.cell_z_borders = np.array(z_borders, dtype=np.float64).reshape(-1, 2)
+        self.update_cell_slices()
+
+    def update_cell_slices(self):
         """
-        binary search x in nums[left, right]
-        :param nums: pd.DataFrame, [key, key_index], index table
-        :param x: key
-        :param left:
-        :param right:
-        :return: key index
+        search the slices of leaf cells in index_keys by their z borders, after index_keys are changed
+        :return: None
         """
-        while left <= right:
-            mid = (left + right) // 2
-            if nums.iloc[mid].key == x:
-                return nums.iloc[mid].key_index
-            if nums.iloc[mid].key < x:
-                left = mid + 1
-            else:
-                right = mid - 1
-        return None
+        if self.cell_z_borders is None:
+            return
+        self.cell_slices = np.stack([np.searchsorted(self.index_keys, self.cell_z_borders[:, 0], side='left'),
+                                     np.searchsorted(self.index_keys, self.cell_z_borders[:, 1], side='right')],
+                                    axis=1)
+
+    def leaf_cells(self):
+        """
+        get the cells of leaf models, created from brin at the first time if not built or loaded
+        :return: list of geohash, np.array of [bottom, up, left, right] and np.array of [start, end) in index_keys
+        """
+        if self.cell_slices is None:
+            self.init_leaf_cells()
+        return self.cell_geohashes, self.cell_borders, self.cell_slices
+
+    def lower_bound_in_cells(self, keys, cells, geohashes, slices):
+        """
+        lower bounds of keys in the slices of their leaf cells
+        1. group keys by cell, predict every group by one call of its leaf model
+        2. search the scopes [pre - max_err, pre - min_err] clipped to the slices in batch by search_mode
+        3. keys out of the training data of leaf model may be out of scope, search them in the whole slice
+        :param keys: np.array, normalized z
+        :param cells: np.array of int, cell of every key in geohashes and slices
+        :param geohashes: list of geohash, by leaf_cells
+        :param slices: np.array of [start, end) in index_keys, by leaf_cells
+        :return: np.array of int, position of the first key >= key in [start, end] of the slice
+        """
+        starts, ends = slices[cells, 0], slices[cells, 1]
+        # 1. predict every group by one call of its leaf model
+        pres = np.full(len(keys), np.nan)
+        min_errs = np.zeros(len(keys))
+        max_errs = np.zeros(len(keys))
+        for j, group in group_indexes(cells):
+            leaf_model = self.gm_dict.get(geohashes[j])
+            if leaf_model is None:
+                continue
+            pres[group] = leaf_model.predict(keys[group])
+            min_errs[group], max_errs[group] = leaf_model.min_err, leaf_model.max_err
+        # 2. search the scopes clipped to the slices in batch, the whole slice if the model is empty
+        predicted = ~np.isnan(pres)
+        pres = np.where(predicted, pres * self.block_size, starts)
+        left_bounds = np.where(predicted, np.rint(pres - max_errs * self.block_size), starts)
+        right_bounds = np.where(predicted, np.rint(pres - min_errs * self.block_size), ends - 1)
+        left_bounds = np.clip(left_bounds, starts, ends - 1).astype(np.int64)
+        right_bounds = np.clip(right_bounds, starts, ends - 1).astype(np.int64)
+        positions = np.clip(self.search_batch(keys, pres, left_bounds, right_bounds), starts, ends)
+        # 3. search the keys out of scope in the whole slice
+        last = len(self.index_keys) - 1
+        exact = ((positions == starts) | (self.index_keys[np.clip(positions - 1, 0, last)] < keys)) & \
+                ((positions == ends) | (self.index_keys[np.minimum(positions, last)] >= keys))
+        for i in np.flatnonzero(~exact):
+            positions[i] = starts[i] + np.searchsorted(self.index_keys[starts[i]:ends[i]], keys[i], side='left')
+        return positions
+
+    def range_query(self, data: pd.DataFrame):
+        """
+        query index by x1/y1/x2/y2 range
+        :param data: pd.DataFrame, [x1, y1, x2, y2], left-bottom and right-up corners of windows
+        :return: pd.Series, [np.array of key index in window]
+        """
+        return pd.Series(self.range_query_batch(data.x1.values, data.y1.values, data.x2.values, data.y2.values))
+
+    def range_query_batch(self, x1, y1, x2, y2):
+        """
+        query index by x1/y1/x2/y2 ranges in batch
+        :param x1: np.array, left of windows
+        :param y1: np.array, bottom of windows
+        :param x2: np.array, right of windows
+        :param y2: np.array, up of windows
+        :return: list of np.array, key index of points in every window, sorted by z
+        """
+        return [self.index_positions[positions] for positions in self.range_search_batch(x1, y1, x2, y2)]
+
+    def range_search_batch(self, x1, y1, x2, y2):
+        """
+        search positions of index_keys in x1/y1/x2/y2 ranges in batch
+        1. select the leaf cells whose xy_border intersects the window
+        2. all the points of the cells contained in window are in window, without filtering
+        3. the cells partially covered: search the slice [lower bound of z_min, lower bound of z_max + 1) of window
+           in the cell by its leaf model, the slices of all the windows are searched in one batch,
+           then filter the points of slices by the cells of window
+        4. skip the dead entries
+        :return: list of np.array, positions of index_keys in every window
+        """
+        z_order = ZOrder()
+        geohashes, borders, slices = self.leaf_cells()
+        boxes = []
+        partials = []
+        results = [[] for i in range(len(x1))]
+        for i in range(len(x1)):
+            box = z_order.window_to_box(Region(y1[i], y2[i], x1[i], x2[i]), self.region)
+            boxes.append(box)
+            if box is None:
+                continue
+            # 1. select the leaf cells whose xy_border intersects the window
+            cells = np.flatnonzero((borders[:, 0] <= y2[i]) & (borders[:, 1] >= y1[i]) &
+                                   (borders[:, 2] <= x2[i]) & (borders[:, 3] >= x1[i]) &
+                                   (slices[:, 1] > slices[:, 0]))
+            contained = (borders[cells, 0] >= y1[i]) & (borders[cells, 1] <= y2[i]) & \
+                        (borders[cells, 2] >= x1[i]) & (borders[cells, 3] <= x2[i])
+            # 2. all the points of the cells contained in window
+            for cell in cells[contained]:
+                results[i].append(np.arange(slices[cell, 0], slices[cell, 1]))
+            partials.extend([i, cell] for cell in cells[~contained])
+        # 3. search the slices of window in the cells partially covered in one batch
+        partials = np.array(partials, dtype=np.int64).reshape(-1, 2)
+        z_mins = np.array([0 if box is None else z_order.morton.pack(box[0], box[1]) for box in boxes],
+                          dtype=np.int64)
+        z_maxs = np.array([0 if box is None else z_order.morton.pack(box[2], box[3]) for box in boxes],
+                          dtype=np.int64)
+        keys = np.concatenate([z_mins[partials[:, 0]], z_maxs[partials[:, 0]] + 1]) / z_order.max_z
+        positions = self.lower_bound_in_cells(keys, np.concatenate([partials[:, 1], partials[:, 1]]),
+                                              geohashes, slices)
+        for (i, cell), start, end in zip(partials, positions[:len(partials)], positions[len(partials):]):
+            if start >= end:
+                continue
+            zs = np.rint(self.index_keys[start:end] * z_order.max_z)
+            results[i].append(np.arange(start, end)[z_order.z_in_box_batch(zs, boxes[i])])
+        # 4. skip the dead entries, slices of cells may overlap at the borders
+        for i in range(len(results)):
+            positions = np.unique(np.concatenate(results[i])) if results[i] else np.empty(0, dtype=np.int64)
+            if self.dead_num:
+                positions = positions[~bitmap_get(self.tombstones, positions)]
+            results[i] = positions
+        return results
+
+    def polygon_query(self, polygons):
+        """
+        query index by polygons
+        1. range search the bounding box of every polygon
+        2. filter the points in box by polygon, point is the center of the cell of z
+        :param polygons: list of np.array of [x, y] vertices
+        :return: pd.Series, [np.array of key index in polygon]
+        """
+        z_order = ZOrder()
+        polygons = [np.asarray(polygon, dtype=np.float64).reshape(-1, 2) for polygon in polygons]
+        bboxes = np.array([[polygon[:, 0].min(), polygon[:, 1].min(), polygon[:, 0].max(), polygon[:, 1].max()]
+                           for polygon in polygons], dtype=np.float64).reshape(-1, 4)
+        # 1. range search the bounding box of every polygon
+        candidates = self.range_search_batch(bboxes[:, 0], bboxes[:, 1], bboxes[:, 2], bboxes[:, 3])
+        # 2. filter the points in box by polygon
+        results = []
+        for positions, polygon in zip(candidates, polygons):
+            lngs, lats = z_order.z_to_point_batch(np.rint(self.index_keys[positions] * z_order.max_z), self.region,
+                                                  center=True)
+            results.append(self.index_positions[positions[points_in_polygon(lngs, lats, polygon)]])
+        return pd.Series(results)
+
+    def knn_query(self, data: pd.DataFrame, k):
+        """
+        query index by x/y point and k
+        :param data: pd.DataFrame, [x, y]
+        :param k: int
+        :return: pd.Series, [np.array of key index of k nearest points]
+        """
+        results, distances, candidates = self.knn_query_batch(data.x.values, data.y.values, k)
+        return pd.Series([result[~np.isnan(result)] for result in results])
+
+    def knn_query_batch(self, x, y, k):
+        """
+        query index by x/y points and k in batch, points are searched in chunks to bound the distance matrix
+        of points and leaf cells
+        distance is computed between x/y and the center of the cell of z
+        :param x: np.array
+        :param y: np.array
+        :param k: int
+        :return: np.array of key index, shape = [len(x), k], nan for missing neighbours
+                 np.array of distance, shape = [len(x), k], inf for missing neighbours
+                 np.array of int, candidates examined for every point
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        results = np.full((len(x), k), np.nan)
+        distances = np.full((len(x), k), np.inf)
+        candidates = np.zeros(len(x), dtype=np.int64)
+        # 每块的距离矩阵不超过4M个元素
+        step = max(4000000 // max(len(self.leaf_cells()[0]), 1), 1)
+        for start in range(0, len(x), step):
+            end = min(start + step, len(x))
+            results[start:end], distances[start:end], candidates[start:end] = \
+                self.knn_search_batch(x[start:end], y[start:end], k)
+        return results, distances, candidates
+
+    def knn_search_batch(self, x, y, k):
+        """
+        knn_query_batch of one chunk
+        1. sort the cells of leaf models by the distance to every point, search the lower bound of z of every point
+           in its nearest cell, the k-th nearest distance of the 2k keys around it is the first radius
+        2. search the windows [x - r, x + r] * [y - r, y + r] of all the unfinished points in one batch:
+           in every cell nearer than r, search the slice [lower bound of z_min, lower bound of z_max + 1) of window
+           by its leaf model, and filter the points of slices by the cells of window
+        3. the result is provably nearest when the k-th nearest distance in window <= r,
+           otherwise enlarge r to the k-th nearest distance, or double it if less than k points in window
+        """
+        z_order = ZOrder()
+        geohashes, borders, slices = self.leaf_cells()
+        results = np.full((len(x), k), np.nan)
+        distances = np.full((len(x), k), np.inf)
+        candidates = np.zeros(len(x), dtype=np.int64)
+        if len(self.index_keys) == 0 or len(x) == 0:
+            return results, distances, candidates
+        max_num = 1 << z_order.bits
+        min_radius = max(self.region.right - self.region.left, self.region.up - self.region.bottom) / max_num
+        # 1. sort the cells by the distance to every point
+        dx = np.maximum(np.maximum(borders[:, 2] - x[:, np.newaxis], x[:, np.newaxis] - borders[:, 3]), 0)
+        dy = np.maximum(np.maximum(borders[:, 0] - y[:, np.newaxis], y[:, np.newaxis] - borders[:, 1]), 0)
+        cell_distances = np.sqrt(dx * dx + dy * dy)
+        cell_orders = np.argsort(cell_distances, axis=1, kind='stable')
+        cell_distances = np.take_along_axis(cell_distances, cell_orders, axis=1)
+        # the k-th nearest distance of the 2k keys around the lower bound in the nearest cell is the first radius
+        zs = z_order.pack_batch(self.zoom_clip(x, self.region.left, self.region.right, max_num),
+                                self.zoom_clip(y, self.region.bottom, self.region.up, max_num)) / z_order.max_z
+        nearest = cell_orders[:, 0]
+        starts, ends = slices[nearest, 0], slices[nearest, 1]
+        lower_bounds = self.lower_bound_in_cells(zs, nearest, geohashes, slices)
+        seeds = np.clip(lower_bounds - k, starts, np.maximum(ends - 2 * k, starts))[:, np.newaxis] + np.arange(2 * k)
+        seed_distances = self.knn_distances(np.minimum(seeds, len(self.index_keys) - 1), x[:, np.newaxis],
+                                            y[:, np.newaxis])
+        seed_distances[seeds >= ends[:, np.newaxis]] = np.inf
+        if self.dead_num:
+            seed_distances[bitmap_get(self.tombstones, np.minimum(seeds, len(self.index_keys) - 1))] = np.inf
+        radiuses = np.partition(seed_distances, k - 1, axis=1)[:, k - 1]
+        # cell中不足k个key时，从覆盖整个cell的半径开始
+        cell_sizes = np.maximum(borders[nearest, 1] - borders[nearest, 0], borders[nearest, 3] - borders[nearest, 2])
+        radiuses = np.where(np.isinf(radiuses), cell_distances[:, 0] + cell_sizes, radiuses)
+        radiuses = np.maximum(radiuses, min_radius)
+        # 2. search the windows of all the unfinished points in one batch
+        unfinished = np.arange(len(x))
+        while len(unfinished):
+            r = radiuses[unfinished]
+            px, py = x[unfinished], y[unfinished]
+            boxes = np.stack([self.zoom_clip(px - r, self.region.left, self.region.right, max_num),
+                              self.zoom_clip(py - r, self.region.bottom, self.region.up, max_num),
+                              self.zoom_clip(px + r, self.region.left, self.region.right, max_num),
+                              self.zoom_clip(py + r, self.region.bottom, self.region.up, max_num)], axis=1)
+            # the cells nearer than r of every window
+            cell_counts = (cell_distances[unfinished] <= r[:, np.newaxis]).sum(axis=1)
+            windows = np.repeat(np.arange(len(unfinished)), cell_counts)
+            cell_ranks = np.arange(cell_counts.sum()) - np.repeat(np.cumsum(cell_counts) - cell_counts, cell_counts)
+            cells = cell_orders[unfinished[windows], cell_ranks]
+            z_mins = z_order.pack_batch(boxes[windows, 0], boxes[windows, 1])
+            z_maxs = z_order.pack_batch(boxes[windows, 2], boxes[windows, 3])
+            bounds = self.lower_bound_in_cells(np.concatenate([z_mins, z_maxs + 1]) / z_order.max_z,
+                                               np.concatenate([cells, cells]), geohashes, slices)
+            starts, ends = bounds[:len(cells)], bounds[len(cells):]
+            # expand the slices of all the windows into one array, and filter them by the cells of window
+            lengths = np.maximum(ends - starts, 0)
+            windows = np.repeat(windows, lengths)
+            positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + \
+                        np.repeat(starts, lengths)
+            candidates[unfinished] += np.bincount(windows, minlength=len(unfinished))
+            keep = z_order.z_in_box_batch(np.rint(self.index_keys[positions] * z_order.max_z), boxes[windows].T)
+            if self.dead_num:
+                keep &= ~bitmap_get(self.tombstones, positions)
+            windows, positions = windows[keep], positions[keep]
+            point_distances = self.knn_distances(positions, px[windows], py[windows])
+            # 按window和距离排序，每个window的前k个为它的k近邻
+            order = np.lexsort((point_distances, windows))
+            windows, positions, point_distances = windows[order], positions[order], point_distances[order]
+            counts = np.bincount(windows, minlength=len(unfinished))
+            firsts = np.cumsum(counts) - counts
+            ranks = np.arange(len(windows)) - firsts[windows]
+            kth_distances = np.full(len(unfinished), np.inf)
+            full = counts >= k
+            kth_distances[full] = point_distances[firsts[full] + k - 1]
+            # 3. the result is provably nearest when the k-th nearest distance in window <= r,
+            # or when the window covers the whole region
+            covered = (boxes[:, 0] == 0) & (boxes[:, 1] == 0) & (boxes[:, 2] == max_num - 1) & \
+                      (boxes[:, 3] == max_num - 1) & (cell_counts == len(borders))
+            finished = (full & (kth_distances <= r)) | covered
+            keep = (ranks < k) & finished[windows]
+            results[unfinished[windows[keep]], ranks[keep]] = self.index_positions[positions[keep]]
+            distances[unfinished[windows[keep]], ranks[keep]] = point_distances[keep]
+            radiuses[unfinished[full]] = kth_distances[full]
+            radiuses[unfinished[~full]] = r[~full] * 2
+            unfinished = unfinished[~finished]
+        return results, distances, candidates
+
+    def knn_distances(self, positions, x, y):
+        """
+        distances between x/y and the cell centers of index_keys[positions]
+        """
+        z_order = ZOrder()
+        zs = np.rint(self.index_keys[positions] * z_order.max_z)
+        lngs, lats = z_order.z_to_point_batch(zs, self.region, center=True)
+        return np.sqrt((lngs - x) ** 2 + (lats - y) ** 2)
+
+    @staticmethod
+    def zoom_clip(values, lower, upper, max_num):
+        """
+        zoom values into the cells of [0, max_num) like ZOrder.zoom_batch, values out of region are clipped
+        """
+        zoom = np.floor((np.asarray(values, dtype=np.float64) - lower) * max_num / (upper - lower))
+        return np.clip(zoom, 0, max_num - 1).astype(np.uint64)
+
+    def search_batch(self, keys, pres, left_bounds, right_bounds):
+        """
+        search the lower bounds of keys in index scopes by search_mode, and count the probes into search_stats
+        binary: binary search in the whole scope [pre - max_err, pre - min_err]
+        exponential: gallop from pre, the scope only bounds the steps
+        :param keys: np.array, normalized z
+        :param pres: np.array, predicted positions
+        :param left_bounds: np.array of int
+        :param right_bounds: np.array of int
+        :return: np.array of int, position of the first key >= key in scope, right bound + 1 if not found
+        """
+        if self.search_mode == 'binary':
+            positions, probes = binary_search_batch(self.index_keys, keys, left_bounds, right_bounds)
+        elif self.search_mode == 'exponential':
+            positions, probes = exponential_search_batch(self.index_keys, keys, pres, left_bounds, right_bounds)
+        else:
+            raise ValueError("unknown search mode: %s" % self.search_mode)
+        self.search_stats['searches'] += len(keys)
+        self.search_stats['probes'] += int(probes.sum())
+        return positions
+
+    def reset_search_stats(self):
+        self.search_stats = {'searches': 0, 'probes': 0}
 
 
 class MyEncoder(json.JSONEncoder):
@@ -226,11 +706,14 @@ class MyEncoder(json.JSONEncoder):
         elif isinstance(obj, Region):
             return obj.__dict__
         elif isinstance(obj, GeoHashModelIndex):
-            return obj.__dict__
-        elif isinstance(obj, AbstractNN):
-            return obj.__dict__
+            # index_keys和index_positions单独保存为npy
+            return {key: value for key, value in obj.__dict__.items()
+                    if key not in ['index_keys', 'index_positions', 'tombstones', 'cell_geohashes', 'cell_borders',
+                                   'cell_z_borders', 'cell_slices']}
+        elif isinstance(obj, (AbstractNN, LinearModel, PiecewiseLinearModel, RadixSpline)):
+            return obj.to_dict()
         elif isinstance(obj, BRIN):
-            return obj.__dict__
+            return obj.to_dict()
         elif isinstance(obj, MetaPage):
             return obj.__dict__
         elif isinstance(obj, RevMapPage):
@@ -246,10 +729,18 @@ class MyDecoder(json.JSONDecoder):
         json.JSONDecoder.__init__(self, object_hook=self.dict_to_object)
 
     def dict_to_object(self, d):
-        if len(d.keys()) == 8 and d.__contains__("weights") and d.__contains__("core_nums") \
+        if len(d.keys()) in [8, 10] and d.__contains__("weights") and d.__contains__("core_nums") \
                 and d.__contains__("input_min") and d.__contains__("input_max") and d.__contains__("output_min") \
                 and d.__contains__("output_max") and d.__contains__("min_err") and d.__contains__("max_err"):
             t = AbstractNN.init_by_dict(d)
+        elif len(d.keys()) == 4 and d.__contains__("slope") and d.__contains__("intercept"):
+            t = LinearModel.init_by_dict(d)
+        elif len(d.keys()) == 5 and d.__contains__("keys") and d.__contains__("intercepts") \
+                and d.__contains__("slopes"):
+            t = PiecewiseLinearModel.init_by_dict(d)
+        elif len(d.keys()) == 8 and d.__contains__("knot_keys") and d.__contains__("knot_labels") \
+                and d.__contains__("table"):
+            t = RadixSpline.init_by_dict(d)
         elif len(d.keys()) == 4 and d.__contains__("bottom") and d.__contains__("up") \
                 and d.__contains__("left") and d.__contains__("right"):
             t = Region.init_by_dict(d)
@@ -264,7 +755,7 @@ class MyDecoder(json.JSONDecoder):
                 "blknums") and d.__contains__("attnums") and d.__contains__("allnulls") and d.__contains__(
             "hasnulls") and d.__contains__("placeholders") and d.__contains__("values"):
             t = RegularPage.init_by_dict(d)
-        elif len(d.keys()) == 7 and d.__contains__("version") and d.__contains__("pages_per_range") \
+        elif len(d.keys()) in [7, 9] and d.__contains__("version") and d.__contains__("pages_per_range") \
                 and d.__contains__("revmap_page_maxitems") and d.__contains__(
             "regular_page_maxitems") and d.__contains__("meta_page") and d.__contains__(
             "revmap_pages") and d.__contains__("regular_pages"):
@@ -303,4 +794,7 @@ if __name__ == '__main__':
     search_time = (end_time - start_time) / len(train_set_xy)
     print("Search time ", search_time)
     print("Not found nums ", result.isna().sum())
+    memory_usage = index.memory_usage()
+    print("Memory ", memory_usage)
+    print("Bytes per key ", memory_usage['total'] / len(train_set_xy))
     print("*************end %s************" % index_name)
@@ -0,0 +1,131 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+# 文件结构：magic(8B) | version(uint32) | header长度(uint32) | header(json) | 对齐 | sections
+# header记录index参数和每个section的dtype/shape/offset，sections是连续存放的ndarray，加载时用np.memmap直接映射
+MAGIC = b'STLIDX\x00\x00'
+VERSION = 1
+ALIGNMENT = 64
+PREFIX = struct.Struct('<8sII')
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_index_file(path, header: dict, sections: dict):
+    """
+    save header and sections into binary index file
+    :param path: file path
+    :param header: dict, can be dumped by json
+    :param sections: dict, name -> np.array
+    :return: None
+    """
+    sections = {name: np.ascontiguousarray(section) for name, section in sections.items()}
+    layout = {}
+    offset = 0
+    for name, section in sections.items():
+        layout[name] = {'dtype': section.dtype.str, 'shape': list(section.shape), 'offset': offset}
+        offset = align(offset + section.nbytes)
+    header_bytes = json.dumps({'header': header, 'sections': layout}, ensure_ascii=False).encode('utf-8')
+    data_start = align(PREFIX.size + len(header_bytes))
+    # 先写临时文件再替换，sections可能是path本身的memmap，直接截断path会让映射失效
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(PREFIX.pack(MAGIC, VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, section in sections.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(section.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def load_index_file(path):
+    """
+    load header and sections from binary index file, sections are mapped by np.memmap without copy
+    :param path: file path
+    :return: header dict, sections dict of name -> read-only np.array
+    """
+    with open(path, 'rb') as f:
+        magic, version, header_length = PREFIX.unpack(f.read(PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not an index file" % path)
+        if version > VERSION:
+            raise ValueError("index file version %d is newer than supported version %d" % (version, VERSION))
+        content = json.loads(f.read(header_length).decode('utf-8'))
+    data_start = align(PREFIX.size + header_length)
+    buffer = np.memmap(path, dtype=np.uint8, mode='r') if os.path.getsize(path) > data_start else None
+    sections = {}
+    for name, layout in content['sections'].items():
+        dtype = np.dtype(layout['dtype'])
+        shape = tuple(layout['shape'])
+        start = data_start + layout['offset']
+        end = start + dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+        if start == end:
+            sections[name] = np.empty(shape, dtype=dtype)
+        else:
+            sections[name] = buffer[start:end].view(dtype).reshape(shape)
+    return content['header'], sections
+
+
+def models_to_sections(prefix, models):
+    """
+    stack the arrays of models into sections, one section for every field, other fields are kept in header
+    :param prefix: name prefix of sections
+    :param models: list of model or None, model.to_dict() returns the args of model.init_by_dict
+    :return: list of model header (None for missing model), dict of sections
+    """
+    headers = []
+    fields = {}
+    for model in models:
+        if model is None:
+            headers.append(None)
+            continue
+        header = {'type': type(model).__name__, 'values': {}, 'arrays': {}, 'lists': {}}
+        for key, value in model.to_dict().items():
+            if isinstance(value, list) and len(value) > 0 and all(isinstance(v, np.ndarray) for v in value):
+                header['lists'][key] = len(value)
+                arrays = {'%s.%d' % (key, i): v for i, v in enumerate(value)}
+            elif isinstance(value, np.ndarray):
+                arrays = {key: value}
+            else:
+                header['values'][key] = value.item() if isinstance(value, np.generic) else value
+                continue
+            for name, array in arrays.items():
+                field = fields.setdefault(name, [])
+                offset = sum(len(a) for a in field)
+                field.append(array.reshape(-1))
+                header['arrays'][name] = [offset, list(array.shape)]
+        headers.append(header)
+    sections = {'%s.%s' % (prefix, name): np.concatenate(field) for name, field in fields.items()}
+    return headers, sections
+
+
+def sections_to_models(prefix, headers, sections, model_classes):
+    """
+    create models from header and stacked sections, arrays of models are views of sections
+    :param prefix: name prefix of sections
+    :param headers: list of model header created by models_to_sections
+    :param sections: dict of sections
+    :param model_classes: dict, class name -> model class with init_by_dict
+    :return: list of model or None
+    """
+    models = []
+    for header in headers:
+        if header is None:
+            models.append(None)
+            continue
+        d = dict(header['values'])
+        arrays = {}
+        for name, (offset, shape) in header['arrays'].items():
+            size = int(np.prod(shape, dtype=np.int64))
+            arrays[name] = sections['%s.%s' % (prefix, name)][offset:offset + size].reshape(shape)
+        for key, length in header['lists'].items():
+            d[key] = [arrays.pop('%s.%d' % (key, i)) for i in range(length)]
+        d.update(arrays)
+        models.append(model_classes[header['type']].init_by_dict(d))
+    return models
@@ -0,0 +1,200 @@
+import gc
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from src.rmi_keras import TrainedNN, AbstractNN, ModelCache
+from src.rmi_linear import LinearModel, PiecewiseLinearModel, RadixSpline, train_model
+
+MODEL_CLASSES = {'AbstractNN': AbstractNN, 'LinearModel': LinearModel,
+                 'PiecewiseLinearModel': PiecewiseLinearModel, 'RadixSpline': RadixSpline}
+
+# 进程池按进程数缓存，多次build复用，spawn上下文解决CUDA_ERROR_NOT_INITIALIZED报错且不修改全局start method
+executors = {}
+
+
+def get_executor(processes):
+    """
+    get the process pool of processes workers, create it at the first time
+    :param processes: worker nums
+    :return: ProcessPoolExecutor
+    """
+    executor = executors.get(processes)
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+        executors[processes] = executor
+    return executor
+
+
+def shutdown_executors():
+    for executor in executors.values():
+        executor.shutdown()
+    executors.clear()
+
+
+def build_model(model_type, inputs, labels, model_path, threshold, use_threshold, core, train_step, batch_size,
+                learning_rate, keep_ratio, retrain_time_limit):
+    """
+    train one model by model_type
+    nn: train keras network by TrainedNN and extract weights into AbstractNN
+    linear/pla/radix_spline: train closed-form model, error = threshold / 2
+    :return: model and its telemetry record
+    """
+    start_time = time.time()
+    if model_type != 'nn':
+        model = train_model(model_type, inputs, labels, threshold / 2)
+        return model, get_record(model_type, model, len(labels), 0, 0, time.time() - start_time)
+    tmp_index = TrainedNN(model_path, inputs, labels,
+                          threshold,
+                          use_threshold,
+                          core,
+                          train_step,
+                          batch_size,
+                          learning_rate,
+                          keep_ratio,
+                          retrain_time_limit)
+    tmp_index.train()
+    # get parameters in model (weight matrix and bias matrix)
+    abstract_index = AbstractNN(tmp_index.get_weights(),
+                                core,
+                                tmp_index.train_x_min,
+                                tmp_index.train_x_max,
+                                tmp_index.train_y_min,
+                                tmp_index.train_y_max,
+                                tmp_index.min_err,
+                                tmp_index.max_err)
+    record = get_record(model_type, abstract_index, len(labels), tmp_index.epochs, tmp_index.retrain_times,
+                        time.time() - start_time)
+    del tmp_index
+    gc.collect()
+    return abstract_index, record
+
+
+def get_record(model_type, model, key_num, epochs, retrains, wall_time, cached=False):
+    return {'model_type': model_type,
+            'keys': key_num,
+            'epochs': epochs,
+            'retrains': retrains,
+            'wall_time': wall_time,
+            'min_err': float(model.min_err),
+            'max_err': float(model.max_err),
+            'window': float(model.max_err - model.min_err),
+            'cached': cached}
+
+
+def build_model_from_shared_memory(shared_arrays, start, end, model_type, model_path, train_args):
+    """
+    worker of train_leaves: read keys[start:end] and labels[start:end] from shared memory and train the model
+    :param shared_arrays: list of (shared memory name, dtype, length) of keys and labels
+    :return: class name and to_dict() of the model, the weights are compact np.array, and the telemetry record
+    """
+    arrays = []
+    for name, dtype, length in shared_arrays:
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            arrays.append(np.ndarray((length,), dtype=dtype, buffer=shm.buf)[start:end].copy())
+        finally:
+            shm.close()
+    model, record = build_model(model_type, arrays[0], arrays[1], model_path, **train_args)
+    return type(model).__name__, model.to_dict(), record
+
+
+def train_leaves(tasks, model_type, train_args, processes, cache_dir=None, telemetry=None, weight_dtype='float64'):
+    """
+    train leaf models in process pool
+    1. nn models are loaded from the model cache if the keys, relative labels and args are not changed,
+       the index of model cache is loaded once
+    2. train the others in process pool and put them into the model cache
+    3. quantize the weights of nn models and recompute their error bounds, the model cache keeps float64 weights
+    4. write the telemetry records of all the models
+    :param tasks: list of (leaf key, model path, inputs, labels), empty leaves are skipped
+    :param model_type: nn/linear/pla/radix_spline
+    :param train_args: dict of the other args of build_model
+    :param processes: worker nums
+    :param cache_dir: dir of model cache, None to disable the cache
+    :param telemetry: Telemetry, None to disable the records
+    :param weight_dtype: float64/float16/int8, dtype of the weights of nn models
+    :return: dict of leaf key -> model
+    """
+    tasks = [task for task in tasks if task[3] is not None and len(task[3]) > 0]
+    models = {}
+    records = {}
+    # 1. nn models are loaded from the model cache, closed-form models are not cached
+    cache = ModelCache(cache_dir) if cache_dir is not None and model_type == 'nn' else None
+    if cache is not None:
+        cache_keys = {task[0]: ModelCache.get_key(task[2], task[3], train_args['core'], train_args)
+                      for task in tasks}
+        cache_index = cache.load_index()
+        for key, model_path, inputs, labels in tasks:
+            start_time = time.time()
+            model = cache.get(cache_keys[key], float(labels[0]), cache_index)
+            if model is not None:
+                models[key] = model
+                records[key] = get_record(model_type, model, len(labels), 0, 0, time.time() - start_time, True)
+    # 2. train the others in process pool and put them into the model cache
+    untrained_tasks = [task for task in tasks if task[0] not in models]
+    # 闭式模型训练只需毫秒，直接在当前进程训练
+    results = train_models(untrained_tasks, model_type, train_args, 1 if model_type != 'nn' else processes)
+    for key, (model, record) in results.items():
+        models[key] = model
+        records[key] = record
+    if cache is not None:
+        labels = {task[0]: task[3] for task in untrained_tasks}
+        cache.put_all({cache_keys[key]: (models[key], float(labels[key][0])) for key in results})
+    # 3. quantize the weights of nn models
+    if model_type == 'nn' and weight_dtype != 'float64':
+        for key, model_path, inputs, labels in tasks:
+            model = models[key].quantize(weight_dtype, inputs, labels)
+            models[key] = model
+            records[key] = dict(records[key], min_err=model.min_err, max_err=model.max_err,
+                                window=model.max_err - model.min_err)
+    # 4. write the telemetry records of all the models
+    if telemetry is not None:
+        telemetry.write([dict(record, leaf=key) for key, record in records.items()])
+    return models
+
+
+def train_models(tasks, model_type, train_args, processes):
+    """
+    train models in process pool
+    1. copy the keys and labels of all the leaves into one shared memory block, workers read their slices from it
+    2. submit leaves largest-first to balance the load of workers
+    :param tasks: list of (leaf key, model path, inputs, labels)
+    :return: dict of leaf key -> (model, telemetry record)
+    """
+    if processes <= 1 or len(tasks) <= 1:
+        return {key: build_model(model_type, inputs, labels, model_path, **train_args)
+                for key, model_path, inputs, labels in tasks}
+    # 1. copy the keys and labels of all the leaves into one shared memory block
+    offsets = np.cumsum([0] + [len(task[3]) for task in tasks])
+    shms = []
+    shared_arrays = []
+    futures = {}
+    try:
+        for column in [2, 3]:
+            array = np.concatenate([np.asarray(task[column], dtype=np.float64) for task in tasks])
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shms.append(shm)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+            shared_arrays.append((shm.name, array.dtype.str, len(array)))
+        # 2. submit leaves largest-first
+        executor = get_executor(processes)
+        order = sorted(range(len(tasks)), key=lambda i: offsets[i + 1] - offsets[i], reverse=True)
+        futures = {tasks[i][0]: executor.submit(build_model_from_shared_memory, shared_arrays,
+                                                int(offsets[i]), int(offsets[i + 1]),
+                                                model_type, tasks[i][1], train_args)
+                   for i in order}
+        results = {}
+        for key, future in futures.items():
+            class_name, d, record = future.result()
+            results[key] = (MODEL_CLASSES[class_name].init_by_dict(d), record)
+        return results
+    finally:
+        # worker出错时也要等其他worker结束才能释放shared memory
+        wait(futures.values())
+        for shm in shms:
+            shm.close()
+            shm.unlink()
@@ -1,13 +1,15 @@
+import heapq
 import os
 import sys
 import time
 
+import numpy as np
 import pandas as pd
 from memory_profiler import profile
 
 sys.path.append('D:/Code/Paper/st-learned-index')
 from src.index import Index
-from src.spatial_index.common_utils import Region, Point
+from src.spatial_index.common_utils import Region, Point, memory_usage_of
 
 MAX_ELE_NUM = 100
 
@@ -203,6 +205,106 @@ class QuadTree(Index):
             self.geohash(node.LU, parent_geohash + "10")
             self.geohash(node.RU, parent_geohash + "11")
 
+    def memory_usage(self):
+        """
+        bytes of every component, keys: points in leaf nodes, tree_nodes: nodes and geohash map
+        :return: dict, component name -> bytes, and total bytes
+        """
+        items = []
+        nodes = [self.root_node]
+        while nodes:
+            node = nodes.pop()
+            if node.is_leaf == 1:
+                items.append(node.items)
+            else:
+                nodes.extend([node.LB, node.RB, node.LU, node.RU])
+        return memory_usage_of({'keys': items,
+                                'tree_nodes': [self.root_node, self.geohash_items_map]})
+
+    @staticmethod
+    def geohash_to_region(geohash, region):
+        """
+        get region of node by geohash, every 2 bits split lat and lng: 00 LB, 01 RB, 10 LU, 11 RU
+        :param geohash: str, created by self.geohash
+        :param region: bbox of quad tree
+        :return: Region
+        """
+        bottom, up, left, right = region.bottom, region.up, region.left, region.right
+        for i in range(0, len(geohash), 2):
+            y_center = (up + bottom) / 2
+            x_center = (left + right) / 2
+            if geohash[i] == "0":
+                up = y_center
+            else:
+                bottom = y_center
+            if geohash[i + 1] == "0":
+                right = x_center
+            else:
+                left = x_center
+        return Region(bottom, up, left, right)
+
+    def knn_search(self, point, k):
+        """
+        best-first search k nearest items of point
+        1. pop the node nearest to point, scan its items if leaf, or push its children
+        2. stop when the k-th nearest distance <= the distance of the nearest node left
+        :param point: Point
+        :param k: int
+        :return: list of [distance, item] sorted by distance, candidates examined
+        """
+        count = 0
+        node_heap = [(0.0, count, self.root_node)]
+        item_heap = []  # 按距离的大顶堆，保存当前最近的k个item
+        candidates = 0
+        while node_heap:
+            node_distance, _, node = heapq.heappop(node_heap)
+            if len(item_heap) == k and node_distance > -item_heap[0][0]:
+                break
+            if node.is_leaf == 1:
+                for item in node.items:
+                    candidates += 1
+                    distance = ((item.lng - point.lng) ** 2 + (item.lat - point.lat) ** 2) ** 0.5
+                    count += 1
+                    if len(item_heap) < k:
+                        heapq.heappush(item_heap, (-distance, count, item))
+                    elif distance < -item_heap[0][0]:
+                        heapq.heapreplace(item_heap, (-distance, count, item))
+            else:
+                for child in [node.LB, node.RB, node.LU, node.RU]:
+                    count += 1
+                    heapq.heappush(node_heap, (child.region.distance(point.lng, point.lat), count, child))
+        return [[-distance, item] for distance, _, item in sorted(item_heap, reverse=True)], candidates
+
+    def knn_query(self, data: pd.DataFrame, k):
+        """
+        query index by x/y point and k
+        :param data: pd.DataFrame, [x, y]
+        :param k: int
+        :return: pd.Series, [np.array of index of k nearest points]
+        """
+        results, distances, candidates = self.knn_query_batch(data.x.values, data.y.values, k)
+        return pd.Series([result[~np.isnan(result)] for result in results])
+
+    def knn_query_batch(self, x, y, k):
+        """
+        query index by x/y points and k in batch
+        :param x: np.array
+        :param y: np.array
+        :param k: int
+        :return: np.array of index, shape = [len(x), k], nan for missing neighbours
+                 np.array of distance, shape = [len(x), k], inf for missing neighbours
+                 np.array of int, candidates examined for every point
+        """
+        results = np.full((len(x), k), np.nan)
+        distances = np.full((len(x), k), np.inf)
+        candidates = np.zeros(len(x), dtype=np.int64)
+        for i in range(len(x)):
+            neighbours, candidates[i] = self.knn_search(Point(x[i], y[i]), k)
+            for j, (distance, item) in enumerate(neighbours):
+                results[i, j] = item.index
+                distances[i, j] = distance
+        return results, distances, candidates
+
     def build(self, data: pd.DataFrame, z=False):
         if z is False:
             for index, point in data.iterrows():
@@ -256,6 +358,9 @@ def main():
     search_time = (end_time - start_time) / len(test_set_xy)
     print("Search time ", search_time)
     print("Not found nums ", result.isna().sum())
+    memory_usage = index.memory_usage()
+    print("Memory ", memory_usage)
+    print("Bytes per key ", memory_usage['total'] / len(train_set_xy))
     print("*************end %s************" % index_name)
 
 
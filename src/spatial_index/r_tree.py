@@ -8,7 +8,7 @@ from rtree import index
 
 sys.path.append('D:/Code/Paper/st-learned-index')
 from src.index import Index
-from src.spatial_index.common_utils import Point
+from src.spatial_index.common_utils import Point, memory_usage_of
 
 
 class RTree(Index):
@@ -27,6 +27,17 @@ class RTree(Index):
     def delete(self, point):
         self.index.delete(point.index, (point.lng, point.lat))
 
+    def memory_usage(self):
+        """
+        bytes of every component, tree_nodes: python wrapper of rtree, native: C-side storage of libspatialindex
+        native storage is estimated by leaves: every entry stores id and mbr, every leaf is an entry of its parent
+        :return: dict, component name -> bytes, and total bytes
+        """
+        entry_size = 8 + 2 * self.index.properties.dimension * 8
+        leaves = self.index.leaves()
+        entry_num = sum(len(ids) for _, ids, _ in leaves) + len(leaves)
+        return memory_usage_of({'tree_nodes': [self.index]}, native=entry_num * entry_size)
+
     def build(self, data: pd.DataFrame):
         for index, point in data.iterrows():
             self.insert(Point(point.x, point.y, index=index))
@@ -75,6 +86,9 @@ def main():
     search_time = (end_time - start_time) / len(test_set_xy)
     print("Search time ", search_time)
     print("Not found nums ", result.isna().sum())
+    memory_usage = index.memory_usage()
+    print("Memory ", memory_usage)
+    print("Bytes per key ", memory_usage['total'] / len(train_set_xy))
     print("*************end %s************" % index_name)
 
 
@@ -0,0 +1,65 @@
+import json
+import os
+
+# 训练记录，每个model一行json：
+# index/stage/leaf: model位置, model_type, keys: key数, epochs: 所有retrain的epoch总数, retrains: retrain次数,
+# wall_time: 训练耗时(s), min_err/max_err: 误差范围, window: max_err - min_err, cached: 是否从model cache加载
+RECORD_FIELDS = ['index', 'stage', 'leaf', 'model_type', 'keys', 'epochs', 'retrains', 'wall_time',
+                 'min_err', 'max_err', 'window', 'cached']
+
+
+class Telemetry:
+    def __init__(self, path, **context):
+        """
+        :param path: jsonl file, records are appended to it
+        :param context: fields written into every record, e.g. index and stage
+        """
+        self.path = path
+        self.context = context
+
+    def write(self, records):
+        """
+        append records into jsonl file
+        :param records: list of dict
+        :return: None
+        """
+        file_path = os.path.dirname(self.path)
+        if file_path and os.path.exists(file_path) is False:
+            os.makedirs(file_path)
+        with open(self.path, "a") as f:
+            for record in records:
+                record = dict(self.context, **record)
+                f.write(json.dumps({key: record.get(key) for key in RECORD_FIELDS}) + "\n")
+
+
+def load_records(path):
+    """
+    load records from jsonl file
+    :param path: jsonl file
+    :return: list of dict
+    """
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def plot_report(path, png_path):
+    """
+    offline report of training records, not called in build
+    plot window, wall time, epochs and key nums of every model
+    :param path: jsonl file
+    :param png_path: png file
+    :return: None
+    """
+    from matplotlib import pyplot as plt
+    records = load_records(path)
+    fig, axes = plt.subplots(2, 2, figsize=(12, 8))
+    for ax, field in zip(axes.flatten(), ['window', 'wall_time', 'epochs', 'keys']):
+        ax.bar(range(len(records)), [record[field] or 0 for record in records])
+        ax.set_title(field)
+        ax.set_xlabel('model')
+    fig.tight_layout()
+    file_path = os.path.dirname(png_path)
+    if file_path and os.path.exists(file_path) is False:
+        os.makedirs(file_path)
+    fig.savefig(png_path)
+    plt.close(fig)
@@ -1,22 +1,32 @@
-import gc
 import json
-import multiprocessing
 import os
 import sys
+import threading
 import time
 
 import numpy as np
 import pandas as pd
 
 sys.path.append('D:/Code/Paper/st-learned-index')
-from src.spatial_index.common_utils import ZOrder, Region
+from src.spatial_index.common_utils import ZOrder, Region, group_indexes, binary_search_batch, \
+    exponential_search_batch, bitmap_create, bitmap_get, bitmap_set, bitmap_to_mask, first_alive_batch, memory_usage_of
+from src.spatial_index.index_file import save_index_file, load_index_file, models_to_sections, sections_to_models
 from src.spatial_index.spatial_index import SpatialIndex
-from src.rmi_keras import TrainedNN, AbstractNN
+from src.spatial_index.leaf_trainer import MODEL_CLASSES, train_leaves
+from src.spatial_index.telemetry import Telemetry
+from src.rmi_keras import AbstractNN
+from src.rmi_linear import LinearModel, PiecewiseLinearModel, RadixSpline
+from src.rmi_stacked import StackedStage
+
+# 保存在index文件header中的训练参数，load后merge重训leaf_model时使用
+TRAIN_ARG_NAMES = ['use_thresholds', 'thresholds', 'model_types', 'weight_dtypes', 'cores', 'train_steps',
+                   'batch_sizes', 'learning_rates', 'keep_ratios', 'retrain_time_limits', 'merge_threshold',
+                   'compaction_ratio']
 
 
 class ZMIndex(SpatialIndex):
     def __init__(self, region=Region(-90, 90, -180, 180), model_path=None, train_data_length=None, rmi=None,
-                 index_list=None):
+                 index_keys=None, index_positions=None, search_mode='binary'):
         super(ZMIndex, self).__init__("ZM Index")
         # nn args
         self.block_size = 100
@@ -24,6 +34,8 @@ class ZMIndex(SpatialIndex):
         self.thresholds = [30, 20]
         self.stages = [1, 100]
         self.stage_length = len(self.stages)
+        self.model_types = ['nn', 'nn']  # nn: keras网络, linear/pla/radix_spline: 闭式模型，误差上限为threshold / 2
+        self.weight_dtypes = ['float64', 'float64']  # nn的weights存储类型: float64/float16/int8
         self.cores = [[1, 128, 1], [1, 128, 1]]
         self.train_steps = [40000, 20000]
         self.batch_sizes = [1024, 1024]
@@ -39,7 +51,31 @@ class ZMIndex(SpatialIndex):
         self.model_path = model_path
         self.train_data_length = train_data_length
         self.rmi = [[None for i in range(self.stages[i])] for i in range(self.stage_length)] if rmi is None else rmi
-        self.index_list = index_list  # 索引列
+        self.stacked_rmi = None  # rmi每个stage堆叠后的参数，修改rmi后置空，predict时重新compile
+        self.index_keys = index_keys  # 索引列：有序的key
+        self.index_positions = index_positions  # 索引列：key对应的key index
+        self.search_mode = search_mode  # binary: 在[pre - max_err, pre - min_err]内二分, exponential: 从pre开始倍增查找
+        self.search_stats = {'searches': 0, 'probes': 0}
+        # delta buffer: 插入的key有序地暂存在buffer中，超过merge_threshold后在后台线程合并进index_keys
+        self.merge_threshold = 10000
+        self.delta_keys = np.empty(0, dtype=np.float64)
+        self.delta_positions = np.empty(0, dtype=np.float64)
+        self.delta_seqs = np.empty(0, dtype=np.int64)  # 插入序号，merge后只删除merge前插入的key
+        # insert只追加到无序的log，读取delta buffer前由sort_delta批量排序合并
+        self.delta_log = []  # list of (keys, positions, seqs)
+        self.delta_log_num = 0
+        self.insert_seq = 0
+        self.next_id = train_data_length  # 未指定key index的插入点按顺序分配key index
+        self.lock = threading.RLock()  # 保护index_keys、rmi和delta buffer的读写
+        self.merge_lock = threading.Lock()
+        self.merge_thread = None
+        self.merging_seq = -1  # merge中的delta buffer快照的最大插入序号
+        self.merge_deleted_seqs = []  # merge期间删除的快照中的key
+        self.merge_error = None  # 后台merge的异常，下次insert/delete或join_merge时抛出
+        # tombstones: index_keys中已删除的位置，dead占比超过compaction_ratio后在后台compact
+        self.compaction_ratio = 0.1
+        self.tombstones = bitmap_create(0 if index_keys is None else len(index_keys))
+        self.dead_num = 0
 
     def init_train_data(self, data: pd.DataFrame):
         """
@@ -52,44 +88,37 @@ class ZMIndex(SpatialIndex):
         :return: None
         """
         z_order = ZOrder()
-        z_values = data.apply(lambda t: z_order.point_to_z(t.x, t.y, self.region), 1)
+        z_values = z_order.point_to_z_batch(data.x.values, data.y.values, self.region)
         # z归一化
         z_values_normalization = z_values / z_order.max_z
         self.train_data_length = len(z_values_normalization)
-        self.train_inputs[0][0] = z_values_normalization.sort_values(ascending=True).values
+        self.next_id = self.train_data_length
+        self.train_inputs[0][0] = np.sort(z_values_normalization)
         self.train_labels[0][0] = pd.Series(np.arange(0, self.train_data_length) / self.block_size).values
 
-    def build_single_thread(self, curr_stage, current_stage_step, inputs, labels, tmp_dict=None):
+    def build_single_thread(self, curr_stage, current_stage_step, inputs, labels):
         # train model
         i = curr_stage
         j = current_stage_step
-        model_path = self.model_path + "models/" + str(i) + "_" + str(j) + "_weights.best.hdf5"
-        tmp_index = TrainedNN(model_path, inputs, labels,
-                              self.thresholds[i],
-                              self.use_thresholds[i],
-                              self.cores[i],
-                              self.train_steps[i],
-                              self.batch_sizes[i],
-                              self.learning_rates[i],
-                              self.keep_ratios[i],
-                              self.retrain_time_limits[i])
-        tmp_index.train()
-        tmp_index.plot()
-        # get parameters in model (weight matrix and bias matrix)
-        abstract_index = AbstractNN(tmp_index.get_weights(),
-                                    self.cores[i],
-                                    tmp_index.train_x_min,
-                                    tmp_index.train_x_max,
-                                    tmp_index.train_y_min,
-                                    tmp_index.train_y_max,
-                                    tmp_index.min_err,
-                                    tmp_index.max_err)
-        del tmp_index
-        gc.collect()
-        if tmp_dict is not None:
-            tmp_dict[j] = abstract_index
-        else:
-            self.rmi[i][j] = abstract_index
+        self.rmi[i][j] = train_leaves([(j, self.get_model_path(i, j), inputs, labels)], self.model_types[i],
+                                      self.get_train_args(i), 1, self.model_path + "models/",
+                                      self.get_telemetry(i), self.weight_dtypes[i])[j]
+
+    def get_model_path(self, i, j):
+        return self.model_path + "models/" + str(i) + "_" + str(j) + "_weights.best.hdf5"
+
+    def get_telemetry(self, i):
+        return Telemetry(self.model_path + "models/telemetry.jsonl", index=self.name, stage=i)
+
+    def get_train_args(self, i):
+        return {'threshold': self.thresholds[i],
+                'use_threshold': self.use_thresholds[i],
+                'core': self.cores[i],
+                'train_step': self.train_steps[i],
+                'batch_size': self.batch_sizes[i],
+                'learning_rate': self.learning_rates[i],
+                'keep_ratio': self.keep_ratios[i],
+                'retrain_time_limit': self.retrain_time_limits[i]}
 
     def build(self, data: pd.DataFrame):
         """
@@ -100,7 +129,9 @@ class ZMIndex(SpatialIndex):
         """
         # 1. init train z->index data from x/y data
         self.init_train_data(data)
-        # 2. create rmi for train z->index data
+        # 2. create rmi for train z->index data, telemetry records of the last build are cleared
+        if os.path.exists(self.get_telemetry(0).path):
+            os.remove(self.get_telemetry(0).path)
         # 构建stage_nums结构的树状NNs
         for i in range(0, self.stage_length - 1):
             for j in range(0, self.stages[i]):
@@ -120,26 +151,21 @@ class ZMIndex(SpatialIndex):
                     for ind in range(self.stages[i + 1]):
                         self.train_inputs[i + 1][ind] = self.train_inputs[i][j][np.round(pres) == ind]
                         self.train_labels[i + 1][ind] = self.train_labels[i][j][np.round(pres) == ind]
-        # 叶子节点使用线程池训练
-        multiprocessing.set_start_method('spawn')  # 解决CUDA_ERROR_NOT_INITIALIZED报错
-        pool = multiprocessing.Pool(processes=self.thread_pool_size)
-        mp_dict = multiprocessing.Manager().dict()  # 使用共享dict暂存index[i]的所有model
+        # 叶子节点使用进程池训练，keys和labels通过shared memory传给worker
         i = self.stage_length - 1
-        task_size = self.stages[i]
-        for j in range(task_size):
-            inputs = self.train_inputs[i][j]
-            labels = self.train_labels[i][j]
-            if labels is None or len(labels) == 0:
-                continue
-            pool.apply_async(self.build_single_thread, (i, j, inputs, labels, mp_dict))
-        pool.close()
-        pool.join()
-        for (key, value) in mp_dict.items():
-            self.rmi[i][key] = value
+        tasks = [(j, self.get_model_path(i, j), self.train_inputs[i][j], self.train_labels[i][j])
+                 for j in range(self.stages[i])]
+        models = train_leaves(tasks, self.model_types[i], self.get_train_args(i), self.thread_pool_size,
+                              self.model_path + "models/", self.get_telemetry(i), self.weight_dtypes[i])
+        for j, model in models.items():
+            self.rmi[i][j] = model
+        self.stacked_rmi = None
 
         # 3. clear train data and label to save memory
-        self.index_list = pd.DataFrame({'key': self.train_inputs[0][0],
-                                        "key_index": self.train_labels[0][0]})
+        self.index_keys = np.ascontiguousarray(self.train_inputs[0][0])
+        self.index_positions = np.ascontiguousarray(self.train_labels[0][0])
+        self.tombstones = bitmap_create(len(self.index_keys))
+        self.dead_num = 0
         self.train_inputs = None
         self.train_labels = None
 
@@ -162,18 +188,422 @@ class ZMIndex(SpatialIndex):
         pre = leaf_model.predict(key)[0]
         return pre, leaf_model.min_err, leaf_model.max_err
 
+    def predict_batch(self, keys):
+        """
+        predict indexes from keys in batch
+        1. route keys stage by stage, every model predicts its group of keys at once
+        2. predict the indexes by leaf_models, one predict for every leaf_model
+        stages compiled into StackedStage are predicted by gathered parameters instead of model by model
+        :param keys: np.array, normalized z
+        :return: np.array of the indexes predicted by rmi, min_errs and max_errs of their leaf_models,
+                 nan if the leaf_model is empty
+        """
+        keys = np.asarray(keys, dtype=np.float64)
+        # 1. route keys stage by stage
+        model_indexes = self.route_batch(keys)
+        # 2. predict the indexes by leaf_models
+        stacked_stage = self.get_stacked_rmi()[self.stage_length - 1]
+        if stacked_stage is not None:
+            return stacked_stage.predict(model_indexes, keys)
+        pres = np.full(len(keys), np.nan)
+        min_errs = np.full(len(keys), np.nan)
+        max_errs = np.full(len(keys), np.nan)
+        for j, group in group_indexes(model_indexes):
+            leaf_model = self.rmi[self.stage_length - 1][j]
+            if leaf_model is None:
+                continue
+            pres[group] = leaf_model.predict(keys[group])
+            min_errs[group] = leaf_model.min_err
+            max_errs[group] = leaf_model.max_err
+        return pres, min_errs, max_errs
+
+    def route_batch(self, keys):
+        """
+        route keys stage by stage, every model predicts its group of keys at once
+        :param keys: np.array, normalized z
+        :return: np.array of int, index of leaf_model of every key
+        """
+        keys = np.asarray(keys, dtype=np.float64)
+        stacked_rmi = self.get_stacked_rmi()
+        model_indexes = np.zeros(len(keys), dtype=np.int64)
+        for i in range(0, self.stage_length - 1):
+            if stacked_rmi[i] is not None:
+                next_model_indexes = np.round(stacked_rmi[i].predict(model_indexes, keys)[0]).astype(np.int64)
+            else:
+                next_model_indexes = np.zeros(len(keys), dtype=np.int64)
+                for j, group in group_indexes(model_indexes):
+                    next_model_indexes[group] = np.round(self.rmi[i][j].predict(keys[group]))
+            model_indexes = np.clip(next_model_indexes, 0, self.stages[i + 1] - 1)
+        return model_indexes
+
+    def get_stacked_rmi(self):
+        """
+        compile every stage of rmi into StackedStage, None for the stages which can not be stacked
+        :return: list of StackedStage or None
+        """
+        stacked_rmi = self.stacked_rmi
+        if stacked_rmi is None:
+            stacked_rmi = [StackedStage.compile(models) for models in self.rmi]
+            self.stacked_rmi = stacked_rmi
+        return stacked_rmi
+
+    def insert(self, point):
+        """
+        insert point into delta buffer, z of single point is computed on python int without the overhead of numpy
+        :param point: Point, point.index is the key index, a new one is created if None
+        :return: None
+        """
+        self.raise_merge_error()
+        z_order = ZOrder()
+        key = z_order.point_to_z(point.lng, point.lat, self.region) / z_order.max_z
+        self.append_delta(np.array([key]), None if point.index is None else [point.index])
+
+    def insert_batch(self, x, y, positions=None):
+        """
+        insert x/y points into delta buffer in batch, and start merge in background when the buffer is full
+        :param x: np.array
+        :param y: np.array
+        :param positions: np.array, key index of points, new ones are created if None
+        :return: None
+        """
+        self.raise_merge_error()
+        z_order = ZOrder()
+        keys = z_order.point_to_z_batch(x, y, self.region) / z_order.max_z
+        self.append_delta(keys, positions)
+
+    def append_delta(self, keys, positions):
+        """
+        append keys to the unsorted insert log in O(batch), they are sorted into delta buffer by sort_delta
+        when delta buffer is read next time
+        :param keys: np.array, normalized z
+        :param positions: np.array, key index of keys, new ones are created if None
+        :return: None
+        """
+        with self.lock:
+            if positions is None:
+                positions = (self.next_id + np.arange(len(keys))) / self.block_size
+                self.next_id += len(keys)
+            positions = np.asarray(positions, dtype=np.float64)
+            seqs = self.insert_seq + np.arange(len(keys), dtype=np.int64)
+            self.insert_seq += len(keys)
+            self.delta_log.append((keys, positions, seqs))
+            self.delta_log_num += len(keys)
+            full = self.need_merge()
+        if full:
+            self.start_merge()
+
+    def sort_delta(self):
+        """
+        sort the insert log and merge it into delta buffer, must be called with lock before reading delta buffer
+        :return: None
+        """
+        if not self.delta_log:
+            return
+        keys, positions, seqs = [np.concatenate(arrays) for arrays in zip(*self.delta_log)]
+        # log按插入顺序排列，stable排序后相同key保持插入顺序
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        # 新数组替换旧数组而不是原地修改，merge中的快照不受影响
+        inserts = np.searchsorted(self.delta_keys, keys, side='right')
+        self.delta_keys = np.insert(self.delta_keys, inserts, keys)
+        self.delta_positions = np.insert(self.delta_positions, inserts, positions[order])
+        self.delta_seqs = np.insert(self.delta_seqs, inserts, seqs[order])
+        self.delta_log = []
+        self.delta_log_num = 0
+
+    def start_merge(self):
+        """
+        start merge in background thread, do nothing if it is running
+        :return: None
+        """
+        if self.merge_thread is not None and self.merge_thread.is_alive():
+            return
+        self.merge_thread = threading.Thread(target=self.background_merge, daemon=True)
+        self.merge_thread.start()
+
+    def background_merge(self):
+        # merge期间插入或删除的key可能再次超过阈值
+        try:
+            while self.need_merge():
+                self.merge()
+        except Exception as e:
+            # 线程中的异常无法被调用方捕获，记录下来由下次insert/delete或join_merge抛出
+            self.merge_error = e
+
+    def join_merge(self):
+        """
+        wait for the background merge, and raise the exception of it if failed
+        :return: None
+        """
+        if self.merge_thread is not None:
+            self.merge_thread.join()
+        self.raise_merge_error()
+
+    def raise_merge_error(self):
+        """
+        raise the exception of the last failed background merge once, the delta buffer is kept for the next merge
+        :return: None
+        """
+        error, self.merge_error = self.merge_error, None
+        if error is not None:
+            raise error
+
+    def need_merge(self):
+        return len(self.delta_keys) + self.delta_log_num >= self.merge_threshold or \
+               self.dead_num > self.compaction_ratio * max(len(self.index_keys), 1)
+
+    def merge(self):
+        """
+        merge delta buffer into index_keys, compact the dead entries and refresh the affected leaf_models
+        1. snapshot delta buffer and tombstones, the keys inserted or deleted during merge are kept
+        2. remove the dead entries and merge the keys of snapshot into index_keys
+        3. refresh leaf_models
+        4. swap index_keys and leaf_models, remove the snapshot from delta buffer,
+           and mark the entries deleted during merge in the new tombstones
+        :return: None
+        """
+        with self.merge_lock:
+            # 1. snapshot delta buffer and tombstones
+            with self.lock:
+                self.sort_delta()
+                if len(self.delta_keys) == 0 and self.dead_num == 0:
+                    return
+                keys, positions, seqs = self.delta_keys, self.delta_positions, self.delta_seqs
+                self.merging_seq = seqs.max() if len(seqs) else -1
+                self.merge_deleted_seqs = []
+                index_keys, index_positions = self.index_keys, self.index_positions
+                alive = ~bitmap_to_mask(self.tombstones, len(index_keys))
+            try:
+                # 2. remove the dead entries and merge the keys of snapshot into index_keys
+                alive_keys = index_keys[alive]
+                inserts = np.searchsorted(alive_keys, keys, side='right')
+                new_keys = np.insert(alive_keys, inserts, keys)
+                new_positions = np.insert(index_positions[alive], inserts, positions)
+                old_to_new = np.full(len(index_keys), -1, dtype=np.int64)
+                old_to_new[alive] = np.arange(len(alive_keys)) + np.searchsorted(inserts, np.arange(len(alive_keys)),
+                                                                                 side='right')
+                # 3. refresh leaf_models
+                leaf_models = self.refresh_leaf_models(index_keys, old_to_new, new_keys, keys)
+            except Exception:
+                # 失败时index_keys和delta buffer都未修改，快照的key留在delta buffer中等待下次merge
+                with self.lock:
+                    self.merging_seq = -1
+                    self.merge_deleted_seqs = []
+                raise
+            # 4. swap index_keys and leaf_models
+            with self.lock:
+                tombstones = bitmap_create(len(new_keys))
+                deleted = alive & bitmap_to_mask(self.tombstones, len(index_keys))
+                bitmap_set(tombstones, old_to_new[deleted])
+                if self.merge_deleted_seqs:
+                    inserted = inserts + np.arange(len(keys))
+                    bitmap_set(tombstones, inserted[np.isin(seqs, self.merge_deleted_seqs)])
+                self.index_keys = new_keys
+                self.index_positions = new_positions
+                self.rmi[self.stage_length - 1] = leaf_models
+                self.stacked_rmi = None
+                self.train_data_length = len(new_keys)
+                self.tombstones = tombstones
+                self.dead_num = int(deleted.sum()) + len(self.merge_deleted_seqs)
+                kept = self.delta_seqs > self.merging_seq
+                self.delta_keys = self.delta_keys[kept]
+                self.delta_positions = self.delta_positions[kept]
+                self.delta_seqs = self.delta_seqs[kept]
+                self.merging_seq = -1
+                self.merge_deleted_seqs = []
+
+    def refresh_leaf_models(self, old_keys, old_to_new, new_keys, inserted_keys):
+        """
+        retrain the leaf_models which get inserted keys, lose dead keys, or whose keys are shifted by different
+        offsets, and shift the outputs of the others by the offset of their keys
+        :param old_keys: np.array, index_keys before merge
+        :param old_to_new: np.array of int, positions of old keys in new keys, -1 if removed
+        :param new_keys: np.array, index_keys after merge
+        :param inserted_keys: np.array
+        :return: list of leaf_models
+        """
+        i = self.stage_length - 1
+        leaf_models = list(self.rmi[i])
+        affected = set(np.unique(self.route_batch(inserted_keys)).tolist())
+        shifts = old_to_new - np.arange(len(old_keys))
+        for j, group in group_indexes(self.route_batch(old_keys)):
+            if j in affected or leaf_models[j] is None:
+                continue
+            group_shifts = shifts[group]
+            if (old_to_new[group] < 0).any() or group_shifts.min() != group_shifts.max():
+                affected.add(j)
+            elif group_shifts[0] != 0:
+                leaf_models[j] = leaf_models[j].shift(group_shifts[0] / self.block_size)
+        # 没有key的leaf_model置空
+        for j in affected:
+            leaf_models[j] = None
+        labels = np.arange(len(new_keys)) / self.block_size
+        tasks = [(int(j), self.get_model_path(i, j), new_keys[group], labels[group])
+                 for j, group in group_indexes(self.route_batch(new_keys)) if j in affected]
+        models = train_leaves(tasks, self.model_types[i], self.get_train_args(i), self.thread_pool_size,
+                              self.model_path + "models/", self.get_telemetry(i), self.weight_dtypes[i])
+        for j, model in models.items():
+            leaf_models[j] = model
+        return leaf_models
+
+    def delete(self, point):
+        """
+        delete point
+        :param point: Point, delete the entries of point.index, or all the entries of x/y if None
+        :return: int, number of deleted entries
+        """
+        return self.delete_batch([point.lng], [point.lat], None if point.index is None else [point.index])
+
+    def delete_batch(self, x, y, positions=None):
+        """
+        delete x/y points in batch, start compaction in background when the dead entries are too many
+        1. the entries in index_keys are marked in tombstones
+        2. the entries in delta buffer are removed
+        :param x: np.array
+        :param y: np.array
+        :param positions: np.array, key index of points, delete all the entries of x/y if None
+        :return: int, number of deleted entries
+        """
+        self.raise_merge_error()
+        z_order = ZOrder()
+        zs = z_order.point_to_z_batch(x, y, self.region) / z_order.max_z
+        with self.lock:
+            self.sort_delta()
+            # 1. the entries in index_keys are marked in tombstones
+            starts = self.lower_bound_batch(zs)
+            ends = np.searchsorted(self.index_keys, zs, side='right')
+            dead = [np.arange(start, end) for start, end in zip(starts, ends)]
+            if positions is not None:
+                dead = [entries[self.index_positions[entries] == position]
+                        for entries, position in zip(dead, positions)]
+            dead = np.concatenate(dead) if dead else np.empty(0, dtype=np.int64)
+            dead = np.unique(dead[~bitmap_get(self.tombstones, dead)])
+            bitmap_set(self.tombstones, dead)
+            self.dead_num += len(dead)
+            # 2. the entries in delta buffer are removed
+            if positions is None:
+                removed = np.isin(self.delta_keys, zs)
+            else:
+                # (key, position)成对匹配：组合成complex，实部为key，虚部为position
+                removed = np.isin(self.delta_keys + 1j * self.delta_positions,
+                                  zs + 1j * np.asarray(positions, dtype=np.float64))
+            if removed.any():
+                # merge中的快照已合并进新的index_keys，swap时标记为dead
+                removed_seqs = self.delta_seqs[removed]
+                self.merge_deleted_seqs.extend(removed_seqs[removed_seqs <= self.merging_seq].tolist())
+                self.delta_keys = self.delta_keys[~removed]
+                self.delta_positions = self.delta_positions[~removed]
+                self.delta_seqs = self.delta_seqs[~removed]
+            full = self.need_merge()
+        if full:
+            self.start_merge()
+        return len(dead) + int(removed.sum())
+
+    def get_index_keys(self, positions):
+        """
+        keys of positions, positions >= len(index_keys) are in delta buffer
+        """
+        return self.get_by_positions(self.index_keys, self.delta_keys, positions)
+
+    def get_index_positions(self, positions):
+        """
+        key indexes of positions, positions >= len(index_keys) are in delta buffer
+        """
+        return self.get_by_positions(self.index_positions, self.delta_positions, positions)
+
+    def get_by_positions(self, main_values, delta_values, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        size = len(self.index_keys)
+        in_main = positions < size
+        if in_main.all():
+            return main_values[positions]
+        values = np.empty(len(positions), dtype=np.float64)
+        values[in_main] = main_values[positions[in_main]]
+        values[~in_main] = delta_values[positions[~in_main] - size]
+        return values
+
+    def memory_usage(self):
+        """
+        bytes of every component
+        models: rmi and stacked rmi, keys: index keys, delta keys and tombstones, positions: key indexes and insert seqs
+        :return: dict, component name -> bytes, and total bytes
+        """
+        with self.lock:
+            self.sort_delta()
+            return memory_usage_of({'models': [self.rmi, self.stacked_rmi],
+                                    'keys': [self.index_keys, self.delta_keys, self.tombstones],
+                                    'positions': [self.index_positions, self.delta_positions, self.delta_seqs]})
+
     def save(self):
+        """
+        save zm index into binary index file
+        header: args of zm index and models, sections: stacked arrays of models, index_keys and index_positions
+        :return: None
+        """
+        if os.path.exists(self.model_path) is False:
+            os.makedirs(self.model_path)
+        header = {'block_size': self.block_size,
+                  'stages': self.stages,
+                  'region': self.region.__dict__,
+                  'train_data_length': self.train_data_length,
+                  'next_id': self.next_id,
+                  'train_args': {name: getattr(self, name) for name in TRAIN_ARG_NAMES},
+                  'rmi': []}
+        with self.lock:
+            self.sort_delta()
+            sections = {'index_keys': self.index_keys,
+                        'index_positions': self.index_positions,
+                        'delta_keys': self.delta_keys,
+                        'delta_positions': self.delta_positions,
+                        'tombstones': self.tombstones}
+            for i in range(self.stage_length):
+                models_header, models_sections = models_to_sections('rmi.%d' % i, self.rmi[i])
+                header['rmi'].append(models_header)
+                sections.update(models_sections)
+        save_index_file(self.model_path + 'zm_index.idx', header, sections)
+
+    def load(self):
+        """
+        load zm index from binary index file, arrays are memory-mapped without copy
+        :return: None
+        """
+        header, sections = load_index_file(self.model_path + 'zm_index.idx')
+        self.block_size = header['block_size']
+        self.stages = header['stages']
+        self.stage_length = len(self.stages)
+        self.region = Region.init_by_dict(header['region'])
+        self.train_data_length = header['train_data_length']
+        for name, value in header.get('train_args', {}).items():
+            setattr(self, name, value)
+        self.rmi = [sections_to_models('rmi.%d' % i, header['rmi'][i], sections, MODEL_CLASSES)
+                    for i in range(self.stage_length)]
+        self.stacked_rmi = None
+        self.index_keys = sections['index_keys']
+        self.index_positions = sections['index_positions']
+        self.next_id = header.get('next_id', self.train_data_length)
+        # delta buffer会被替换，不使用memmap
+        self.delta_keys = np.array(sections.get('delta_keys', np.empty(0)), dtype=np.float64)
+        self.delta_positions = np.array(sections.get('delta_positions', np.empty(0)), dtype=np.float64)
+        self.delta_seqs = np.arange(len(self.delta_keys), dtype=np.int64)
+        self.delta_log = []
+        self.delta_log_num = 0
+        self.insert_seq = len(self.delta_keys)
+        self.tombstones = np.array(sections.get('tombstones', bitmap_create(len(self.index_keys))), dtype=np.uint8)
+        self.dead_num = int(bitmap_to_mask(self.tombstones, len(self.index_keys)).sum())
+
+    def save_json(self):
         """
         save zm index into json file
         :return: None
         """
         if os.path.exists(self.model_path) is False:
             os.makedirs(self.model_path)
-        self.index_list.to_csv(self.model_path + 'index_list.csv', sep=',', header=True, index=False)
+        np.save(self.model_path + 'index_keys.npy', self.index_keys)
+        np.save(self.model_path + 'index_positions.npy', self.index_positions)
         with open(self.model_path + 'zm_index.json', "w") as f:
             json.dump(self, f, cls=MyEncoder, ensure_ascii=False)
 
-    def load(self):
+    def load_json(self):
         """
         load zm index from json file
         :return: None
@@ -182,94 +612,301 @@ class ZMIndex(SpatialIndex):
             zm_index = json.load(f, cls=MyDecoder)
             self.train_data_length = zm_index.train_data_length
             self.rmi = zm_index.rmi
-            self.index_list = pd.read_csv(self.model_path + 'index_list.csv',
-                                          float_precision='round_trip')  # round_trip保留小数位数
+            self.stacked_rmi = None
+            self.index_keys = np.load(self.model_path + 'index_keys.npy', mmap_mode='r')
+            self.index_positions = np.load(self.model_path + 'index_positions.npy', mmap_mode='r')
+            self.tombstones = bitmap_create(len(self.index_keys))
             del zm_index
 
     @staticmethod
     def init_by_dict(d: dict):
         return ZMIndex(region=d['region'],
                        train_data_length=d['train_data_length'],
-                       rmi=d['rmi'],
-                       index_list=d['index_list'])
+                       rmi=d['rmi'])
 
     def point_query(self, data: pd.DataFrame):
         """
         query index by x/y point
-        1. compute z from x/y of points
-        2. normalize z by z.min and z.max
-        3. predict by z and create index scope [pre - min_err, pre + max_err]
-        4. binary search in scope
         :param data: pd.DataFrame, [x, y]
-        :return: pd.DataFrame, [pre]
+        :return: pd.Series, [pre], nan if not found
+        """
+        return pd.Series(self.point_query_batch(data.x.values, data.y.values))
+
+    def point_query_batch(self, x, y):
+        """
+        query index by x/y points in batch
+        1. compute z from x/y of all points in one pass
+        2. normalize z by z.min and z.max
+        3. predict by rmi in batch and create index scopes [pre - max_err, pre - min_err]
+        4. binary search in all the scopes in lockstep
+        5. search the points not found in delta buffer
+        :param x: np.array
+        :param y: np.array
+        :return: np.array, key index of every point, nan if not found
         """
         z_order = ZOrder()
-        # 写法1：list
-        results = []
-        for index, point in data.iterrows():
-            # 1. compute z from x/y of points
-            z_value = z_order.point_to_z(point.x, point.y, self.region)
-            # 2. normalize z by z.min and z.max
-            z = z_value / z_order.max_z
-            # 3. predict by z and create index scope [pre - min_err, pre + max_err]
-            pre, min_err, max_err = self.predict(z)
-            left_bound = max((pre - max_err) * self.block_size, 0)
-            right_bound = min((pre - min_err) * self.block_size, self.train_data_length - 1)
-            # 4. binary search in scope
-            result = self.binary_search(self.index_list, z, int(round(left_bound)), int(round(right_bound)))
-            results.append(result)
-        return pd.Series(results)
-        # 写法2：pd.DataFrame
-        # z_values = data.apply(lambda t: z_order.point_to_z(t.x, t.y, self.region), 1)
-        # # z归一化
-        # data["z"] = (z_values - self.z_values_normalization_min_max[0]) / (
-        #         self.z_values_normalization_min_max[1] - self.z_values_normalization_min_max[0])
-        # data["pres"] = data.z.apply(self.predict)
-        # data["left_bound"] = data.pres.apply(lambda pre: max((pre - self.errs[0]) * self.block_size, 0))
-        # data["right_bound"] = data.pres.apply(
-        #     lambda pre: min((pre + self.errs[1]) * self.block_size, self.train_data_length))
-        # results = data.apply(
-        #     lambda t: self.binary_search(self.index_list, t.z, int(round(t.left_bound)), int(round(t.right_bound))), 1)
-        # return results
-
-    # def range_query(self, data: pd.DataFrame):
-    #     """
-    #     query index by x1/y1/x2/y2 range
-    #     1. compute z1, z2 from x1/y1/x2/y2 of data
-    #     2. normalize z1 and z2 by z.min and z.max
-    #     3. point query from z1 and z2 to index_z1 and index_z2
-    #     4. filter all the point of scope[index_z1, index_z2] by range(x1/y1/x2/y2).contain(point)
-    #     :param data: pd.DataFrame, [x1, y1, x2, y2]
-    #     :return: pd.DataFrame, [pre, min_err, max_err]
-    #     """
-    #     z_order = ZOrder()
-    #     z_value = z_order.point_to_z(df[lng_col][i], df[lat_col][i])
-    #     # z归一化
-    #     min_z_value = min(z_values)
-    #     max_z_value = max(z_values)
-    #     for i in range(df.count()[0]):
-    #         z_value_normalization = (z_values[i] - min_z_value) / (max_z_value - min_z_value)
-    #         z_values_normalization.append(z_value_normalization)
-
-    # TODO: 无法处理有重复的数组
-    def binary_search(self, nums, x, left, right):
-        """
-        binary search x in nums[left, right]
-        :param nums: pd.DataFrame, [key, key_index], index table
-        :param x: key
-        :param left:
-        :param right:
-        :return: key index
-        """
-        while left <= right:
-            mid = (left + right) // 2
-            if nums.iloc[mid].key == x:
-                return nums.iloc[mid].key_index
-            if nums.iloc[mid].key < x:
-                left = mid + 1
+        # 1. compute z from x/y of all points in one pass
+        z_values = z_order.point_to_z_batch(x, y, self.region)
+        # 2. normalize z by z.min and z.max
+        zs = z_values / z_order.max_z
+        with self.lock:
+            self.sort_delta()
+            # 3. predict by rmi in batch and search in the scopes [pre - max_err, pre - min_err]
+            positions = self.lower_bound_batch(zs)
+            keys = self.index_keys
+            if self.dead_num:
+                positions, found = first_alive_batch(keys, self.tombstones, positions, zs)
             else:
-                right = mid - 1
-        return None
+                found = (positions < len(keys)) & (keys[np.minimum(positions, len(keys) - 1)] == zs)
+            results = np.full(len(zs), np.nan)
+            results[found] = self.index_positions[positions[found]]
+            # 5. search the points not found in delta buffer
+            if len(self.delta_keys) and not found.all():
+                missed = np.flatnonzero(~found)
+                delta_positions = np.searchsorted(self.delta_keys, zs[missed])
+                in_delta = (delta_positions < len(self.delta_keys)) & \
+                           (self.delta_keys[np.minimum(delta_positions, len(self.delta_keys) - 1)] == zs[missed])
+                results[missed[in_delta]] = self.delta_positions[delta_positions[in_delta]]
+        return results
+
+    def lower_bound_batch(self, keys):
+        """
+        find the position of the first index key >= key for every key
+        1. predict by rmi in batch and create index scopes [pre - max_err, pre - min_err]
+        2. binary search in all the scopes in lockstep
+        3. keys not in index may be out of their scopes, search them in the whole index
+        :param keys: np.array, normalized z
+        :return: np.array of int, positions in [0, len(index_keys)]
+        """
+        # 1. predict by rmi in batch and create index scopes [pre - max_err, pre - min_err]
+        pres, min_errs, max_errs = self.predict_batch(keys)
+        left_bounds, right_bounds = self.search_scope_batch(pres, min_errs, max_errs)
+        # 2. search in all the scopes in lockstep
+        index_keys = self.index_keys
+        positions = self.search_batch(keys, pres * self.block_size, left_bounds, right_bounds)
+        # 3. check lower bound: index_keys[position - 1] < key <= index_keys[position]
+        last = len(index_keys) - 1
+        after_prev = (positions == 0) | (index_keys[np.clip(positions - 1, 0, last)] < keys)
+        before_next = (positions == last + 1) | (index_keys[np.minimum(positions, last)] >= keys)
+        missed = ~(after_prev & before_next)
+        if missed.any():
+            positions[missed] = np.searchsorted(index_keys, keys[missed])
+            self.search_stats['probes'] += int(missed.sum()) * len(index_keys).bit_length()
+        return positions
+
+    def search_batch(self, keys, pres, left_bounds, right_bounds):
+        """
+        search the lower bounds of keys in index scopes by search_mode, and count the probes into search_stats
+        binary: binary search in the whole scope [pre - max_err, pre - min_err]
+        exponential: gallop from pre, the scope only bounds the steps
+        :param keys: np.array, normalized z
+        :param pres: np.array, predicted positions, nan if the leaf_model is empty
+        :param left_bounds: np.array of int
+        :param right_bounds: np.array of int
+        :return: np.array of int, position of the first key >= key in scope, right bound + 1 if not found
+        """
+        if self.search_mode == 'binary':
+            positions, probes = binary_search_batch(self.index_keys, keys, left_bounds, right_bounds)
+        elif self.search_mode == 'exponential':
+            positions, probes = exponential_search_batch(self.index_keys, keys, pres, left_bounds, right_bounds)
+        else:
+            raise ValueError("unknown search mode: %s" % self.search_mode)
+        self.search_stats['searches'] += len(keys)
+        self.search_stats['probes'] += int(probes.sum())
+        return positions
+
+    def reset_search_stats(self):
+        self.search_stats = {'searches': 0, 'probes': 0}
+
+    def search_scope_batch(self, pres, min_errs, max_errs):
+        """
+        create index scopes [pre - max_err, pre - min_err] of predicted indexes
+        the whole index is searched when the leaf_model is empty
+        :param pres: np.array
+        :param min_errs: np.array
+        :param max_errs: np.array
+        :return: np.array of int, left bounds and right bounds of scopes
+        """
+        empty = np.isnan(pres)
+        left_bounds = np.clip((pres - max_errs) * self.block_size, 0, self.train_data_length)
+        right_bounds = np.minimum((pres - min_errs) * self.block_size, self.train_data_length - 1)
+        left_bounds = np.where(empty, 0, np.round(left_bounds)).astype(np.int64)
+        right_bounds = np.where(empty, self.train_data_length - 1, np.round(right_bounds)).astype(np.int64)
+        return left_bounds, right_bounds
+
+    def range_query(self, data: pd.DataFrame):
+        """
+        query index by x1/y1/x2/y2 range
+        :param data: pd.DataFrame, [x1, y1, x2, y2], left-bottom and right-up corners of windows
+        :return: pd.Series, [np.array of key index in window]
+        """
+        return pd.Series(self.range_query_batch(data.x1.values, data.y1.values, data.x2.values, data.y2.values))
+
+    def range_query_batch(self, x1, y1, x2, y2, max_intervals=16):
+        """
+        query index by x1/y1/x2/y2 ranges in batch
+        :param x1: np.array, left of windows
+        :param y1: np.array, bottom of windows
+        :param x2: np.array, right of windows
+        :param y2: np.array, up of windows
+        :param max_intervals: max z intervals of one window
+        :return: list of np.array, key index of points in every window, sorted by z in index_keys and delta buffer
+        """
+        with self.lock:
+            return [self.get_index_positions(positions) for positions in
+                    self.range_search_batch(x1, y1, x2, y2, max_intervals)]
+
+    def range_search_batch(self, x1, y1, x2, y2, max_intervals=16):
+        """
+        search positions of index_keys in x1/y1/x2/y2 ranges in batch
+        :return: list of np.array, positions of index_keys in every window,
+                 positions >= len(index_keys) are in delta buffer
+        """
+        windows, positions = self.range_search_flat(x1, y1, x2, y2, max_intervals)
+        return np.split(positions, np.searchsorted(windows, np.arange(1, len(x1))))
+
+    def range_search_flat(self, x1, y1, x2, y2, max_intervals=16):
+        """
+        search positions of index_keys in x1/y1/x2/y2 ranges in batch, the results of all windows in flat arrays
+        1. decompose every window into z intervals by BIGMIN/LITMAX
+        2. normalize z and search the slice [lower bound of z_min, lower bound of z_max + 1) of every interval,
+           the endpoints of all the intervals are predicted by rmi in one batch
+        3. expand the slices of all the intervals into one array, filter the points of slices which are not exact
+           by the cells of their windows, and the dead entries
+        4. search the slices of intervals in delta buffer in the same way
+        :return: np.array of int, window of every position, sorted
+                 np.array of int, positions of index_keys, sorted by z in index_keys and delta buffer of every window,
+                 positions >= len(index_keys) are in delta buffer
+        """
+        z_order = ZOrder()
+        # 1. decompose every window into z intervals by BIGMIN/LITMAX
+        boxes = np.zeros((len(x1), 4), dtype=np.int64)
+        intervals = []
+        for i in range(len(x1)):
+            box = z_order.window_to_box(Region(y1[i], y2[i], x1[i], x2[i]), self.region)
+            if box is not None:
+                boxes[i] = box
+                for z_min, z_max, exact in z_order.box_to_z_intervals(box, max_intervals):
+                    intervals.append([i, z_min, z_max, exact])
+        intervals = np.array(intervals, dtype=np.int64).reshape(-1, 4)
+        windows = []
+        positions = []
+        with self.lock:
+            self.sort_delta()
+            # 2. normalize z and search the slices of intervals in one batch
+            slices = [(self.index_keys, 0,
+                       self.lower_bound_batch(intervals[:, 1] / z_order.max_z),
+                       self.lower_bound_batch((intervals[:, 2] + 1) / z_order.max_z))]
+            # 4. search the slices of intervals in delta buffer in the same way
+            if len(self.delta_keys):
+                slices.append((self.delta_keys, len(self.index_keys),
+                               np.searchsorted(self.delta_keys, intervals[:, 1] / z_order.max_z),
+                               np.searchsorted(self.delta_keys, (intervals[:, 2] + 1) / z_order.max_z)))
+            # 3. expand the slices into one array and filter them
+            for keys, offset, starts, ends in slices:
+                lengths = np.maximum(ends - starts, 0)
+                slice_ids = np.repeat(np.arange(len(intervals)), lengths)
+                slice_positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + \
+                                  np.repeat(starts, lengths)
+                keep = intervals[slice_ids, 3] == 1
+                inexact = np.flatnonzero(~keep)
+                zs = np.rint(keys[slice_positions[inexact]] * z_order.max_z)
+                keep[inexact] = z_order.z_in_box_batch(zs, boxes[intervals[slice_ids[inexact], 0]].T)
+                if offset == 0 and self.dead_num:
+                    keep &= ~bitmap_get(self.tombstones, slice_positions)
+                windows.append(intervals[slice_ids[keep], 0])
+                positions.append(slice_positions[keep] + offset)
+        windows = np.concatenate(windows)
+        positions = np.concatenate(positions)
+        # 同一个window的delta buffer结果排在index_keys结果之后
+        order = np.argsort(windows, kind='stable')
+        return windows[order], positions[order]
+
+    def knn_query(self, data: pd.DataFrame, k):
+        """
+        query index by x/y point and k
+        :param data: pd.DataFrame, [x, y]
+        :param k: int
+        :return: pd.Series, [np.array of key index of k nearest points]
+        """
+        results, distances, candidates = self.knn_query_batch(data.x.values, data.y.values, k)
+        return pd.Series([result[~np.isnan(result)] for result in results])
+
+    def knn_query_batch(self, x, y, k):
+        """
+        query index by x/y points and k in batch
+        1. search the lower bound of z of every point, the k-th nearest distance of the 2k keys around it
+           is the first radius
+        2. range query the windows [x - r, x + r] * [y - r, y + r] of all the unfinished points in one batch
+        3. the result is provably nearest when the k-th nearest distance in window <= r,
+           otherwise enlarge r to the k-th nearest distance, or double it if less than k points in window
+        distance is computed between x/y and the center of the cell of z
+        :param x: np.array
+        :param y: np.array
+        :param k: int
+        :return: np.array of key index, shape = [len(x), k], nan for missing neighbours
+                 np.array of distance, shape = [len(x), k], inf for missing neighbours
+                 np.array of int, candidates examined for every point
+        """
+        with self.lock:
+            return self.knn_search_batch(x, y, k)
+
+    def knn_search_batch(self, x, y, k):
+        """
+        knn_query_batch without lock
+        """
+        self.sort_delta()
+        z_order = ZOrder()
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        size = len(self.index_keys)
+        results = np.full((len(x), k), np.nan)
+        distances = np.full((len(x), k), np.inf)
+        candidates = np.zeros(len(x), dtype=np.int64)
+        max_radius = float(max(self.region.right - self.region.left, self.region.up - self.region.bottom))
+        min_radius = max_radius / (1 << z_order.bits)
+        # 1. the k-th nearest distance of the 2k keys around the lower bound is the first radius
+        zs = z_order.point_to_z_batch(x, y, self.region) / z_order.max_z
+        starts = np.clip(self.lower_bound_batch(zs) - k, 0, max(size - 2 * k, 0))
+        radiuses = np.full(len(x), max_radius)
+        width = min(2 * k, size)
+        candidates += width
+        if width >= k and len(x):
+            # 所有点的2k个key为[len(x), 2k]的矩阵，按行partition取第k近的距离
+            positions = starts[:, np.newaxis] + np.arange(width)
+            lngs, lats = z_order.z_to_point_batch(np.rint(self.get_index_keys(positions.ravel()) * z_order.max_z),
+                                                  self.region, center=True)
+            seed_distances = np.sqrt((lngs.reshape(positions.shape) - x[:, np.newaxis]) ** 2 +
+                                     (lats.reshape(positions.shape) - y[:, np.newaxis]) ** 2)
+            radiuses = np.partition(seed_distances, k - 1, axis=1)[:, k - 1]
+        # 2. range query the windows of all the unfinished points in one batch
+        unfinished = np.arange(len(x))
+        while len(unfinished):
+            r = radiuses[unfinished]
+            px, py = x[unfinished], y[unfinished]
+            windows, positions = self.range_search_flat(px - r, py - r, px + r, py + r)
+            candidates += np.bincount(unfinished[windows], minlength=len(x))
+            lngs, lats = z_order.z_to_point_batch(np.rint(self.get_index_keys(positions) * z_order.max_z),
+                                                  self.region, center=True)
+            point_distances = np.sqrt((lngs - px[windows]) ** 2 + (lats - py[windows]) ** 2)
+            # 按window和距离排序，每个window的前k个为它的k近邻
+            order = np.lexsort((point_distances, windows))
+            windows, positions, point_distances = windows[order], positions[order], point_distances[order]
+            counts = np.bincount(windows, minlength=len(unfinished))
+            firsts = np.cumsum(counts) - counts
+            ranks = np.arange(len(windows)) - firsts[windows]
+            kth_distances = np.full(len(unfinished), np.inf)
+            full = counts >= k
+            kth_distances[full] = point_distances[firsts[full] + k - 1]
+            # 3. the result is provably nearest when the k-th nearest distance in window <= r
+            finished = (full & (kth_distances <= r)) | (r >= max_radius)
+            keep = (ranks < k) & finished[windows]
+            results[unfinished[windows[keep]], ranks[keep]] = self.get_index_positions(positions[keep])
+            distances[unfinished[windows[keep]], ranks[keep]] = point_distances[keep]
+            radiuses[unfinished[full]] = kth_distances[full]
+            radiuses[unfinished[~full]] = np.minimum(np.maximum(r[~full] * 2, min_radius), max_radius)
+            unfinished = unfinished[~finished]
+        return results, distances, candidates
 
 
 class MyEncoder(json.JSONEncoder):
@@ -285,9 +922,13 @@ class MyEncoder(json.JSONEncoder):
         elif isinstance(obj, Region):
             return obj.__dict__
         elif isinstance(obj, ZMIndex):
-            return obj.__dict__
-        elif isinstance(obj, AbstractNN):
-            return obj.__dict__
+            # index_keys和index_positions单独保存为npy
+            return {key: value for key, value in obj.__dict__.items()
+                    if key not in ['index_keys', 'index_positions', 'delta_keys', 'delta_positions', 'delta_seqs',
+                                   'delta_log', 'lock', 'merge_lock', 'merge_thread', 'merge_deleted_seqs', 'merge_error',
+                                   'tombstones', 'stacked_rmi']}
+        elif isinstance(obj, (AbstractNN, LinearModel, PiecewiseLinearModel, RadixSpline)):
+            return obj.to_dict()
         else:
             return super(MyEncoder, self).default(obj)
 
@@ -298,10 +939,18 @@ class MyDecoder(json.JSONDecoder):
 
     def dict_to_object(self, d):
         t = None
-        if len(d.keys()) == 8 and d.__contains__("weights") and d.__contains__("core_nums") \
+        if len(d.keys()) in [8, 10] and d.__contains__("weights") and d.__contains__("core_nums") \
                 and d.__contains__("input_min") and d.__contains__("input_max") and d.__contains__("output_min") \
                 and d.__contains__("output_max") and d.__contains__("min_err") and d.__contains__("max_err"):
             t = AbstractNN.init_by_dict(d)
+        elif len(d.keys()) == 4 and d.__contains__("slope") and d.__contains__("intercept"):
+            t = LinearModel.init_by_dict(d)
+        elif len(d.keys()) == 5 and d.__contains__("keys") and d.__contains__("intercepts") \
+                and d.__contains__("slopes"):
+            t = PiecewiseLinearModel.init_by_dict(d)
+        elif len(d.keys()) == 8 and d.__contains__("knot_keys") and d.__contains__("knot_labels") \
+                and d.__contains__("table"):
+            t = RadixSpline.init_by_dict(d)
         elif len(d.keys()) == 4 and d.__contains__("bottom") and d.__contains__("up") \
                 and d.__contains__("left") and d.__contains__("right"):
             t = Region.init_by_dict(d)
@@ -339,4 +988,7 @@ if __name__ == '__main__':
     search_time = (end_time - start_time) / len(train_set_xy)
     print("Search time ", search_time)
     print("Not found nums ", result.isna().sum())
+    memory_usage = index.memory_usage()
+    print("Memory ", memory_usage)
+    print("Bytes per key ", memory_usage['total'] / len(train_set_xy))
     print("*************end %s************" % index_name)
@@ -8,7 +8,7 @@ from src.spatial_index.common_utils import read_data_and_search
 
 
 class ZMIndex(Index):
-    def __init__(self):
+    def __init__(self, search_mode='binary'):
         super(ZMIndex, self).__init__("ZM Index")
         self.block_size = 100
         self.total_number = None
@@ -22,6 +22,8 @@ class ZMIndex(Index):
         self.keep_ratios = [0.9, 1.0]
         self.index = None
         self.data = None
+        self.search_mode = search_mode  # binary: 在scope内二分, exponential: 从pre开始倍增查找
+        self.search_stats = {'searches': 0, 'probes': 0}
 
     def build(self, points):
         self.total_number = len(points)
@@ -96,17 +98,25 @@ class ZMIndex(Index):
         pre = self.index[i][leaf_model].predict(point.z)
         err = self.index[i][leaf_model].mean_err
         scope = list(range((pre - err) * self.block_size, (pre + err) * self.block_size))
-        value = self.binary_search(scope, point.index * self.block_size)
+        if self.search_mode == 'binary':
+            value = self.binary_search(scope, point.index * self.block_size)
+        elif self.search_mode == 'exponential':
+            value = self.exponential_search(scope, point.index * self.block_size, err * self.block_size)
+        else:
+            raise ValueError("unknown search mode: %s" % self.search_mode)
+        self.search_stats['searches'] += 1
         return value
 
-    def binary_search(self, nums, x):
+    def binary_search(self, nums, x, left=0, right=None):
         """
         nums: Sorted array from smallest to largest
         x: Target number
+        left, right: search in nums[left, right], the whole nums by default
         """
-        left, right = 0, len(nums) - 1
+        right = len(nums) - 1 if right is None else right
         while left <= right:
             mid = (left + right) // 2
+            self.search_stats['probes'] += 1
             if nums[mid] == x:
                 return mid
             if nums[mid] < x:
@@ -115,6 +125,41 @@ class ZMIndex(Index):
                 right = mid - 1
         return None
 
+    def exponential_search(self, nums, x, start):
+        """
+        nums: Sorted array from smallest to largest
+        x: Target number
+        start: predicted position, gallop from it with step 1, 2, 4... and binary search between the last two steps
+        """
+        if len(nums) == 0:
+            return None
+        start = min(max(int(start), 0), len(nums) - 1)
+        self.search_stats['probes'] += 1
+        if nums[start] == x:
+            return start
+        step = 1
+        if nums[start] < x:
+            left = start + 1
+            while start + step < len(nums):
+                self.search_stats['probes'] += 1
+                if nums[start + step] >= x:
+                    return self.binary_search(nums, x, left, start + step)
+                left = start + step + 1
+                step *= 2
+            return self.binary_search(nums, x, left, len(nums) - 1)
+        else:
+            right = start - 1
+            while start - step >= 0:
+                self.search_stats['probes'] += 1
+                if nums[start - step] <= x:
+                    return self.binary_search(nums, x, start - step, right)
+                right = start - step - 1
+                step *= 2
+            return self.binary_search(nums, x, 0, right)
+
+    def reset_search_stats(self):
+        self.search_stats = {'searches': 0, 'probes': 0}
+
 
 if __name__ == '__main__':
     os.chdir(os.path.dirname(os.path.realpath(__file__)))